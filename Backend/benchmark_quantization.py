@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Quantization Benchmark
+Compares fp32 against weight-only int8/int4 CPU inference on a fixed prompt set:
+peak memory, tokens/sec and output agreement with the fp32 reference.
+
+Each mode runs in its own subprocess so memory numbers are not mixed up.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+PROMPTS = [
+    "What is the normal adult potassium range?",
+    "List the first-line antihypertensive drug classes.",
+    "Explain the difference between type 1 and type 2 diabetes.",
+    "What are the common side effects of metformin?",
+    "Summarize the CURB-65 score and how it is used.",
+]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_mode(mode, max_new_tokens):
+    """Load the model with one quantization mode and generate for every prompt."""
+    os.environ["FORCE_CPU"] = "true"
+    os.environ["MODEL_QUANTIZATION"] = mode
+
+    import torch
+    from server.services.medgemma import MedGemmaService
+    from server.api.schemas.request import ChatDomain, ChatMode
+
+    service = MedGemmaService()
+    t0 = time.time()
+    service.load_model()
+    load_time = time.time() - t0
+    load_rss = peak_rss_mb()
+
+    outputs = []
+    total_tokens = 0
+    total_time = 0.0
+    for prompt in PROMPTS:
+        inputs = service.prepare_inputs(prompt, [], None, ChatDomain.GENERAL, ChatMode.CONSULT)
+        input_len = inputs["input_ids"].shape[1]
+
+        t1 = time.time()
+        with torch.no_grad():
+            generation = service.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        total_time += time.time() - t1
+
+        token_ids = generation[0, input_len:].tolist()
+        total_tokens += len(token_ids)
+        outputs.append(token_ids)
+
+    service.shutdown()
+    return {
+        "mode": mode,
+        "load_time_s": load_time,
+        "load_peak_rss_mb": load_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        "tokens_per_s": total_tokens / total_time if total_time > 0 else 0.0,
+        "outputs": outputs,
+    }
+
+
+def agreement(reference, candidate):
+    """Fraction of reference tokens matched before the first divergence."""
+    matched = 0
+    for a, b in zip(reference, candidate):
+        if a != b:
+            break
+        matched += 1
+    return matched / len(reference) if reference else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark quantized CPU inference")
+    parser.add_argument("--modes", nargs="+", default=["none", "int8", "int4"])
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_mode(args.worker, args.max_new_tokens)))
+        return
+
+    print("=" * 60)
+    print("QUANTIZATION BENCHMARK (CPU)")
+    print("=" * 60)
+
+    results = {}
+    for mode in args.modes:
+        print(f"\n⏳ Running mode: {mode}...")
+        proc = subprocess.run(
+            [sys.executable, __file__, "--worker", mode, "--max-new-tokens", str(args.max_new_tokens)],
+            capture_output=True,
+            text=True
+        )
+        if proc.returncode != 0:
+            print(f"❌ {mode} failed:\n{proc.stderr[-2000:]}")
+            continue
+        results[mode] = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"✅ {mode}: {results[mode]['tokens_per_s']:.2f} tok/s, peak RSS {results[mode]['peak_rss_mb']:.0f} MB")
+
+    reference = results.get("none")
+
+    print(f"\n{'Mode':<8}{'Load s':>8}{'Peak RSS MB':>14}{'Tok/s':>8}{'Exact':>8}{'Agreement':>11}")
+    for mode, result in results.items():
+        exact = "-"
+        agree = "-"
+        if reference is not None:
+            pairs = list(zip(reference["outputs"], result["outputs"]))
+            exact = f"{sum(a == b for a, b in pairs)}/{len(pairs)}"
+            agree = f"{sum(agreement(a, b) for a, b in pairs) / len(pairs):.1%}"
+        print(
+            f"{mode:<8}{result['load_time_s']:>8.1f}{result['peak_rss_mb']:>14.0f}"
+            f"{result['tokens_per_s']:>8.2f}{exact:>8}{agree:>11}"
+        )
+
+
+if __name__ == "__main__":
+    main()
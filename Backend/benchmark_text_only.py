@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Text-only Path Benchmark
+Compares the legacy dummy-image path against the text-only fast path:
+prompt tokens, prefill latency and end-to-end generation latency.
+"""
+
+import argparse
+import time
+import torch
+
+from server.config import settings
+from server.services.medgemma import MedGemmaService
+from server.api.schemas.request import ChatDomain, ChatMode
+
+
+PROMPTS = [
+    "What is the normal adult potassium range?",
+    "What is the primary difference between WBCs and RBCs",
+    "Summarize the first-line management of community-acquired pneumonia.",
+    "List common causes of microcytic anemia.",
+]
+
+
+def run_path(service, text_only, max_new_tokens):
+    """Run every prompt through one path and collect timings."""
+    settings.text_only_fast_path = text_only
+    results = []
+
+    for prompt in PROMPTS:
+        t0 = time.time()
+        inputs = service.prepare_inputs(prompt, [], None, ChatDomain.GENERAL, ChatMode.CONSULT)
+        prep_time = time.time() - t0
+        input_len = inputs["input_ids"].shape[1]
+
+        # Prefill only: one forward pass over the prompt
+        t1 = time.time()
+        with torch.no_grad():
+            service.model(**inputs, logits_to_keep=1)
+        prefill_time = time.time() - t1
+
+        # Full greedy generation
+        t2 = time.time()
+        with torch.no_grad():
+            generation = service.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        gen_time = time.time() - t2
+        output_ids = generation[0, input_len:].tolist()
+
+        results.append({
+            "input_tokens": input_len,
+            "prep": prep_time,
+            "prefill": prefill_time,
+            "generate": gen_time,
+            "output": service.processor.decode(output_ids, skip_special_tokens=True),
+        })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the text-only inference path")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("TEXT-ONLY PATH BENCHMARK")
+    print("=" * 60)
+
+    service = MedGemmaService()
+    print(f"\n⏳ Loading model on {service.device} ({service.dtype})...")
+    service.load_model()
+
+    # Warm up both paths so lazy initialization doesn't skew the first numbers
+    run_path(service, text_only=False, max_new_tokens=1)
+    run_path(service, text_only=True, max_new_tokens=1)
+
+    print("\n🖼️  Dummy-image path...")
+    dummy = run_path(service, text_only=False, max_new_tokens=args.max_new_tokens)
+    print("📝 Text-only path...")
+    text_only = run_path(service, text_only=True, max_new_tokens=args.max_new_tokens)
+
+    print(f"\n{'Prompt':<8}{'Tokens (dummy → text)':<26}{'Prefill s':<20}{'Generate s':<20}")
+    for i, (d, t) in enumerate(zip(dummy, text_only)):
+        print(
+            f"{i:<8}{d['input_tokens']:>6} → {t['input_tokens']:<15}"
+            f"{d['prefill']:>6.2f} → {t['prefill']:<10.2f}"
+            f"{d['generate']:>6.2f} → {t['generate']:<10.2f}"
+        )
+
+    def mean(rows, key):
+        return sum(r[key] for r in rows) / len(rows)
+
+    print(f"\n⏱️  AVERAGES (dummy → text-only):")
+    print(f"   Input tokens:     {mean(dummy, 'input_tokens'):.0f} → {mean(text_only, 'input_tokens'):.0f}")
+    print(f"   Preprocessing:    {mean(dummy, 'prep'):.3f}s → {mean(text_only, 'prep'):.3f}s")
+    print(f"   Prefill:          {mean(dummy, 'prefill'):.2f}s → {mean(text_only, 'prefill'):.2f}s")
+    print(f"   Generation:       {mean(dummy, 'generate'):.2f}s → {mean(text_only, 'generate'):.2f}s")
+
+    print("\n📤 Sample output (text-only):")
+    print(text_only[0]["output"])
+
+    service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
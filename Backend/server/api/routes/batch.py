@@ -0,0 +1,86 @@
+"""Batch generation job API routes."""
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+import logging
+
+from server.api.schemas import BatchGenerateRequest, BatchJobResponse
+from server.db import get_db
+from server.db.models import BatchJob
+from server.services.batch_jobs import batch_jobs
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/v1/batch", tags=["batch"])
+
+
+def job_response(db: Session, job: BatchJob) -> BatchJobResponse:
+    """Status of a job with its per-status item counts."""
+    counts = batch_jobs.item_counts(db, job.id)
+    return BatchJobResponse(
+        job_id=job.id,
+        status=job.status,
+        total=sum(counts.values()),
+        items=counts,
+        created_at=job.created_at,
+        updated_at=job.updated_at,
+        completed_at=job.completed_at,
+        results_url=f"/api/v1/batch/{job.id}/results"
+    )
+
+
+@router.post("/generate", response_model=BatchJobResponse, status_code=202)
+async def create_batch_job(request: BatchGenerateRequest, db: Session = Depends(get_db)):
+    """
+    Submit a batch generation job.
+
+    Each item is a prompt (message, domain/mode, optional image or summarize-mode
+    workspace) generated without conversation history. Items run in the
+    background at batch priority, behind interactive chat, and each result is
+    stored as soon as it is ready. Jobs resume after a server restart.
+
+    Poll GET /batch/{job_id} for progress and download GET /batch/{job_id}/results.
+    """
+    job = batch_jobs.create_job(
+        db,
+        [item.model_dump() for item in request.items],
+        max_new_tokens=request.max_new_tokens
+    )
+    return job_response(db, job)
+
+
+@router.get("/{job_id}", response_model=BatchJobResponse)
+async def get_batch_job(job_id: str, db: Session = Depends(get_db)):
+    """Get the status and progress of a batch job."""
+    job = batch_jobs.get_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job_response(db, job)
+
+
+@router.get("/{job_id}/results")
+async def get_batch_results(job_id: str, db: Session = Depends(get_db)):
+    """
+    Download the finished items of a batch job as JSONL.
+
+    One line per finished item, in submission order: index, custom_id, status
+    (done, failed or cancelled), response, finish_reason, error, completed_at.
+    Items still pending or generating are not included yet.
+    """
+    if not batch_jobs.get_job(db, job_id):
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return StreamingResponse(
+        batch_jobs.iter_results(job_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="batch-{job_id}.jsonl"'}
+    )
+
+
+@router.post("/{job_id}/cancel", response_model=BatchJobResponse)
+async def cancel_batch_job(job_id: str, db: Session = Depends(get_db)):
+    """Cancel a batch job; finished results are kept."""
+    job = batch_jobs.cancel_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job_response(db, job)
@@ -1,7 +1,8 @@
 """Chat API routes."""
 
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Request, UploadFile, File
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session
 from typing import Optional
 import uuid
@@ -11,18 +12,71 @@ import asyncio
 import time
 
 from server.api.schemas import ChatRequest, ChatResponse
+from server.api.schemas.request import ChatMode
 from server.db import get_db
-from server.services import medgemma_service, session_manager
+from server.services import (
+    medgemma_service, session_manager, GenerationCancelled,
+    generation_queue, Priority, QueueRejected
+)
+from server.services.generation_queue import GenerationSlot, QueueFull
+from server.services.model_readiness import ModelState
 from server.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Retry-After for requests that arrive while the model is still loading
+MODEL_LOADING_RETRY_AFTER_S = 5
+
 router = APIRouter(prefix="/api/v1", tags=["chat"])
 
 
+async def require_model_ready():
+    """Wait up to `model_ready_wait_s` for the model to finish loading.
+    
+    Raises:
+        HTTPException: 503 with the loading state and progress (and Retry-After)
+            while the model is not ready, or if loading failed
+    """
+    readiness = medgemma_service.readiness
+    if readiness.state == ModelState.READY:
+        return
+    if readiness.state == ModelState.NOT_LOADED:
+        # Not started by the app lifespan (e.g. embedded use): start it now
+        medgemma_service.start_background_load()
+    if settings.model_ready_wait_s > 0 and await asyncio.to_thread(readiness.wait, settings.model_ready_wait_s):
+        return
+    status = readiness.get_status()
+    message = "Model failed to load" if status["state"] == ModelState.FAILED.value else "Model is still loading"
+    raise HTTPException(
+        status_code=503,
+        detail={"message": message, **status},
+        headers={"Retry-After": str(MODEL_LOADING_RETRY_AFTER_S)}
+    )
+
+
+async def acquire_generation_slot(mode: ChatMode) -> GenerationSlot:
+    """Wait for the model and a generation slot; summarize requests queue behind interactive ones.
+    
+    Raises:
+        HTTPException: 503 while the model is loading; 429 if the queue is full,
+            503 if no slot freed up in time (all with a Retry-After header)
+    """
+    await require_model_ready()
+    priority = Priority.SUMMARIZE if mode == ChatMode.SUMMARIZE else Priority.INTERACTIVE
+    try:
+        return await generation_queue.acquire(priority)
+    except QueueRejected as e:
+        raise HTTPException(
+            status_code=429 if isinstance(e, QueueFull) else 503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after_s)}
+        )
+
+
 @router.post("/chat", response_model=ChatResponse)
 async def chat(
     request: ChatRequest,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
     """
@@ -34,8 +88,12 @@ async def chat(
     - image_path: Optional path to medical image
     - domain: Medical domain (general, radiology, pathology, dermatology)
     - mode: Interaction mode (consult, plan, diagnose)
+    - request_id: Optional client-chosen id for POST /chat/{request_id}/cancel
     
     The domain and mode determine the AI's specialized behavior and system prompt.
+    Generation is cancelled if the client disconnects before the reply is ready.
+    Returns 503 while the model is loading, and 429 (queue full) or 503 (queue wait
+    timed out) under load, all with Retry-After.
     """
     # Log incoming message
     request_start = time.time()
@@ -53,31 +111,49 @@ async def chat(
     history = session_manager.get_conversation_history(db, request.session_id)
     logger.info(f"[CHAT] History retrieval ({len(history)} msgs): {time.time()-t2:.3f}s")
     
-    # Save user message
-    t3 = time.time()
-    user_msg = session_manager.add_message(
-        db,
-        request.session_id,
-        role="user",
-        content=request.message,
-        image_path=request.image_path
-    )
-    logger.info(f"[CHAT] Save user message: {time.time()-t3:.3f}s")
+    # Wait for a generation slot before storing anything, so a rejected request leaves no trace
+    t_queue = time.time()
+    slot = await acquire_generation_slot(request.mode)
+    logger.info(f"[CHAT] Queue wait: {time.time()-t_queue:.3f}s")
     
     try:
+        # Save user message
+        t3 = time.time()
+        user_msg = session_manager.add_message(
+            db,
+            request.session_id,
+            role="user",
+            content=request.message,
+            image_path=request.image_path
+        )
+        logger.info(f"[CHAT] Save user message: {time.time()-t3:.3f}s")
+        
         # Generate response WITH domain/mode (run in thread to avoid MPS deadlock)
         t4 = time.time()
         logger.info(f"[CHAT] Starting model generation (domain={request.domain.value}, mode={request.mode.value})...")
-        response_text = await asyncio.to_thread(
-            medgemma_service.generate_response,
+        request_id = request.request_id or uuid.uuid4().hex
+        generation = asyncio.ensure_future(asyncio.to_thread(
+            medgemma_service.generate,
             user_message=request.message,
             conversation_history=history,
             image_path=request.image_path,
             domain=request.domain,
             mode=request.mode,
-            tools=request.tools
-        )
-        logger.info(f"[CHAT] Model generation complete: {time.time()-t4:.2f}s")
+            tools=request.tools,
+            session_id=request.session_id,
+            prompt_lookup=request.prompt_lookup,
+            request_id=request_id,
+            stop=request.stop
+        ))
+        # Don't keep the model busy for a client that has gone away
+        while not generation.done():
+            await asyncio.wait({generation}, timeout=1.0)
+            if not generation.done() and await http_request.is_disconnected():
+                logger.info(f"[CHAT] Client disconnected, cancelling {request_id}")
+                medgemma_service.cancel(request_id)
+        result = await generation
+        response_text = result.text
+        logger.info(f"[CHAT] Model generation complete: {time.time()-t4:.2f}s ({result.stop_reason})")
         
         # Save assistant response
         t5 = time.time()
@@ -94,12 +170,19 @@ async def chat(
         return ChatResponse(
             message_id=assistant_msg.id,
             response=response_text,
-            timestamp=assistant_msg.timestamp
+            timestamp=assistant_msg.timestamp,
+            finish_reason=result.stop_reason
         )
         
+    except GenerationCancelled:
+        # Nobody saw the reply, so it is not stored
+        logger.info(f"[CHAT] Generation cancelled after {time.time()-request_start:.2f}s")
+        raise HTTPException(status_code=409, detail="Generation cancelled")
     except Exception as e:
         logger.error(f"[CHAT] Error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+    finally:
+        slot.release()
 
 
 @router.post("/chat/stream")
@@ -117,8 +200,13 @@ async def chat_stream(
     - domain: Medical domain (general, radiology, pathology, dermatology)
     - mode: Interaction mode (consult, plan, diagnose, summarize)
     - workspace_path: Optional workspace path for summarize mode
+    - request_id: Optional client-chosen id for POST /chat/{request_id}/cancel
+      (also returned in the X-Request-ID header)
     
     The domain and mode determine the AI's specialized behavior and system prompt.
+    Closing the connection cancels the generation.
+    Returns 503 while the model is loading, and 429 (queue full) or 503 (queue wait
+    timed out) under load, all with Retry-After.
     """
     # Log incoming message
     logger.info(f"User Message: {request.message}")
@@ -142,14 +230,23 @@ async def chat_stream(
         # Prepend to user message
         user_message = f"{documents_content}\n\nUser request: {request.message}"
     
+    # Wait for a generation slot before storing anything, so a rejected request leaves no trace
+    slot = await acquire_generation_slot(request.mode)
+    
     # Save user message (original message, not with documents)
-    user_msg = session_manager.add_message(
-        db,
-        request.session_id,
-        role="user",
-        content=request.message,
-        image_path=request.image_path
-    )
+    try:
+        user_msg = session_manager.add_message(
+            db,
+            request.session_id,
+            role="user",
+            content=request.message,
+            image_path=request.image_path
+        )
+    except Exception:
+        slot.release()
+        raise
+    
+    request_id = request.request_id or uuid.uuid4().hex
     
     async def generate():
         try:
@@ -160,7 +257,11 @@ async def chat_stream(
                 image_path=request.image_path,
                 domain=request.domain,
                 mode=request.mode,
-                tools=request.tools
+                tools=request.tools,
+                session_id=request.session_id,
+                prompt_lookup=request.prompt_lookup,
+                request_id=request_id,
+                stop=request.stop
             ):
                 full_response.append(chunk)
                 yield f"data: {chunk}\n\n"
@@ -176,10 +277,35 @@ async def chat_stream(
             
             yield "data: [DONE]\n\n"
             
+        except GenerationCancelled:
+            # Cancelled via /chat/{request_id}/cancel: end the stream, don't store the partial reply
+            logger.info(f"Generation {request_id} cancelled")
+            yield "data: [DONE]\n\n"
         except Exception as e:
             yield f"data: [ERROR: {str(e)}]\n\n"
+        finally:
+            slot.release()
+    
+    # The background task frees the slot if the client leaves before the stream starts
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"X-Request-ID": request_id},
+        background=BackgroundTask(slot.release)
+    )
+
+
+@router.post("/chat/{request_id}/cancel")
+async def cancel_chat(request_id: str):
+    """
+    Cancel an in-flight generation.
     
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    The sequence is dropped before its next decode step and the partial reply
+    is not saved to the session.
+    """
+    if not medgemma_service.cancel(request_id):
+        raise HTTPException(status_code=404, detail="No generation in progress with this request id")
+    return {"status": "cancelled", "request_id": request_id}
 
 
 @router.post("/images")
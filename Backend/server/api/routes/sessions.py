@@ -12,7 +12,7 @@ from server.api.schemas import (
     MessageResponse
 )
 from server.db import get_db
-from server.services import session_manager
+from server.services import session_manager, medgemma_service
 
 router = APIRouter(prefix="/api/v1/sessions", tags=["sessions"])
 
@@ -118,4 +118,6 @@ def delete_session(
     if not success:
         raise HTTPException(status_code=404, detail="Session not found")
     
+    medgemma_service.forget_session(session_id)
+    
     return {"success": True}
@@ -4,6 +4,8 @@ from server.api.schemas.request import (
     ChatRequest,
     SessionCreateRequest,
     SessionUpdateRequest,
+    BatchGenerateItem,
+    BatchGenerateRequest,
 )
 from server.api.schemas.response import (
     MessageResponse,
@@ -12,16 +14,20 @@ from server.api.schemas.response import (
     SessionDetailResponse,
     HealthResponse,
     ImageUploadResponse,
+    BatchJobResponse,
 )
 
 __all__ = [
     "ChatRequest",
     "SessionCreateRequest",
     "SessionUpdateRequest",
+    "BatchGenerateItem",
+    "BatchGenerateRequest",
     "MessageResponse",
     "ChatResponse",
     "SessionResponse",
     "SessionDetailResponse",
     "HealthResponse",
     "ImageUploadResponse",
+    "BatchJobResponse",
 ]
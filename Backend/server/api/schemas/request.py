@@ -32,6 +32,9 @@ class ChatRequest(BaseModel):
     stream: bool = Field(False, description="Whether to stream the response")
     workspace_path: Optional[str] = Field(None, description="Workspace path for reading medical files (used in summarize mode)")
     tools: Optional[List[Dict[str, Any]]] = Field(None, description="Optional list of tool schemas from MCP server to inject into prompt")
+    prompt_lookup: Optional[bool] = Field(None, description="Use prompt-lookup decoding (defaults to on for summarize mode)")
+    request_id: Optional[str] = Field(None, description="Client-chosen id for cancelling via POST /chat/{request_id}/cancel")
+    stop: Optional[List[str]] = Field(None, description="Stop sequences; generation ends once the reply contains one of them")
     
     @validator('mode')
     def validate_agent_mode(cls, v, values):
@@ -41,6 +44,36 @@ class ChatRequest(BaseModel):
         return v
 
 
+class BatchGenerateItem(BaseModel):
+    """One prompt of a batch generation job."""
+    message: str = Field(..., description="User message text")
+    domain: ChatDomain = Field(default=ChatDomain.GENERAL, description="Medical domain for specialized behavior")
+    mode: ChatMode = Field(default=ChatMode.SUMMARIZE, description="Interaction mode")
+    image_path: Optional[str] = Field(None, description="Path to image file (optional)")
+    workspace_path: Optional[str] = Field(None, description="Workspace whose MD and PDF files are prepended to the message (summarize mode)")
+    custom_id: Optional[str] = Field(None, description="Client id returned with the item's result")
+    
+    @validator('mode')
+    def validate_agent_mode(cls, v, values):
+        """Reject Agent mode as it's not yet supported."""
+        if v == ChatMode.AGENT:
+            raise ValueError("Agent mode is not yet supported")
+        return v
+    
+    @validator('workspace_path')
+    def validate_workspace_mode(cls, v, values):
+        """Workspaces are only read in summarize mode, as in chat."""
+        if v and values.get('mode') != ChatMode.SUMMARIZE:
+            raise ValueError("workspace_path requires summarize mode")
+        return v
+
+
+class BatchGenerateRequest(BaseModel):
+    """Request model for submitting a batch generation job."""
+    items: List[BatchGenerateItem] = Field(..., min_length=1, description="Prompts to generate replies for")
+    max_new_tokens: Optional[int] = Field(None, gt=0, description="Maximum tokens per reply (default: service default)")
+
+
 class SessionCreateRequest(BaseModel):
     """Request model for creating a new session."""
     title: Optional[str] = Field(None, description="Optional title for the session")
@@ -22,6 +22,10 @@ class ChatResponse(BaseModel):
     message_id: str = Field(..., description="ID of the generated message")
     response: str = Field(..., description="Assistant's response")
     timestamp: datetime = Field(..., description="Timestamp of the response")
+    finish_reason: Optional[str] = Field(
+        None,
+        description="Why generation ended: eos, length, tool_call, stop_sequence, repetition or cache"
+    )
 
 
 class SessionResponse(BaseModel):
@@ -46,10 +50,26 @@ class HealthResponse(BaseModel):
     """Response model for health check."""
     status: str = Field(..., description="Server status")
     model_loaded: bool = Field(..., description="Whether the MedGemma model is loaded")
+    model_state: str = Field("ready", description="MedGemma state: not_loaded, loading, warming, ready or failed")
+    model_progress: Optional[str] = Field(None, description="Current loading step")
+    model_error: Optional[str] = Field(None, description="Why loading failed (state failed)")
+    model_load_elapsed_s: Optional[float] = Field(None, description="Seconds spent loading (total once ready)")
     version: str = Field(..., description="API version")
     medasr_loaded: bool = Field(False, description="Whether the MedASR model is loaded")
 
 
+class BatchJobResponse(BaseModel):
+    """Response model for batch job status."""
+    job_id: str = Field(..., description="Unique job identifier")
+    status: str = Field(..., description="Job status: queued, running, completed or cancelled")
+    total: int = Field(..., description="Number of items in the job")
+    items: Dict[str, int] = Field(..., description="Number of items per status (pending, running, done, failed, cancelled)")
+    created_at: datetime = Field(..., description="Job creation timestamp")
+    updated_at: datetime = Field(..., description="Last update timestamp")
+    completed_at: Optional[datetime] = Field(None, description="When the last item finished or the job was cancelled")
+    results_url: str = Field(..., description="JSONL download of the finished items")
+
+
 class ImageUploadResponse(BaseModel):
     """Response model for image upload."""
     image_id: str = Field(..., description="Unique image identifier")
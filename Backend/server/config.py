@@ -2,7 +2,7 @@
 
 import os
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 try:
     from pydantic_settings import BaseSettings
@@ -21,7 +21,101 @@ class Settings(BaseSettings):
     # Model settings
     model_name: str = "google/medgemma-4b-it"
     model_device: str = "auto"
-    model_dtype: str = "float16"
+    model_dtype: str = "auto"  # auto (per-device default), float32, float16 or bfloat16
+    model_quantization: str = "none"  # none, int8 or int4 (weight-only via torchao, CPU)
+    text_only_fast_path: bool = True  # Skip the dummy image / vision encoder for text-only requests
+    # Requests are preprocessed (template, processor, image) on a small worker pool; 0 = on the caller's thread
+    preprocess_workers: int = 2
+    preprocess_queue_depth: int = 16  # Requests waiting for a preprocessing worker before callers block
+    # Pre-converted safetensors snapshots in the serving dtype/quantization, memory-mapped at startup
+    model_snapshot_dir: Optional[str] = None  # e.g. ./storage/snapshots (None disables snapshots)
+    model_snapshot_create: bool = True  # Write the snapshot after a load from the Hub
+    # Generation requests arriving while the model loads wait this long before getting 503
+    model_ready_wait_s: float = 0.0
+    # Inference backend: torch, or onnx (exported graphs on ONNX Runtime, CPU)
+    inference_backend: str = "torch"
+    onnx_model_dir: Optional[str] = None  # Written by `python -m server.services.onnx_backend export`
+    onnx_intra_op_threads: int = 0  # ONNX Runtime intra-op threads; 0 = its default
+    
+    # Conversation history window (0 disables windowing)
+    history_max_tokens: int = 8192
+    history_min_recent_messages: int = 4  # Most recent messages are always kept
+    history_trim_ratio: float = 0.75  # Trim to this fraction of the budget when over it
+    
+    # Generation scheduler settings
+    scheduler_max_batch_size: int = 8  # Sequences decoded together per step
+    prefill_chunk_tokens: int = 512  # Longer prompts are prefilled in chunks between decode steps; 0 disables
+    kv_pool_mb: int = 0  # Paged KV block pool for the decode batch; 0 keeps one padded batch cache
+    kv_block_size: int = 16  # Tokens per KV block
+    
+    # Inference worker pool: >1 runs that many model replicas in worker processes
+    inference_replicas: int = 1
+    inference_threads_per_replica: int = 0  # torch intra-op threads / pinned cores; 0 splits the cores evenly
+    inference_pin_cores: bool = True  # Pin each replica to its own cores (Linux only)
+    
+    # Generation queue: admission control and priorities (interactive > summarize > batch)
+    generation_slots: int = 0  # Requests generating at once; 0 = scheduler_max_batch_size x inference_replicas
+    queue_max_depth_interactive: int = 32
+    queue_max_depth_summarize: int = 8
+    queue_max_depth_batch: int = 1024
+    queue_max_wait_interactive_s: float = 30.0  # 0 waits indefinitely
+    queue_max_wait_summarize_s: float = 120.0
+    queue_max_wait_batch_s: float = 0.0
+    batch_max_concurrency: int = 0  # Batch job items generating at once; 0 = generation slots - 1
+    
+    # End generation right after the first complete tool_code{...} block when tools are given
+    stop_on_tool_call: bool = True
+    # End generation once a span of `repetition_ngram_tokens` tokens has been
+    # generated `repetition_max_repeats` times back to back (a degenerate loop)
+    repetition_stop_enabled: bool = True
+    repetition_ngram_tokens: int = 12
+    repetition_max_repeats: int = 4
+    
+    # Speculative decoding for text-only requests (greedy output is unchanged)
+    speculative_enabled: bool = False
+    speculative_draft_model: str = "google/gemma-3-270m-it"
+    speculative_num_draft_tokens: int = 5
+    
+    # Prompt-lookup (n-gram copy) decoding, draft-free; per-request override via ChatRequest.prompt_lookup
+    prompt_lookup_modes: List[str] = ["summarize"]
+    prompt_lookup_num_tokens: int = 10
+    prompt_lookup_max_ngram: int = 3
+    
+    # Compiled mode: static KV cache + compiled decode step for requests decoding alone,
+    # warmed up at startup for each prompt-length bucket (longer prompts use the batch path)
+    compiled_mode_enabled: bool = False
+    compiled_prompt_buckets: List[int] = [256, 1024, 2048]
+    compiled_max_new_tokens: int = 1024  # Static cache holds largest bucket + this many tokens
+    compiled_warmup_tokens: int = 16
+    
+    # Exact-match response cache (same rendered prompt + image + params -> stored reply)
+    response_cache_enabled: bool = True
+    response_cache_max_entries: int = 512
+    response_cache_ttl_s: int = 3600  # 0 keeps replies until evicted or cleared
+    response_cache_sqlite_path: Optional[str] = None  # e.g. server/temp/response_cache.db
+    
+    # Semantic answer cache for history-free, image-free, tool-free questions (opt-in)
+    semantic_cache_enabled: bool = False
+    semantic_cache_embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2"
+    semantic_cache_modes: List[str] = ["consult"]
+    semantic_cache_threshold: float = 0.92  # Minimum cosine similarity for a hit
+    semantic_cache_max_entries: int = 2048  # Per domain/mode
+    semantic_cache_audit_path: Optional[str] = None  # JSONL of every hit, for false-hit review
+    
+    # Prefix KV cache (shared system prompt / tool block prefill)
+    prefix_cache_enabled: bool = True
+    prefix_cache_max_mb: int = 1024
+    
+    # Per-session KV cache (reuse conversation prefill across turns)
+    session_kv_enabled: bool = True
+    session_kv_ram_mb: int = 4096
+    session_kv_disk_mb: int = 16384  # 0 disables the disk tier
+    session_kv_idle_spill_s: int = 300
+    
+    # Vision embedding cache (keyed by image content hash)
+    vision_cache_enabled: bool = True
+    vision_cache_max_mb: int = 512
+    vision_cache_disk_dir: Optional[str] = None  # e.g. "./server/temp/vision_cache" to enable the disk tier
     
     # MedASR settings
     medasr_model_name: str = "google/medasr"
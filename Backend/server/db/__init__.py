@@ -1,6 +1,6 @@
 """Database package initialization."""
 
 from server.db.database import Base, engine, get_db, init_db
-from server.db.models import Session, Message
+from server.db.models import Session, Message, BatchJob, BatchItem
 
-__all__ = ["Base", "engine", "get_db", "init_db", "Session", "Message"]
+__all__ = ["Base", "engine", "get_db", "init_db", "Session", "Message", "BatchJob", "BatchItem"]
@@ -46,3 +46,50 @@ class Message(Base):
     
     def __repr__(self):
         return f"<Message(id={self.id}, role={self.role}, session_id={self.session_id})>"
+
+
+class BatchJob(Base):
+    """Offline generation job over many prompts."""
+    
+    __tablename__ = "batch_jobs"
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    status = Column(String, nullable=False, default="queued")  # 'queued', 'running', 'completed', 'cancelled'
+    max_new_tokens = Column(Integer, nullable=True)  # None = service default
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    completed_at = Column(DateTime, nullable=True)
+    
+    # Relationship to items
+    items = relationship("BatchItem", back_populates="job", cascade="all, delete-orphan", order_by="BatchItem.index")
+    
+    def __repr__(self):
+        return f"<BatchJob(id={self.id}, status={self.status})>"
+
+
+class BatchItem(Base):
+    """One prompt of a batch job and, once generated, its result."""
+    
+    __tablename__ = "batch_items"
+    
+    id = Column(String, primary_key=True, default=generate_uuid)
+    job_id = Column(String, ForeignKey("batch_jobs.id"), nullable=False, index=True)
+    index = Column(Integer, nullable=False)  # Position in the submitted list
+    custom_id = Column(String, nullable=True)  # Client's id for matching results
+    message = Column(Text, nullable=False)
+    domain = Column(String, nullable=False)
+    mode = Column(String, nullable=False)
+    image_path = Column(String, nullable=True)
+    workspace_path = Column(String, nullable=True)
+    status = Column(String, nullable=False, default="pending", index=True)  # 'pending', 'running', 'done', 'failed', 'cancelled'
+    response = Column(Text, nullable=True)
+    finish_reason = Column(String, nullable=True)
+    error = Column(Text, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    completed_at = Column(DateTime, nullable=True)
+    
+    # Relationship to job
+    job = relationship("BatchJob", back_populates="items")
+    
+    def __repr__(self):
+        return f"<BatchItem(id={self.id}, job_id={self.job_id}, index={self.index}, status={self.status})>"
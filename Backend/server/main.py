@@ -3,13 +3,15 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 
 from server.config import settings
 from server.db import init_db
-from server.services import medgemma_service, medasr_service
+from server.services import medgemma_service, medasr_service, generation_queue
 from server.services.system_prompts import clear_prompt_cache
-from server.api.routes import chat, sessions, dicom, documents, speech
+from server.api.routes import chat, sessions, dicom, documents, speech, batch
+from server.services.batch_jobs import batch_jobs
 from server.api.schemas import HealthResponse
 
 # Configure logging
@@ -29,9 +31,13 @@ async def lifespan(app: FastAPI):
     init_db()
     print("Database initialized")
     
-    # Load model in background
-    print("Loading MedGemma model...")
-    medgemma_service.load_model()
+    # Load the model on a background thread: sessions, DICOM and PDF endpoints are
+    # usable right away, generation returns 503 until the model is ready
+    print("Loading MedGemma model in the background...")
+    medgemma_service.start_background_load()
+    
+    # Resume unfinished batch jobs (items start once the model is ready)
+    batch_jobs.start()
     
     # Note: MedASR is loaded on-demand (lazy loading) when speech endpoint is first called
     print("MedASR model will be loaded on-demand when needed")
@@ -40,6 +46,8 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     print("Shutting down MedCompanion server...")
+    await batch_jobs.stop()
+    medgemma_service.shutdown()
     
     # Clean up DICOM temp folders
     from server.api.routes.dicom import cleanup_all_temp_folders
@@ -69,14 +77,20 @@ app.include_router(sessions.router)
 app.include_router(dicom.router)
 app.include_router(documents.router)
 app.include_router(speech.router)
+app.include_router(batch.router)
 
 
 @app.get("/api/v1/health", response_model=HealthResponse)
 async def health_check():
-    """Health check endpoint."""
+    """Health check endpoint (the server is up; `model_state` says whether generation is)."""
+    readiness = medgemma_service.readiness.get_status()
     return HealthResponse(
         status="ok",
         model_loaded=medgemma_service.model_loaded,
+        model_state=readiness["state"],
+        model_progress=readiness["progress"],
+        model_error=readiness["error"],
+        model_load_elapsed_s=readiness.get("elapsed_s"),
         version="1.0.0",
         medasr_loaded=medasr_service.model_loaded
     )
@@ -92,10 +106,23 @@ async def root():
     }
 
 
+@app.get("/api/v1/admin/generation-stats")
+async def generation_stats():
+    """Generation counters (scheduler throughput, admission queue depth and wait times, cache hit rates, batch jobs)."""
+    # A replica pool waits for every worker process to answer; keep that off the event loop
+    stats = await asyncio.to_thread(medgemma_service.get_stats)
+    stats["queue"] = generation_queue.get_stats()
+    stats["batch"] = batch_jobs.get_stats()
+    return stats
+
+
 @app.post("/api/v1/admin/clear-prompt-cache")
 async def clear_cache():
-    """Clear the system prompt cache. Useful for development when updating prompts."""
+    """Clear the system prompt cache (and cached replies). Useful for development when updating prompts."""
     clear_prompt_cache()
+    if hasattr(medgemma_service, "clear_prompt_cache"):
+        # Replica worker processes keep their own prompt and reply caches
+        medgemma_service.clear_prompt_cache()
     return {"status": "ok", "message": "Prompt cache cleared. New prompts will be loaded on next request."}
 
 
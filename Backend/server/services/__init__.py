@@ -1,11 +1,13 @@
 """Services package."""
 
-from server.services.medgemma import medgemma_service, MedGemmaService
+from server.services.medgemma import medgemma_service, MedGemmaService, GenerationCancelled
 from server.services.medasr import medasr_service, MedASRService
 from server.services.session_manager import session_manager, SessionManager
+from server.services.generation_queue import generation_queue, GenerationQueue, Priority, QueueRejected
 
 __all__ = [
-    "medgemma_service", "MedGemmaService",
+    "medgemma_service", "MedGemmaService", "GenerationCancelled",
     "medasr_service", "MedASRService",
-    "session_manager", "SessionManager"
+    "session_manager", "SessionManager",
+    "generation_queue", "GenerationQueue", "Priority", "QueueRejected"
 ]
@@ -0,0 +1,325 @@
+"""Offline batch generation jobs.
+
+`/chat` and `/chat/stream` serve one interactive request at a time per client.
+Overnight work, such as drafting discharge summaries for a list of workspaces,
+is submitted as a job instead: many prompts that run in the background.
+
+Items are stored in the database when the job is submitted, and each result is
+committed as soon as it is generated. The runner keeps up to `concurrency` items
+in flight so the scheduler decodes them in one batch. Each item takes a
+generation slot at BATCH priority, so interactive chat still goes first.
+
+A restart loses nothing: items that were generating are put back to pending
+and the runner continues with the oldest unfinished job.
+"""
+
+import asyncio
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set
+import logging
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from server.config import settings
+from server.db.database import SessionLocal
+from server.db.models import BatchJob, BatchItem
+from server.api.schemas.request import ChatDomain, ChatMode
+from server.services.medgemma import medgemma_service, GenerationCancelled
+from server.services.generation_queue import generation_queue, Priority, QueueRejected
+from server.services.model_readiness import ModelState
+
+logger = logging.getLogger(__name__)
+
+ITEM_STATUSES = ("pending", "running", "done", "failed", "cancelled")
+
+
+class BatchJobManager:
+    """Stores batch jobs and runs their items through the generation queue."""
+
+    def __init__(self, service, queue, concurrency: int):
+        """
+        Args:
+            service: Generation service (`MedGemmaService` or `ReplicaWorkerPool`)
+            queue: Admission queue items wait in at BATCH priority
+            concurrency: Items generating at once
+        """
+        self.service = service
+        self.queue = queue
+        self.concurrency = concurrency
+
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._stats = {"items_done": 0, "items_failed": 0, "items_cancelled": 0, "tokens_generated": 0}
+
+    # --- Jobs (called from the routes with a request-scoped db session) ---
+
+    def create_job(self, db: Session, items: List[Dict[str, Any]], max_new_tokens: Optional[int] = None) -> BatchJob:
+        """Store a job and its items, and wake the runner."""
+        job = BatchJob(max_new_tokens=max_new_tokens)
+        job.items = [
+            BatchItem(
+                index=i,
+                custom_id=item.get("custom_id"),
+                message=item["message"],
+                domain=ChatDomain(item.get("domain", ChatDomain.GENERAL)).value,
+                mode=ChatMode(item.get("mode", ChatMode.SUMMARIZE)).value,
+                image_path=item.get("image_path"),
+                workspace_path=item.get("workspace_path")
+            )
+            for i, item in enumerate(items)
+        ]
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        logger.info(f"[BATCH] Job {job.id} queued with {len(items)} items")
+        self._notify()
+        return job
+
+    def get_job(self, db: Session, job_id: str) -> Optional[BatchJob]:
+        """Get a job by ID."""
+        return db.query(BatchJob).filter(BatchJob.id == job_id).first()
+
+    def item_counts(self, db: Session, job_id: str) -> Dict[str, int]:
+        """Number of the job's items in each status."""
+        rows = db.query(BatchItem.status, func.count(BatchItem.id)).filter(
+            BatchItem.job_id == job_id
+        ).group_by(BatchItem.status).all()
+        counts = {status: 0 for status in ITEM_STATUSES}
+        counts.update(dict(rows))
+        return counts
+
+    def cancel_job(self, db: Session, job_id: str) -> Optional[BatchJob]:
+        """Cancel a job: pending items are skipped, generating ones are stopped."""
+        job = self.get_job(db, job_id)
+        if job is None or job.status in ("completed", "cancelled"):
+            return job
+        job.status = "cancelled"
+        job.completed_at = datetime.utcnow()
+        running = []
+        for item in job.items:
+            if item.status == "pending":
+                item.status = "cancelled"
+            elif item.status == "running":
+                running.append(item.id)
+        db.commit()
+        for item_id in running:
+            self.service.cancel(self._request_id(item_id))
+        logger.info(f"[BATCH] Job {job_id} cancelled ({len(running)} items were generating)")
+        return job
+
+    def iter_results(self, job_id: str) -> Iterator[str]:
+        """JSONL lines for the job's finished items, in submission order.
+        
+        Uses its own db session, since the response is streamed after the route returns.
+        """
+        db = SessionLocal()
+        try:
+            items = db.query(BatchItem).filter(
+                BatchItem.job_id == job_id,
+                BatchItem.status.in_(("done", "failed", "cancelled"))
+            ).order_by(BatchItem.index).yield_per(100)
+            for item in items:
+                yield json.dumps({
+                    "index": item.index,
+                    "custom_id": item.custom_id,
+                    "status": item.status,
+                    "response": item.response,
+                    "finish_reason": item.finish_reason,
+                    "error": item.error,
+                    "completed_at": item.completed_at.isoformat() if item.completed_at else None,
+                }) + "\n"
+        finally:
+            db.close()
+
+    # --- Runner ---
+
+    def start(self):
+        """Resume unfinished jobs and start the runner (call from the event loop)."""
+        db = SessionLocal()
+        try:
+            # Items that were generating when the server stopped start over
+            resumed = db.query(BatchItem).filter(BatchItem.status == "running").update(
+                {"status": "pending", "started_at": None}, synchronize_session=False
+            )
+            cancelled_jobs = db.query(BatchJob.id).filter(BatchJob.status == "cancelled")
+            db.query(BatchItem).filter(
+                BatchItem.status == "pending",
+                BatchItem.job_id.in_(cancelled_jobs)
+            ).update({"status": "cancelled"}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        if resumed:
+            logger.info(f"[BATCH] Resuming {resumed} interrupted items")
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the runner; interrupted items are resumed by the next `start`."""
+        tasks = [t for t in [self._task, *self._in_flight] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    @staticmethod
+    def _request_id(item_id: str) -> str:
+        return f"batch-{item_id}"
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            # Nothing can generate until the model is ready
+            while self.service.readiness.state != ModelState.READY:
+                await asyncio.sleep(1.0)
+
+            await semaphore.acquire()
+            # Cleared before looking, so a job submitted meanwhile still wakes the runner
+            self._wakeup.clear()
+            item_id = self._claim_next_item()
+            if item_id is None:
+                semaphore.release()
+                await self._wakeup.wait()
+                continue
+            task = asyncio.create_task(self._run_item(item_id))
+            self._in_flight.add(task)
+            task.add_done_callback(lambda t: (self._in_flight.discard(t), semaphore.release()))
+
+    def _claim_next_item(self) -> Optional[str]:
+        """Mark the oldest job's next pending item as running and return its id."""
+        db = SessionLocal()
+        try:
+            item = db.query(BatchItem).join(BatchJob).filter(
+                BatchItem.status == "pending",
+                BatchJob.status.in_(("queued", "running"))
+            ).order_by(BatchJob.created_at, BatchItem.index).first()
+            if item is None:
+                return None
+            item.status = "running"
+            item.started_at = datetime.utcnow()
+            if item.job.status == "queued":
+                item.job.status = "running"
+            db.commit()
+            return item.id
+        finally:
+            db.close()
+
+    async def _run_item(self, item_id: str):
+        # Short-lived sessions only: an open SQLite transaction would block chat writes
+        try:
+            kwargs, workspace_path = self._load_item(item_id)
+            if workspace_path:
+                from server.services.document_scanner import scan_and_read_workspace
+                documents_content = await asyncio.to_thread(scan_and_read_workspace, workspace_path)
+                kwargs["user_message"] = f"{documents_content}\n\nUser request: {kwargs['user_message']}"
+
+            slot = await self._acquire_slot()
+            try:
+                if self._job_cancelled(item_id):
+                    raise GenerationCancelled("Batch job cancelled")
+                result = await asyncio.to_thread(self.service.generate, **kwargs)
+            except asyncio.CancelledError:
+                # Server shutting down: free the model, the item is resumed on restart
+                self.service.cancel(self._request_id(item_id))
+                raise
+            finally:
+                slot.release()
+        except asyncio.CancelledError:
+            raise
+        except GenerationCancelled:
+            self._save_item(item_id, status="cancelled")
+            self._stats["items_cancelled"] += 1
+        except Exception as e:
+            logger.error(f"[BATCH] Item {item_id} failed: {e}", exc_info=True)
+            self._save_item(item_id, status="failed", error=str(e))
+            self._stats["items_failed"] += 1
+        else:
+            self._save_item(item_id, status="done", response=result.text, finish_reason=result.stop_reason)
+            self._stats["items_done"] += 1
+            self._stats["tokens_generated"] += len(result.token_ids)
+
+    def _load_item(self, item_id: str):
+        """Generation kwargs for an item, and its workspace path."""
+        db = SessionLocal()
+        try:
+            item = db.query(BatchItem).filter(BatchItem.id == item_id).first()
+            kwargs = dict(
+                user_message=item.message,
+                conversation_history=[],
+                image_path=item.image_path,
+                domain=ChatDomain(item.domain),
+                mode=ChatMode(item.mode),
+                request_id=self._request_id(item_id)
+            )
+            if item.job.max_new_tokens:
+                kwargs["max_new_tokens"] = item.job.max_new_tokens
+            return kwargs, item.workspace_path
+        finally:
+            db.close()
+
+    def _job_cancelled(self, item_id: str) -> bool:
+        db = SessionLocal()
+        try:
+            item = db.query(BatchItem).filter(BatchItem.id == item_id).first()
+            return item.job.status == "cancelled"
+        finally:
+            db.close()
+
+    def _save_item(self, item_id: str, **fields):
+        """Commit an item's result and complete its job once nothing is left."""
+        db = SessionLocal()
+        try:
+            item = db.query(BatchItem).filter(BatchItem.id == item_id).first()
+            for name, value in fields.items():
+                setattr(item, name, value)
+            item.completed_at = datetime.utcnow()
+            self._finish_job_if_done(db, item.job)
+            db.commit()
+            logger.info(f"[BATCH] Item {item.index} of job {item.job_id}: {item.status}")
+        finally:
+            db.close()
+
+    async def _acquire_slot(self):
+        """A generation slot at BATCH priority, retrying while the queue rejects."""
+        while True:
+            try:
+                return await self.queue.acquire(Priority.BATCH)
+            except QueueRejected as e:
+                await asyncio.sleep(e.retry_after_s)
+
+    def _finish_job_if_done(self, db: Session, job: BatchJob):
+        if job.status != "running":
+            return
+        # The session does not autoflush, so the item just saved would still count as running
+        db.flush()
+        unfinished = db.query(BatchItem).filter(
+            BatchItem.job_id == job.id,
+            BatchItem.status.in_(("pending", "running"))
+        ).count()
+        if unfinished == 0:
+            job.status = "completed"
+            job.completed_at = datetime.utcnow()
+            logger.info(f"[BATCH] Job {job.id} completed")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return runner counters."""
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["concurrency"] = self.concurrency
+        stats["in_flight"] = len(self._in_flight)
+        return stats
+
+
+# Global manager instance. The queue never takes a slot back from a running item,
+# so by default one slot stays free for interactive chat.
+batch_jobs = BatchJobManager(
+    medgemma_service,
+    generation_queue,
+    concurrency=settings.batch_max_concurrency or max(1, generation_queue.slots - 1)
+)
@@ -0,0 +1,246 @@
+"""Priority admission queue for generation requests.
+
+The scheduler decodes up to `scheduler_max_batch_size` sequences per replica and
+queues everything else in arrival order, so under load every caller waits longer
+and longer until clients time out. `GenerationQueue` sits in front of the model:
+a request holds one of `slots` generation slots while it runs, or waits for one.
+Waiting requests are served by priority (interactive chat, then summarize, then
+batch jobs) and in arrival order within a priority.
+
+Each priority has a maximum queue depth and a maximum queue wait. A request that
+arrives at a full queue is rejected at once (`QueueFull`, HTTP 429), and one that
+waits past its deadline gets `QueueTimeout` (HTTP 503). Both carry a Retry-After
+estimate from the observed time a request holds its slot.
+
+All methods must be called from the event loop thread.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from enum import IntEnum
+from typing import Any, Dict, List
+import logging
+
+from server.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the wait-time (seconds) and queue-depth histogram buckets; the last bucket is unbounded
+WAIT_BUCKETS_S = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+DEPTH_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64]
+
+# Weight of the newest observation in the running average of slot hold time
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class Priority(IntEnum):
+    """Queue priority; lower values are served first."""
+    INTERACTIVE = 0
+    SUMMARIZE = 1
+    BATCH = 2
+
+
+class QueueRejected(Exception):
+    """A request was not admitted; retry after `retry_after_s` seconds."""
+
+    def __init__(self, message: str, retry_after_s: int):
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+class QueueFull(QueueRejected):
+    """The queue of the request's priority is at its maximum depth."""
+
+
+class QueueTimeout(QueueRejected):
+    """The request waited longer than its priority's maximum queue wait."""
+
+
+def _observe(histogram: List[int], bounds: List[float], value: float):
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            histogram[i] += 1
+            return
+    histogram[-1] += 1
+
+
+def _histogram_dict(histogram: List[int], bounds: List[float]) -> Dict[str, int]:
+    labels = [f"le_{bound:g}" for bound in bounds] + ["inf"]
+    return dict(zip(labels, histogram))
+
+
+class GenerationSlot:
+    """A held generation slot; `release` hands it to the next waiting request."""
+
+    def __init__(self, queue: "GenerationQueue", priority: Priority):
+        self.queue = queue
+        self.priority = priority
+        self.acquired_at = time.time()
+        self.released = False
+
+    def release(self):
+        """Return the slot (safe to call more than once)."""
+        if self.released:
+            return
+        self.released = True
+        self.queue._release(self)
+
+
+class GenerationQueue:
+    """Bounded priority queue in front of a fixed number of generation slots."""
+
+    def __init__(
+        self,
+        slots: int,
+        max_depth: Dict[Priority, int],
+        max_wait_s: Dict[Priority, float],
+        initial_service_s: float = 10.0
+    ):
+        """
+        Args:
+            slots: Requests allowed to generate at once
+            max_depth: Waiting requests allowed per priority
+            max_wait_s: Longest queue wait per priority (0 waits indefinitely)
+            initial_service_s: Slot hold time assumed until requests have completed
+        """
+        self.slots = slots
+        self.max_depth = max_depth
+        self.max_wait_s = max_wait_s
+
+        self._in_use = 0
+        self._waiting: List[List[Any]] = []  # heap of [priority, sequence, future]
+        self._depth = {priority: 0 for priority in Priority}
+        self._sequence = itertools.count()
+        self._service_s = initial_service_s
+
+        self._stats = {
+            priority: {
+                "admitted": 0,
+                "rejected_full": 0,
+                "timed_out": 0,
+                "abandoned": 0,
+                "completed": 0,
+                "wait_time_s": 0.0,
+                "wait_histogram": [0] * (len(WAIT_BUCKETS_S) + 1),
+                "depth_histogram": [0] * (len(DEPTH_BUCKETS) + 1),
+            }
+            for priority in Priority
+        }
+
+    def retry_after(self, priority: Priority) -> int:
+        """Seconds until a new request of `priority` would likely get a slot."""
+        ahead = sum(depth for p, depth in self._depth.items() if p <= priority)
+        return max(1, math.ceil((ahead + 1) * self._service_s / self.slots))
+
+    async def acquire(self, priority: Priority) -> GenerationSlot:
+        """Wait for a generation slot.
+
+        Raises:
+            QueueFull: If the queue of this priority is at its maximum depth
+            QueueTimeout: If no slot became free within the priority's maximum wait
+        """
+        stats = self._stats[priority]
+        if self._in_use < self.slots and not any(self._depth.values()):
+            self._in_use += 1
+            return self._admitted(priority, 0.0)
+
+        if self._depth[priority] >= self.max_depth[priority]:
+            stats["rejected_full"] += 1
+            retry_after = self.retry_after(priority)
+            logger.info(f"[QUEUE] Rejected {priority.name} request: queue full (retry after {retry_after}s)")
+            raise QueueFull(f"Generation queue for {priority.name.lower()} requests is full", retry_after)
+
+        ahead = sum(depth for p, depth in self._depth.items() if p <= priority)
+        _observe(stats["depth_histogram"], DEPTH_BUCKETS, ahead)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, [priority, next(self._sequence), future])
+        self._depth[priority] += 1
+
+        t0 = time.time()
+        timeout = self.max_wait_s[priority] or None
+        try:
+            await asyncio.wait({future}, timeout=timeout)
+        except asyncio.CancelledError:
+            # Caller went away while waiting: give back a slot granted in the meantime
+            if future.done():
+                self._in_use -= 1
+                self._grant()
+            else:
+                future.cancel()
+                self._depth[priority] -= 1
+            stats["abandoned"] += 1
+            raise
+
+        if not future.done():
+            future.cancel()
+            self._depth[priority] -= 1
+            stats["timed_out"] += 1
+            retry_after = self.retry_after(priority)
+            logger.info(f"[QUEUE] {priority.name} request timed out after {time.time()-t0:.1f}s in queue")
+            raise QueueTimeout(f"No generation slot became free within {timeout:g}s", retry_after)
+        return self._admitted(priority, time.time() - t0)
+
+    def _admitted(self, priority: Priority, wait_s: float) -> GenerationSlot:
+        stats = self._stats[priority]
+        stats["admitted"] += 1
+        stats["wait_time_s"] += wait_s
+        _observe(stats["wait_histogram"], WAIT_BUCKETS_S, wait_s)
+        return GenerationSlot(self, priority)
+
+    def _release(self, slot: GenerationSlot):
+        held_s = time.time() - slot.acquired_at
+        self._service_s += SERVICE_TIME_SMOOTHING * (held_s - self._service_s)
+        self._stats[slot.priority]["completed"] += 1
+        self._in_use -= 1
+        self._grant()
+
+    def _grant(self):
+        """Hand free slots to the highest-priority waiters."""
+        while self._in_use < self.slots and self._waiting:
+            priority, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue  # timed out or abandoned
+            self._depth[priority] -= 1
+            self._in_use += 1
+            future.set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return slot usage, queue depth and wait-time histograms per priority."""
+        priorities = {}
+        for priority, counters in self._stats.items():
+            stats = dict(counters)
+            stats["depth"] = self._depth[priority]
+            stats["max_depth"] = self.max_depth[priority]
+            stats["max_wait_s"] = self.max_wait_s[priority]
+            if stats["admitted"]:
+                stats["avg_wait_s"] = round(stats["wait_time_s"] / stats["admitted"], 3)
+            stats["wait_time_s"] = round(stats["wait_time_s"], 3)
+            stats["wait_histogram"] = _histogram_dict(counters["wait_histogram"], WAIT_BUCKETS_S)
+            stats["depth_histogram"] = _histogram_dict(counters["depth_histogram"], DEPTH_BUCKETS)
+            priorities[priority.name.lower()] = stats
+        return {
+            "slots": self.slots,
+            "in_use": self._in_use,
+            "avg_service_s": round(self._service_s, 2),
+            "throughput_per_s": round(self.slots / self._service_s, 3) if self._service_s > 0 else None,
+            "priorities": priorities,
+        }
+
+
+# Global queue instance (one slot per sequence the replicas can decode at once)
+generation_queue = GenerationQueue(
+    slots=settings.generation_slots or settings.scheduler_max_batch_size * max(settings.inference_replicas, 1),
+    max_depth={
+        Priority.INTERACTIVE: settings.queue_max_depth_interactive,
+        Priority.SUMMARIZE: settings.queue_max_depth_summarize,
+        Priority.BATCH: settings.queue_max_depth_batch,
+    },
+    max_wait_s={
+        Priority.INTERACTIVE: settings.queue_max_wait_interactive_s,
+        Priority.SUMMARIZE: settings.queue_max_wait_summarize_s,
+        Priority.BATCH: settings.queue_max_wait_batch_s,
+    }
+)
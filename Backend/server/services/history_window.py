@@ -0,0 +1,145 @@
+"""Token-budgeted conversation history windowing.
+
+`get_conversation_history` returns every message of a session, so without a
+limit each turn's prompt (and prefill time) grows with the session and can
+eventually exceed the model context. `HistoryWindow` keeps the most recent
+messages that fit a token budget; the system prompt is added separately by
+`prepare_messages` and is always kept.
+
+Token counts come from the processor's tokenizer and are cached per message.
+When a session goes over budget the oldest messages are dropped down to a lower
+watermark, and the window start is remembered per session. The start then stays
+put for the next several turns, which keeps the prompt prefix (and the reusable
+KV state) stable instead of shifting on every turn.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Chat-template tokens around each message ("<start_of_turn>user\n ... <end_of_turn>\n")
+MESSAGE_OVERHEAD_TOKENS = 5
+
+
+class HistoryWindow:
+    """Fits conversation history to a token budget."""
+
+    def __init__(
+        self,
+        tokenizer,
+        max_tokens: int,
+        min_recent_messages: int = 4,
+        trim_ratio: float = 0.75,
+        count_cache_size: int = 4096,
+        max_sessions: int = 1024
+    ):
+        """
+        Args:
+            tokenizer: Tokenizer used to count message tokens
+            max_tokens: Token budget for the history (excluding system prompt and new message)
+            min_recent_messages: Most recent messages that are always kept
+            trim_ratio: When over budget, trim down to this fraction of the budget
+            count_cache_size: Number of per-message token counts to remember
+            max_sessions: Number of per-session window starts to remember
+        """
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.min_recent_messages = min_recent_messages
+        self.trim_ratio = trim_ratio
+        self.count_cache_size = count_cache_size
+        self.max_sessions = max_sessions
+
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+        self._window_starts: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "windows": 0,
+            "trimmed_windows": 0,
+            "excluded_messages": 0,
+            "count_cache_hits": 0,
+            "count_cache_misses": 0,
+        }
+
+    def count_tokens(self, message: Dict[str, Any]) -> int:
+        """Token count of a message's content, cached by content hash."""
+        content = message.get("content")
+        text = content if isinstance(content, str) else str(content)
+        key = hashlib.sha1(f"{message.get('role')}\x00{text}".encode("utf-8")).hexdigest()
+
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                self._stats["count_cache_hits"] += 1
+                return count
+
+        count = len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+        with self._lock:
+            self._stats["count_cache_misses"] += 1
+            self._counts[key] = count
+            while len(self._counts) > self.count_cache_size:
+                self._counts.popitem(last=False)
+        return count
+
+    def fit(self, history: List[Dict[str, Any]], session_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return the most recent part of `history` that fits the token budget.
+
+        Args:
+            history: Conversation history, oldest first
+            session_id: Session the history belongs to, used to keep the window start stable
+
+        Returns:
+            The kept suffix of `history`
+        """
+        if not history:
+            return history
+
+        counts = [self.count_tokens(m) + MESSAGE_OVERHEAD_TOKENS for m in history]
+        pinned_start = max(len(history) - self.min_recent_messages, 0)
+
+        with self._lock:
+            start = self._window_starts.get(session_id, 0) if session_id else 0
+        if start > pinned_start:
+            start = 0
+
+        total = sum(counts[start:])
+        trimmed = False
+        if total > self.max_tokens:
+            # Trim below the budget so the next few turns keep the same start
+            target = self.max_tokens * self.trim_ratio
+            while start < pinned_start and total > target:
+                total -= counts[start]
+                start += 1
+            trimmed = True
+
+        # The chat template requires the kept history to begin with a user turn
+        while start < pinned_start and history[start].get("role") != "user":
+            total -= counts[start]
+            start += 1
+
+        with self._lock:
+            self._stats["windows"] += 1
+            self._stats["excluded_messages"] += start
+            if trimmed:
+                self._stats["trimmed_windows"] += 1
+            if session_id:
+                self._window_starts[session_id] = start
+                self._window_starts.move_to_end(session_id)
+                while len(self._window_starts) > self.max_sessions:
+                    self._window_starts.popitem(last=False)
+
+        if start:
+            logger.info(f"[HISTORY] Keeping {len(history) - start}/{len(history)} messages (~{total} tokens)")
+        return history[start:]
+
+    def get_stats(self) -> Dict[str, int]:
+        """Return windowing and token-count cache counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["max_tokens"] = self.max_tokens
+            return stats
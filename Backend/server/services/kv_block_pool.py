@@ -0,0 +1,268 @@
+"""Paged KV-cache block pool for the decode batch.
+
+The scheduler's contiguous batch cache stores every row left-padded to the
+longest sequence, and each merge or retire re-concatenates the whole cache. That
+wastes memory on padding, fragments the heap, and limits how many sequences fit
+in RAM. With a pool, each sequence's KV state lives in fixed-size blocks taken
+from one preallocated tensor per layer. Only real tokens are stored.
+
+Full prompt blocks are shared between sequences with an identical prefix, for
+example the same system prompt. A block is keyed by its parent block and its
+token ids, so a match is exact, and it is freed when the last sequence holding it
+is freed. Generated tokens always go to blocks owned by one sequence, so shared
+blocks are never written.
+
+Attention still needs contiguous K/V, so each decode step gathers the batch
+(left-padded) into a transient cache that the forward then extends by one token.
+During a step the pool therefore costs about one padded batch copy on top of
+its own preallocated memory, the same transient as the contiguous cache. It
+does not lower peak memory per sequence. What it changes is what stays resident
+between steps: only real tokens, in a fixed budget, with shared prefix blocks
+and no re-concatenation when sequences join or leave the batch.
+"""
+
+import math
+import threading
+from typing import Dict, List, Tuple, Union
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Per-layer (keys, values)
+KVLayers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+# Block 0 is never handed out; its zero slots fill left padding when gathering
+PAD_BLOCK = 0
+
+
+class KVPoolExhausted(Exception):
+    """Not enough free blocks for the requested allocation."""
+
+
+class BlockTable:
+    """The blocks holding one sequence's KV state, in position order."""
+
+    __slots__ = ("blocks", "num_tokens")
+
+    def __init__(self):
+        self.blocks: List[int] = []
+        self.num_tokens = 0
+
+
+class KVBlockPool:
+    """Fixed-size KV blocks allocated from a preallocated pool, with prefix sharing."""
+
+    def __init__(
+        self,
+        num_layers: int,
+        num_kv_heads: int,
+        head_dim: int,
+        num_blocks: int,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float32,
+        device: torch.device = torch.device("cpu")
+    ):
+        """
+        Args:
+            num_layers: Decoder layers (one key and one value pool each)
+            num_kv_heads: Key/value heads per layer
+            head_dim: Size of each head
+            num_blocks: Blocks in the pool, including the reserved padding block
+            block_size: Tokens per block
+            dtype: KV dtype (the model's compute dtype)
+            device: Device the pool is allocated on
+        """
+        if num_blocks < 2:
+            raise ValueError("KV block pool needs at least 2 blocks")
+        self.num_layers = num_layers
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.device = device
+        self._block_offsets = torch.arange(block_size, dtype=torch.long, device=device)
+
+        # Slot-major layout: [num_blocks * block_size, heads, head_dim] per layer
+        shape = (num_blocks * block_size, num_kv_heads, head_dim)
+        self._keys = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self._values = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+
+        self._lock = threading.Lock()
+        self._free: List[int] = list(range(num_blocks - 1, PAD_BLOCK, -1))
+        self._refcount = [0] * num_blocks
+        # (parent block, token ids) -> block, and the reverse for cleanup on free
+        self._shared: Dict[Tuple[int, Tuple[int, ...]], int] = {}
+        self._block_key: Dict[int, Tuple[int, Tuple[int, ...]]] = {}
+        self._stats = {
+            "sequences": 0,
+            "shared_block_hits": 0,
+            "peak_used_blocks": 0,
+        }
+
+    @staticmethod
+    def blocks_for_budget(
+        max_bytes: int,
+        num_layers: int,
+        num_kv_heads: int,
+        head_dim: int,
+        block_size: int,
+        dtype: torch.dtype
+    ) -> int:
+        """Number of blocks that fit in `max_bytes`."""
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        block_bytes = 2 * num_layers * block_size * num_kv_heads * head_dim * element_size
+        return max_bytes // block_bytes
+
+    @property
+    def free_blocks(self) -> int:
+        return len(self._free)
+
+    def blocks_for_tokens(self, num_tokens: int) -> int:
+        return math.ceil(num_tokens / self.block_size)
+
+    def can_allocate(self, num_tokens: int) -> bool:
+        """Whether a new sequence of `num_tokens` fits (ignoring possible prefix sharing)."""
+        return self.blocks_for_tokens(num_tokens) <= len(self._free)
+
+    def blocks_needed_for_step(self, tables: List[BlockTable]) -> int:
+        """New blocks needed to append one token to every sequence in `tables`."""
+        return sum(1 for table in tables if table.num_tokens % self.block_size == 0)
+
+    def add_sequence(self, token_ids: List[int], layers: KVLayers, shareable_len: int) -> BlockTable:
+        """Store a prefilled sequence.
+
+        Args:
+            token_ids: Token ids of the positions in `layers`
+            layers: Per-layer KV tensors shaped [1, heads, len(token_ids), head_dim]
+            shareable_len: Leading positions whose KV depends only on their token ids
+                (no image features); full blocks within it are shared
+
+        Raises:
+            KVPoolExhausted: If the sequence does not fit
+        """
+        num_tokens = len(token_ids)
+        with self._lock:
+            table = BlockTable()
+            parent = -1
+            write_from = 0
+            # Reuse identical full prefix blocks
+            for start in range(0, shareable_len - self.block_size + 1, self.block_size):
+                key = (parent, tuple(token_ids[start:start + self.block_size]))
+                block = self._shared.get(key)
+                if block is None:
+                    break
+                self._refcount[block] += 1
+                table.blocks.append(block)
+                parent = block
+                write_from = start + self.block_size
+                self._stats["shared_block_hits"] += 1
+
+            needed = self.blocks_for_tokens(num_tokens) - len(table.blocks)
+            if needed > len(self._free):
+                self._release(table)
+                raise KVPoolExhausted(f"Need {needed} KV blocks, {len(self._free)} free")
+            for start in range(write_from, num_tokens, self.block_size):
+                block = self._take()
+                table.blocks.append(block)
+                if start + self.block_size <= shareable_len:
+                    key = (parent, tuple(token_ids[start:start + self.block_size]))
+                    if key not in self._shared:
+                        self._shared[key] = block
+                        self._block_key[block] = key
+                parent = block
+            table.num_tokens = num_tokens
+            self._stats["sequences"] += 1
+
+        if write_from < num_tokens:
+            slots = self._slot_index(table, write_from, num_tokens)
+            self.write(slots, [(k[0, :, write_from:num_tokens], v[0, :, write_from:num_tokens]) for k, v in layers])
+        return table
+
+    def append_slot(self, table: BlockTable) -> int:
+        """Reserve the slot for the sequence's next token, taking a new block when needed.
+
+        Raises:
+            KVPoolExhausted: If a new block is needed and none is free
+        """
+        with self._lock:
+            if table.num_tokens % self.block_size == 0:
+                if not self._free:
+                    raise KVPoolExhausted("No free KV blocks")
+                table.blocks.append(self._take())
+            slot = table.blocks[-1] * self.block_size + table.num_tokens % self.block_size
+            table.num_tokens += 1
+            return slot
+
+    def write(self, slots: Union[List[int], torch.Tensor], layers: KVLayers):
+        """Write KV vectors for `slots`; each layer's tensors are [heads, len(slots), head_dim]."""
+        index = torch.as_tensor(slots, dtype=torch.long, device=self.device)
+        for pool_k, pool_v, (k, v) in zip(self._keys, self._values, layers):
+            pool_k.index_copy_(0, index, k.transpose(0, 1).to(pool_k.dtype))
+            pool_v.index_copy_(0, index, v.transpose(0, 1).to(pool_v.dtype))
+
+    def gather(self, tables: List[BlockTable]) -> Tuple[KVLayers, torch.Tensor]:
+        """Contiguous, left-padded KV for a batch of sequences.
+
+        Returns:
+            (layers shaped [batch, heads, max_len, head_dim], attention mask [batch, max_len])
+        """
+        max_len = max(table.num_tokens for table in tables)
+        batch = len(tables)
+        # Padding reads the zero slots of the reserved block
+        index = torch.full((batch, max_len), PAD_BLOCK * self.block_size, dtype=torch.long, device=self.device)
+        for row, table in enumerate(tables):
+            index[row, max_len - table.num_tokens:] = self._slot_index(table, 0, table.num_tokens)
+        padding = torch.tensor([max_len - table.num_tokens for table in tables], device=self.device)
+        mask = (torch.arange(max_len, device=self.device) >= padding.unsqueeze(1)).long()
+        index = index.flatten()
+
+        layers = []
+        for pool_k, pool_v in zip(self._keys, self._values):
+            # [batch * max_len, heads, dim] -> [batch, heads, max_len, dim]
+            k = pool_k.index_select(0, index).view(batch, max_len, *pool_k.shape[1:]).transpose(1, 2)
+            v = pool_v.index_select(0, index).view(batch, max_len, *pool_v.shape[1:]).transpose(1, 2)
+            layers.append((k, v))
+        return layers, mask
+
+    def free(self, table: BlockTable):
+        """Return a sequence's blocks (shared blocks stay until their last user is freed)."""
+        with self._lock:
+            self._release(table)
+
+    def _slot_index(self, table: BlockTable, start: int, end: int) -> torch.Tensor:
+        """Pool slots of the sequence's positions `start:end`."""
+        blocks = torch.tensor(table.blocks, dtype=torch.long, device=self.device)
+        return (blocks.unsqueeze(1) * self.block_size + self._block_offsets).flatten()[start:end]
+
+    def _take(self) -> int:
+        block = self._free.pop()
+        self._refcount[block] = 1
+        used = self.num_blocks - 1 - len(self._free)
+        self._stats["peak_used_blocks"] = max(self._stats["peak_used_blocks"], used)
+        return block
+
+    def _release(self, table: BlockTable):
+        for block in table.blocks:
+            self._refcount[block] -= 1
+            if self._refcount[block] == 0:
+                key = self._block_key.pop(block, None)
+                if key is not None:
+                    del self._shared[key]
+                self._free.append(block)
+        table.blocks = []
+        table.num_tokens = 0
+
+    def get_stats(self) -> Dict[str, float]:
+        """Return block usage, sharing and memory counters."""
+        with self._lock:
+            usable = self.num_blocks - 1
+            used = usable - len(self._free)
+            stats = dict(self._stats)
+            stats["block_size"] = self.block_size
+            stats["total_blocks"] = usable
+            stats["used_blocks"] = used
+            stats["shared_blocks"] = sum(1 for block in self._block_key if self._refcount[block] > 1)
+            stats["utilization"] = round(used / usable, 3)
+            nbytes = sum(t.numel() * t.element_size() for t in self._keys + self._values)
+            stats["memory_mb"] = round(nbytes / (1024 * 1024), 1)
+            return stats
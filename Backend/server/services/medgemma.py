@@ -7,15 +7,38 @@ for use in the FastAPI server.
 import torch
 from PIL import Image
 from pathlib import Path
-from typing import Optional, List, Dict, Any, AsyncIterator
-from transformers import AutoModelForImageTextToText, AutoProcessor
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, AsyncIterator, Deque, Tuple, Union
+from transformers import (
+    AutoModelForCausalLM,
+    AutoModelForImageTextToText,
+    AutoProcessor,
+    AutoTokenizer,
+    CompileConfig,
+    DynamicCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+from transformers.generation.streamers import BaseStreamer
 from server.config import settings
-from server.services.system_prompts import get_system_prompt, get_tool_usage_instructions
+from server.services.system_prompts import get_system_prompt, get_tool_usage_instructions, on_prompt_cache_clear
+from server.services.prefix_cache import PrefixKVCache
+from server.services.session_kv_store import SessionKVStore
+from server.services.vision_cache import VisionEmbeddingCache
+from server.services.history_window import HistoryWindow
+from server.services.response_cache import ResponseCache
+from server.services.semantic_cache import SemanticAnswerCache, TextEmbedder
+from server.services.stop_conditions import StopCondition, RepetitionDetector
+from server.services.kv_block_pool import KVBlockPool, BlockTable, KVPoolExhausted
+from server.services import model_snapshot
+from server.services.model_readiness import ModelReadiness, ModelState
+from server.services.preprocess_pool import PreprocessPool
 from server.api.schemas.request import ChatDomain, ChatMode
 import asyncio
-from queue import Queue
-from threading import Thread
+import threading
 import time
+import uuid
 import logging
 
 logger = logging.getLogger(__name__)
@@ -66,19 +89,1295 @@ Usage: tool_code{{"tool": "{name}", "args": {{"param_name": value, ...}}}}
     return "\n".join(tool_descriptions)
 
 
+class IncrementalDetokenizer:
+    """Turns a growing list of token ids into text deltas.
+
+    Decoding each token on its own breaks SentencePiece spacing and multi-byte
+    characters, and re-decoding the whole sequence every step is quadratic. This
+    keeps a small window (prefix_offset..read_offset) of already-emitted tokens as
+    context and only emits text once it no longer ends in a partial character.
+    """
+    
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+    
+    def _decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+    
+    def add(self, token_ids: List[int]) -> str:
+        """Add newly generated token ids and return any text that is now complete."""
+        self.token_ids.extend(token_ids)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        
+        # Hold back incomplete UTF-8 sequences until the next token completes them
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            delta = new_text[len(prefix_text):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return delta
+        return ""
+    
+    def flush(self) -> str:
+        """Return whatever text is still held back at the end of generation."""
+        if self.read_offset >= len(self.token_ids):
+            return ""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class AsyncTokenStreamer(BaseStreamer):
+    """Streamer fed from the generation thread, consumed from asyncio.
+    
+    `put`/`end` are called from the generation thread (following the
+    `model.generate` contract: prompt ids first, then each new token); text deltas are handed to
+    the event loop with `call_soon_threadsafe` so the API can forward them as SSE
+    events while decoding is still running.
+    """
+    
+    _END = object()
+    
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, skip_prompt: bool = True):
+        self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.skip_prompt = skip_prompt
+        self._next_tokens_are_prompt = True
+    
+    def _push(self, item: Any):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+    
+    def put(self, value):
+        """Receive new token ids from `generate` (the first call carries the prompt)."""
+        if self.skip_prompt and self._next_tokens_are_prompt:
+            self._next_tokens_are_prompt = False
+            return
+        
+        if isinstance(value, torch.Tensor):
+            token_ids = value.reshape(-1).tolist()
+        else:
+            token_ids = list(value)
+        
+        text = self.detokenizer.add(token_ids)
+        if text:
+            self._push(text)
+    
+    def end(self):
+        """Flush held-back text and signal the consumer that generation finished."""
+        text = self.detokenizer.flush()
+        if text:
+            self._push(text)
+        self._push(self._END)
+    
+    def error(self, exc: BaseException):
+        """Forward an exception raised in the generation thread to the consumer."""
+        self._push(exc)
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self) -> str:
+        item = await self.queue.get()
+        if item is self._END:
+            raise StopAsyncIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+
+def split_stream_text(text: str) -> List[str]:
+    """Split a text delta for SSE, with newlines as their own chunks to preserve formatting."""
+    pieces = []
+    for i, line in enumerate(text.split('\n')):
+        if i > 0:
+            pieces.append('\n')
+        if line:
+            pieces.append(line)
+    return pieces
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    """Left-pad `tensor` with zeros along `dim` up to `length`."""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = missing
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=dim)
+
+
+def _rebuild_cache(layers: List[Tuple[torch.Tensor, torch.Tensor]]) -> DynamicCache:
+    """Build a fresh DynamicCache from per-layer (keys, values) tensors.
+    
+    Scheduler caches use plain (non-sliding) layers so every layer has the same
+    sequence length and rows can be padded, merged and sliced uniformly. The
+    sliding-window limit is still enforced by the attention mask.
+    """
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        # `update` on an empty layer would copy the tensors; create the layer with an
+        # empty update and adopt them as they are (the forward never writes in place)
+        cache.update(keys[:, :, :0], values[:, :, :0], layer_idx)
+        layer = cache.layers[layer_idx]
+        layer.keys, layer.values = keys, values
+    return cache
+
+
+def _cache_layers(cache: DynamicCache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Return the per-layer (keys, values) tensors of a DynamicCache."""
+    return [(layer.keys, layer.values) for layer in cache.layers]
+
+
+class GenerationCancelled(Exception):
+    """Raised to the caller of a request that was cancelled before it finished."""
+
+
+@dataclass
+class GenerationResult:
+    """A finished reply with the reason decoding ended."""
+    text: str
+    token_ids: List[int]
+    # "eos", "length", "tool_call", "stop_sequence", "repetition" or "cache" (served from a cache)
+    stop_reason: Optional[str] = None
+
+
+@dataclass
+class _PrefillState:
+    """Progress of a prompt being prefilled, possibly over several chunks."""
+    # Full-length model inputs (input_ids or inputs_embeds, attention_mask, ...)
+    inputs: Dict[str, torch.Tensor]
+    token_ids: List[int]
+    cacheable_len: int
+    cached_len: int
+    pos: int
+    # Prompt positions a chunk boundary must not fall inside (image tokens attend bidirectionally)
+    image_span: Optional[Tuple[int, int]] = None
+    chunks: int = 0
+    started_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class GenerationRequest:
+    """A single sequence tracked by the generation scheduler."""
+    inputs: Dict[str, torch.Tensor]
+    max_new_tokens: int = DEFAULT_MAX_TOKENS
+    streamer: Optional[BaseStreamer] = None
+    session_id: Optional[str] = None
+    # Draft-free speculative decoding by n-gram lookup in the prompt
+    prompt_lookup: bool = False
+    # Text-based early stop (tool call emitted, stop sequence reached)
+    stop: Optional[StopCondition] = None
+    stop_detokenizer: Optional[IncrementalDetokenizer] = None
+    # Ends degenerate generations that keep repeating the same span
+    repetition: Optional[RepetitionDetector] = None
+    # Why decoding ended: "eos", "length", "tool_call", "stop_sequence" or "repetition"
+    stop_reason: Optional[str] = None
+    request_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    output_ids: List[int] = field(default_factory=list)
+    prompt_len: int = 0
+    # Generated tokens folded back into the prompt when a speculative run hands off to the batch
+    resumed_tokens: int = 0
+    finished: bool = False
+    # Set by `GenerationScheduler.cancel`; the request is dropped before its next decode step
+    cancelled: bool = False
+    error: Optional[BaseException] = None
+    submitted_at: float = field(default_factory=time.time)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Per-sequence KV cache from prefill, merged into the batch cache on the next step
+    cache: Optional[DynamicCache] = None
+    prefill_state: Optional[_PrefillState] = None
+    prompt_streamed: bool = False
+    # Blocks holding the sequence's KV state while it is in a paged decode batch
+    block_table: Optional[BlockTable] = None
+    _done: threading.Event = field(default_factory=threading.Event, repr=False)
+    
+    def wait(self) -> List[int]:
+        """Block until the sequence is finished and return the generated token ids."""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+
+class _RequestTokenStreamer(BaseStreamer):
+    """Routes tokens produced by `model.generate` through the scheduler's bookkeeping."""
+    
+    def __init__(self, scheduler: "GenerationScheduler", request: GenerationRequest):
+        self.scheduler = scheduler
+        self.request = request
+        self._next_tokens_are_prompt = True
+    
+    def put(self, value):
+        if self._next_tokens_are_prompt:
+            self._next_tokens_are_prompt = False
+            return
+        for token in value.reshape(-1).tolist():
+            if self.request.finished:
+                return
+            self.scheduler._append_token(self.request, token)
+    
+    def end(self):
+        # The scheduler finishes (or resumes) the request itself
+        pass
+
+
+class _YieldToBatchCriteria(StoppingCriteria):
+    """Stops a single-sequence `generate` run when it is done or other work is waiting."""
+    
+    def __init__(self, scheduler: "GenerationScheduler", request: GenerationRequest):
+        self.scheduler = scheduler
+        self.request = request
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        stop = (
+            self.request.finished
+            or self.request.cancelled
+            or bool(self.scheduler._pending)
+            or not self.scheduler._running
+        )
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+class _NewTokenBudgetCriteria(StoppingCriteria):
+    """Stops a `generate` run after a fixed number of new tokens, independent of `max_new_tokens`."""
+    
+    def __init__(self, prompt_len: int, num_tokens: int):
+        self.prompt_len = prompt_len
+        self.num_tokens = num_tokens
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        stop = input_ids.shape[1] - self.prompt_len >= self.num_tokens
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+
+class GenerationScheduler:
+    """Continuous-batching decode loop that owns the model.
+    
+    A single background thread runs every forward pass. New requests are
+    prefilled individually when admitted and join the running decode batch at
+    the next step; each step decodes one token for every active sequence, and
+    finished sequences are retired without stalling the others. Rows of the batch
+    KV cache are left-padded to a common length and masked out.
+    """
+    
+    def __init__(
+        self,
+        model,
+        eos_token_ids: List[int],
+        max_batch_size: int = 8,
+        prefix_cache: Optional[PrefixKVCache] = None,
+        session_store: Optional[SessionKVStore] = None,
+        vision_cache: Optional[VisionEmbeddingCache] = None,
+        draft_model=None,
+        tokenizer=None,
+        draft_tokenizer=None,
+        prompt_lookup_num_tokens: int = 10,
+        prompt_lookup_max_ngram: int = 3,
+        compiled_buckets: Optional[List[int]] = None,
+        compiled_max_new_tokens: int = DEFAULT_MAX_TOKENS,
+        prefill_chunk_tokens: int = 0,
+        kv_pool: Optional[KVBlockPool] = None
+    ):
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.session_store = session_store
+        self.vision_cache = vision_cache
+        
+        # Speculative decoding: a text-only request that would decode alone runs
+        # assisted greedy generation (draft model or prompt lookup) instead of batch steps
+        self.draft_model = draft_model
+        self.tokenizer = tokenizer
+        self.draft_tokenizer = draft_tokenizer
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self.prompt_lookup_max_ngram = prompt_lookup_max_ngram
+        self._forward_calls = {"target": 0, "draft": 0}
+        
+        # Compiled mode: a request that would decode alone (and is not speculating) runs
+        # `generate` with a static KV cache and a torch.compile'd decode step. The cache
+        # is sized once for the largest bucket, so the compiled graph is reused.
+        self.compiled_buckets = sorted(compiled_buckets or [], reverse=True)
+        self.compiled_max_new_tokens = compiled_max_new_tokens
+        self.compile_config = None
+        
+        # Chunked prefill: prompts longer than this are prefilled one chunk per
+        # scheduler iteration, interleaved with decode steps of the running batch
+        self.prefill_chunk_tokens = prefill_chunk_tokens
+        self._prefilling: Deque[GenerationRequest] = deque()
+        
+        self._pending: Deque[GenerationRequest] = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        
+        # Paged KV: active sequences keep their KV in pool blocks instead of one
+        # padded batch cache, and the batch is gathered from the pool each step
+        self.kv_pool = kv_pool
+        
+        # Request popped from the queue and not yet in the batch
+        self._admitting: Optional[GenerationRequest] = None
+        
+        # Running decode batch
+        self._active: List[GenerationRequest] = []
+        self._batch_cache: Optional[DynamicCache] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        
+        # Counters
+        self._stats = {
+            "requests_completed": 0,
+            "requests_failed": 0,
+            "requests_cancelled": 0,
+            "stopped_tool_call": 0,
+            "stopped_stop_sequence": 0,
+            "stopped_repetition": 0,
+            "repetition_tokens_saved": 0,
+            "tokens_generated": 0,
+            "decode_steps": 0,
+            "decode_time_s": 0.0,
+            "prefill_tokens": 0,
+            "prefill_time_s": 0.0,
+            "chunked_prefills": 0,
+            "prefill_chunks": 0,
+            "kv_preemptions": 0,
+        }
+        self._single_stats = {
+            method: {
+                "runs": 0,
+                "handoffs": 0,
+                "tokens": 0,
+                "target_forwards": 0,
+                "draft_tokens": 0,
+                "accepted_tokens": 0,
+                "time_s": 0.0,
+            }
+            for method in ("draft_model", "prompt_lookup", "static")
+        }
+        self._warmup_stats: Dict[int, Dict[str, float]] = {}
+        
+        self._init_model(model)
+    
+    def _init_model(self, model):
+        """Attach the torch model: forward counters, compile config and image token id.
+        
+        Everything else in `__init__` is model-independent, so a scheduler for
+        another runtime overrides only this.
+        """
+        self.model = model
+        model.register_forward_hook(lambda *args: self._count_forward("target"))
+        if self.draft_model is not None:
+            self.draft_model.register_forward_hook(lambda *args: self._count_forward("draft"))
+        
+        if self.compiled_buckets:
+            self.compile_config = CompileConfig(
+                fullgraph=False,
+                mode="reduce-overhead" if model.device.type == "cuda" else "default"
+            )
+            # transformers only auto-compiles on accelerators unless this is set
+            self.compile_config._compile_all_devices = True
+        
+        # Prompt positions from the first image token on are never served from the
+        # prefix cache: the image features must be fed together with their tokens
+        self.image_token_id = getattr(model.config, "image_token_id", None)
+        if self.image_token_id is None:
+            self.image_token_id = getattr(model.config, "image_token_index", None)
+    
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+    
+    def start(self):
+        """Start the scheduler thread."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="medgemma-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"[SCHEDULER] Started (max_batch_size={self.max_batch_size})")
+    
+    def stop(self):
+        """Stop the scheduler thread and fail any request still in flight."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        
+        shutdown_error = RuntimeError("Generation scheduler stopped")
+        for request in list(self._pending) + list(self._prefilling) + self._active:
+            self._finish(request, error=shutdown_error)
+        self._pending.clear()
+        self._prefilling.clear()
+        self._reset_batch()
+    
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """Queue a request for admission into the decode batch."""
+        request.prompt_len = request.inputs["input_ids"].shape[1]
+        if request.stop is not None and request.stop_detokenizer is None:
+            request.stop_detokenizer = IncrementalDetokenizer(self.tokenizer)
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("Generation scheduler is not running")
+            self._pending.append(request)
+            self._cond.notify()
+        return request
+    
+    def cancel(self, request: GenerationRequest):
+        """Stop a request at its next decode step (or before prefill, if still queued)."""
+        with self._cond:
+            request.cancelled = True
+            self._cond.notify()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Return scheduler counters and current queue/batch sizes."""
+        stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        stats["prefilling"] = len(self._prefilling)
+        stats["active"] = len(self._active)
+        stats["prefill_chunk_tokens"] = self.prefill_chunk_tokens
+        if self.kv_pool is not None:
+            stats["kv_pool"] = self.kv_pool.get_stats()
+        stats["max_batch_size"] = self.max_batch_size
+        if stats["decode_time_s"] > 0:
+            stats["decode_tokens_per_s"] = round(stats["tokens_generated"] / stats["decode_time_s"], 2)
+        if stats["decode_steps"] > 0:
+            stats["avg_batch_size"] = round(stats["tokens_generated"] / stats["decode_steps"], 2)
+        stats["speculative"] = {}
+        for method, counters in self._single_stats.items():
+            if not counters["runs"] or method == "static":
+                continue
+            speculative = dict(counters)
+            if speculative["draft_tokens"]:
+                speculative["acceptance_rate"] = round(speculative["accepted_tokens"] / speculative["draft_tokens"], 3)
+            if speculative["time_s"] > 0:
+                speculative["tokens_per_s"] = round(speculative["tokens"] / speculative["time_s"], 2)
+            if speculative["target_forwards"]:
+                speculative["tokens_per_forward"] = round(speculative["tokens"] / speculative["target_forwards"], 2)
+            stats["speculative"][method] = speculative
+        if self.compiled_buckets:
+            compiled = {
+                key: self._single_stats["static"][key]
+                for key in ("runs", "handoffs", "tokens", "time_s")
+            }
+            if compiled["time_s"] > 0:
+                compiled["tokens_per_s"] = round(compiled["tokens"] / compiled["time_s"], 2)
+            compiled["buckets"] = list(self.compiled_buckets)
+            compiled["warmup"] = dict(self._warmup_stats)
+            stats["compiled"] = compiled
+        return stats
+    
+    def warmup(self, num_tokens: int = 16):
+        """Compile the static-cache decode step and warm up every prompt-length bucket.
+        
+        Runs on the calling thread before `start()`. The largest bucket goes first so
+        the static cache is allocated at its final size; each bucket is then run once
+        more to measure steady per-token latency.
+        """
+        if not self.compiled_buckets:
+            return
+        
+        filler = self.tokenizer("Patient reports intermittent chest pain. ", add_special_tokens=False)["input_ids"]
+        t_start = time.time()
+        
+        for bucket in self.compiled_buckets:
+            token_ids = (filler * (bucket // len(filler) + 1))[:bucket]
+            input_ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+            
+            def run(tokens: int) -> float:
+                t0 = time.time()
+                with torch.no_grad():
+                    self.model.generate(
+                        input_ids=input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        do_sample=False,
+                        min_new_tokens=tokens,
+                        max_new_tokens=self.compiled_max_new_tokens,
+                        stopping_criteria=StoppingCriteriaList([_NewTokenBudgetCriteria(bucket, tokens)]),
+                        cache_implementation="static",
+                        compile_config=self.compile_config
+                    )
+                return time.time() - t0
+            
+            first_run_s = run(num_tokens)
+            prefill_s = run(1)
+            steady_s = run(num_tokens)
+            per_token_ms = (steady_s - prefill_s) / max(num_tokens - 1, 1) * 1000
+            self._warmup_stats[bucket] = {
+                "first_run_s": round(first_run_s, 2),
+                "prefill_s": round(prefill_s, 3),
+                "per_token_ms": round(per_token_ms, 1),
+            }
+            logger.info(
+                f"[SCHEDULER] Warmup bucket {bucket}: first run {first_run_s:.2f}s, "
+                f"prefill {prefill_s:.2f}s, {per_token_ms:.1f} ms/token"
+            )
+        
+        logger.info(
+            f"[SCHEDULER] Compiled mode ready in {time.time()-t_start:.2f}s "
+            f"(buckets={self.compiled_buckets}, max_new_tokens={self.compiled_max_new_tokens})"
+        )
+    
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending and not self._prefilling and not self._active:
+                    if not self._cond.wait(timeout=30) and self.session_store is not None:
+                        try:
+                            self.session_store.spill_idle()
+                        except Exception as e:
+                            logger.error(f"[SCHEDULER] Spilling idle session KV failed: {e}", exc_info=True)
+                if not self._running:
+                    return
+            
+            try:
+                self._admit()
+                if self._active:
+                    self._decode_step()
+            except Exception as e:
+                # Never let the thread die: callers would wait on their requests forever
+                self._fail_in_flight(e)
+    
+    def _fail_in_flight(self, error: BaseException):
+        """Fail every sequence the scheduler was working on and start over with an empty batch."""
+        requests = list(self._prefilling) + self._active
+        if self._admitting is not None:
+            requests.append(self._admitting)
+        logger.error(
+            f"[SCHEDULER] Scheduler iteration failed, failing {len(requests)} in-flight requests: {error}",
+            exc_info=error
+        )
+        for request in requests:
+            self._finish(request, error=error)
+        self._admitting = None
+        self._prefilling.clear()
+        try:
+            self._reset_batch()
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Resetting the batch failed: {e}", exc_info=True)
+            self._active = []
+            self._batch_cache = None
+            self._attention_mask = None
+    
+    def _admit(self):
+        """Prefill pending requests while there is room in the batch.
+        
+        Each call first runs one chunk of the oldest chunked prefill. Long prompts
+        are only set up here and then advance one chunk per scheduler iteration, so
+        the running batch keeps decoding and short prompts are still admitted.
+        """
+        if self._prefilling:
+            self._advance_chunked_prefill()
+        
+        while len(self._active) + len(self._prefilling) < self.max_batch_size:
+            self._admitting = None
+            with self._cond:
+                if not self._pending:
+                    return
+                request = self._pending.popleft()
+            # Failed along with the batch if anything below raises
+            self._admitting = request
+            
+            if self._finish_if_cancelled(request):
+                continue
+            if self.kv_pool is not None and not self._fits_kv_pool(request):
+                if self._active or self._prefilling:
+                    # Wait for running sequences to free blocks
+                    self._admitting = None
+                    with self._cond:
+                        self._pending.appendleft(request)
+                    return
+                self._finish(request, error=KVPoolExhausted(
+                    f"Prompt of {request.prompt_len} tokens does not fit in the KV block pool"
+                ))
+                continue
+            try:
+                if self._needs_chunked_prefill(request):
+                    self._start_chunked_prefill(request)
+                    continue
+                method = self._single_sequence_method(request)
+                if method is not None:
+                    self._run_single_sequence(request, method)
+                    if request.finished or self._finish_if_cancelled(request):
+                        continue
+                    self._prepare_resume(request, method)
+                    if self._needs_chunked_prefill(request):
+                        self._start_chunked_prefill(request)
+                        continue
+                self._prefill(request)
+            except Exception as e:
+                logger.error(f"[SCHEDULER] Prefill failed for {request.request_id}: {e}", exc_info=True)
+                self._finish(request, error=e)
+                continue
+            
+            if request.finished:
+                continue
+            self._merge_into_batch(request)
+        self._admitting = None
+    
+    def _fits_kv_pool(self, request: GenerationRequest) -> bool:
+        """Whether the request's prompt fits next to the prompts still being prefilled."""
+        reserved = sum(self.kv_pool.blocks_for_tokens(r.prompt_len + 1) for r in self._prefilling)
+        return self.kv_pool.blocks_for_tokens(request.prompt_len + 1) + reserved <= self.kv_pool.free_blocks
+    
+    def _needs_chunked_prefill(self, request: GenerationRequest) -> bool:
+        if not self.prefill_chunk_tokens or request.prompt_len <= self.prefill_chunk_tokens:
+            return False
+        # A compiled static-cache run prefills inside `generate`; keep it for prompts it covers
+        return self._single_sequence_method(request) != "static"
+    
+    def _start_chunked_prefill(self, request: GenerationRequest):
+        self._begin_prefill(request)
+        self._prefilling.append(request)
+        self._stats["chunked_prefills"] += 1
+    
+    def _advance_chunked_prefill(self):
+        """Run the next prefill chunk of the oldest chunked request.
+        
+        A request that may speculate stops one token short of its prompt. If it is
+        alone by then, its single-sequence run continues from the chunked cache;
+        otherwise the last token is prefilled and it joins the decode batch.
+        """
+        request = self._prefilling[0]
+        if self._finish_if_cancelled(request):
+            self._prefilling.popleft()
+            return
+        
+        state = request.prefill_state
+        speculative = self._speculative_method(request)
+        stop_at = request.prompt_len - 1 if speculative is not None else request.prompt_len
+        try:
+            if state.pos < stop_at:
+                end = self._chunk_end(state, min(state.pos + self.prefill_chunk_tokens, stop_at))
+                next_token = self._prefill_chunk(request, end)
+                state.chunks += 1
+                self._stats["prefill_chunks"] += 1
+                if end < stop_at:
+                    return
+            if state.pos < request.prompt_len:
+                # Only the last prompt token is left
+                if not self._active and not self._pending and len(self._prefilling) == 1:
+                    self._prefilling.popleft()
+                    self._finish_prefill(request, None)
+                    self._run_single_sequence(request, speculative)
+                    if request.finished or self._finish_if_cancelled(request):
+                        return
+                    self._prepare_resume(request, speculative)
+                    self._begin_prefill(request)
+                    self._prefilling.appendleft(request)
+                    return
+                # Others arrived meanwhile: finish the prompt and join the batch
+                next_token = self._prefill_chunk(request, request.prompt_len)
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Chunked prefill failed for {request.request_id}: {e}", exc_info=True)
+            if request in self._prefilling:
+                self._prefilling.remove(request)
+            self._finish(request, error=e)
+            return
+        
+        self._prefilling.popleft()
+        self._finish_prefill(request, next_token)
+        if not request.finished:
+            self._merge_into_batch(request)
+    
+    def _chunk_end(self, state: _PrefillState, end: int) -> int:
+        """Move a chunk boundary past the image tokens if it would split them."""
+        if state.image_span is not None:
+            start, stop = state.image_span
+            if start < end < stop:
+                return stop
+        return end
+    
+    def _finish_if_cancelled(self, request: GenerationRequest) -> bool:
+        if request.cancelled and not request.finished:
+            self._finish(request, error=GenerationCancelled(f"Request {request.request_id} was cancelled"))
+        return request.cancelled
+    
+    def _count_forward(self, which: str):
+        self._forward_calls[which] += 1
+    
+    def _single_sequence_method(self, request: GenerationRequest) -> Optional[str]:
+        """Pick a single-sequence `generate` path for a request that would otherwise decode alone."""
+        if self._active or self._pending or self._prefilling or request.resumed_tokens:
+            return None
+        if "image_features" in request.inputs:
+            return None
+        
+        speculative = self._speculative_method(request)
+        if speculative is not None:
+            return speculative
+        if (
+            self.compiled_buckets
+            and request.prompt_len <= self.compiled_buckets[0]
+            and request.max_new_tokens <= self.compiled_max_new_tokens
+        ):
+            return "static"
+        return None
+    
+    def _speculative_method(self, request: GenerationRequest) -> Optional[str]:
+        """Speculative method a text-only request may use when it decodes alone."""
+        if request.resumed_tokens or "pixel_values" in request.inputs or "image_features" in request.inputs:
+            return None
+        if request.prompt_lookup:
+            return "prompt_lookup"
+        if self.draft_model is not None:
+            return "draft_model"
+        return None
+    
+    def _run_single_sequence(self, request: GenerationRequest, method: str):
+        """Greedy `generate` run for a single request.
+        
+        Speculative methods draft candidates from n-gram matches against the prompt
+        (prompt lookup) or from the draft model; verification by the target model
+        keeps the output identical to plain greedy decoding. The static method uses
+        a preallocated KV cache and the compiled decode step. Either way the run
+        stops early as soon as another request is waiting, so the sequence can
+        continue in the shared decode batch. After a chunked prefill, `request.cache`
+        holds every prompt token but the last, and `generate` continues from it.
+        """
+        t0 = time.time()
+        target_calls = self._forward_calls["target"]
+        draft_calls = self._forward_calls["draft"]
+        tokens_before = len(request.output_ids)
+        
+        if request.streamer is not None and not request.prompt_streamed:
+            request.streamer.put(request.inputs["input_ids"].cpu())
+            request.prompt_streamed = True
+        
+        if method == "prompt_lookup":
+            generate_kwargs = {
+                "prompt_lookup_num_tokens": self.prompt_lookup_num_tokens,
+                "max_matching_ngram_size": self.prompt_lookup_max_ngram,
+            }
+        elif method == "draft_model":
+            generate_kwargs = {"assistant_model": self.draft_model}
+            if self.draft_tokenizer is not None:
+                # Different vocabularies: transformers re-tokenizes drafts between the models
+                generate_kwargs.update(tokenizer=self.tokenizer, assistant_tokenizer=self.draft_tokenizer)
+        else:
+            generate_kwargs = {"cache_implementation": "static", "compile_config": self.compile_config}
+            for key in ("token_type_ids", "pixel_values"):
+                if key in request.inputs:
+                    generate_kwargs[key] = request.inputs[key]
+        if request.cache is not None:
+            generate_kwargs["past_key_values"] = request.cache
+            request.cache = None
+        
+        with torch.no_grad():
+            self.model.generate(
+                input_ids=request.inputs["input_ids"],
+                attention_mask=request.inputs["attention_mask"],
+                do_sample=False,
+                max_new_tokens=request.max_new_tokens,
+                streamer=_RequestTokenStreamer(self, request),
+                stopping_criteria=StoppingCriteriaList([_YieldToBatchCriteria(self, request)]),
+                **generate_kwargs
+            )
+        
+        tokens = len(request.output_ids) - tokens_before
+        target_forwards = self._forward_calls["target"] - target_calls
+        draft_tokens = self._forward_calls["draft"] - draft_calls
+        stats = self._single_stats[method]
+        stats["runs"] += 1
+        stats["tokens"] += tokens
+        stats["target_forwards"] += target_forwards
+        stats["draft_tokens"] += draft_tokens
+        # Each verification pass yields one token of its own plus the accepted drafts
+        stats["accepted_tokens"] += max(tokens - target_forwards, 0)
+        stats["time_s"] += time.time() - t0
+        logger.info(
+            f"[SCHEDULER] Single-sequence run ({method}) for {request.request_id}: {tokens} tokens in "
+            f"{target_forwards} target forwards, {time.time()-t0:.2f}s"
+        )
+    
+    def _prepare_resume(self, request: GenerationRequest, method: Optional[str] = None):
+        """Fold tokens generated so far into the prompt so the batch path can continue."""
+        if len(request.output_ids) == request.resumed_tokens:
+            return
+        if method is not None:
+            self._single_stats[method]["handoffs"] += 1
+        generated = torch.tensor([request.output_ids[request.resumed_tokens:]], dtype=torch.long, device=self.device)
+        input_ids = torch.cat([request.inputs["input_ids"], generated], dim=1)
+        inputs = {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+        }
+        if "token_type_ids" in request.inputs:
+            inputs["token_type_ids"] = torch.cat([request.inputs["token_type_ids"], torch.zeros_like(generated)], dim=1)
+        for key in ("pixel_values", "image_features", "image_hash"):
+            if key in request.inputs:
+                inputs[key] = request.inputs[key]
+        request.inputs = inputs
+        request.prompt_len = input_ids.shape[1]
+        request.resumed_tokens = len(request.output_ids)
+    
+    def _cacheable_prefix_length(self, token_ids: List[int]) -> int:
+        """Number of leading prompt tokens whose KV state may come from the prefix cache."""
+        limit = len(token_ids) - 1  # always prefill at least one token to get logits
+        if self.image_token_id is not None and self.image_token_id in token_ids:
+            limit = min(limit, token_ids.index(self.image_token_id))
+        return max(limit, 0)
+    
+    def _prefill(self, request: GenerationRequest):
+        """Run the whole prompt through the model in one pass and sample the first token."""
+        self._begin_prefill(request)
+        next_token = self._prefill_chunk(request, request.prompt_len)
+        self._finish_prefill(request, next_token)
+    
+    def _begin_prefill(self, request: GenerationRequest):
+        """Set up a prefill, starting after the longest reusable cached prefix.
+        
+        The session's previous end-of-turn KV state is tried first (it usually
+        covers the whole conversation so far), then the shared prefix cache. Image
+        features are computed here, so chunks only ever see input embeddings.
+        """
+        if request.streamer is not None and not request.prompt_streamed:
+            # Mirror generate()'s streamer contract: prompt first, then new tokens
+            request.streamer.put(request.inputs["input_ids"].cpu())
+            request.prompt_streamed = True
+        
+        model_inputs = dict(request.inputs)
+        image_hash = model_inputs.pop("image_hash", None)
+        image_features = model_inputs.pop("image_features", None)
+        cache = DynamicCache()
+        cached_len = 0
+        
+        token_ids = request.inputs["input_ids"][0].tolist()
+        cacheable_len = self._cacheable_prefix_length(token_ids)
+        layers = None
+        if self.session_store is not None and request.session_id is not None:
+            cached_len, layers = self.session_store.match(request.session_id, token_ids[:cacheable_len])
+        if layers is None and self.prefix_cache is not None:
+            cached_len, layers = self.prefix_cache.match(token_ids[:cacheable_len])
+        if layers is not None:
+            cache = _rebuild_cache(layers)
+        
+        image_span = None
+        if self.image_token_id is not None and self.image_token_id in token_ids:
+            last = len(token_ids) - token_ids[::-1].index(self.image_token_id)
+            image_span = (token_ids.index(self.image_token_id), last)
+        
+        chunked = self._needs_chunked_prefill(request)
+        if image_features is None and "pixel_values" in model_inputs and (
+            chunked or (image_hash is not None and self.vision_cache is not None)
+        ):
+            # Encode once and remember the embeddings for follow-up questions
+            image_features = self._encode_image(model_inputs["pixel_values"])
+            if image_hash is not None and self.vision_cache is not None:
+                self.vision_cache.put_features(image_hash, image_features)
+        if image_features is not None:
+            model_inputs.pop("pixel_values", None)
+            model_inputs["inputs_embeds"] = self._embed_with_image(model_inputs.pop("input_ids"), image_features)
+        
+        request.cache = cache
+        request.prefill_state = _PrefillState(
+            inputs=model_inputs,
+            token_ids=token_ids,
+            cacheable_len=cacheable_len,
+            cached_len=cached_len,
+            pos=cached_len,
+            image_span=image_span
+        )
+    
+    def _prefill_chunk(self, request: GenerationRequest, end: int) -> int:
+        """Run prompt positions [pos, end) through the model; returns the greedy next token."""
+        t0 = time.time()
+        state = request.prefill_state
+        chunk = {}
+        for key, value in state.inputs.items():
+            if key in ("input_ids", "inputs_embeds"):
+                chunk[key] = value[:, state.pos:end]
+            elif key in ("attention_mask", "token_type_ids"):
+                # Indexed by absolute position: cover the cached part and this chunk
+                chunk[key] = value[:, :end]
+            else:
+                chunk[key] = value
+        if state.pos > 0:
+            chunk["cache_position"] = torch.arange(state.pos, end, dtype=torch.long, device=self.device)
+        
+        with torch.no_grad():
+            outputs = self.model(
+                **chunk,
+                past_key_values=request.cache,
+                use_cache=True,
+                logits_to_keep=1,
+            )
+        request.cache = outputs.past_key_values
+        
+        self._stats["prefill_tokens"] += end - state.pos
+        self._stats["prefill_time_s"] += time.time() - t0
+        state.pos = end
+        return int(outputs.logits[0, -1].argmax(-1))
+    
+    def _finish_prefill(self, request: GenerationRequest, next_token: Optional[int]):
+        """Share the prompt prefix with the prefix cache and record the first token, if sampled."""
+        state = request.prefill_state
+        request.prefill_state = None
+        if self.prefix_cache is not None and state.cacheable_len > state.cached_len:
+            self.prefix_cache.insert(state.token_ids[:state.cacheable_len], _cache_layers(request.cache))
+        
+        chunks = f" in {state.chunks} chunks" if state.chunks else ""
+        logger.info(
+            f"[SCHEDULER] Prefilled {request.request_id} ({state.pos - state.cached_len} tokens{chunks}, "
+            f"{state.cached_len} reused from cache): {time.time()-state.started_at:.2f}s"
+        )
+        if next_token is not None:
+            self._append_token(request, next_token)
+    
+    def _encode_image(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Run the vision tower and projector, returning [num_images, tokens, hidden]."""
+        with torch.no_grad():
+            features = self.model.get_image_features(pixel_values=pixel_values)
+        if not isinstance(features, torch.Tensor):
+            features = getattr(features, "pooler_output", features)
+        if isinstance(features, (list, tuple)):
+            features = torch.stack(list(features))
+        return features
+    
+    def _embed_with_image(self, input_ids: torch.Tensor, image_features: torch.Tensor) -> torch.Tensor:
+        """Text embeddings with precomputed image features scattered into the image-token slots."""
+        image_mask = input_ids == self.image_token_id
+        with torch.no_grad():
+            embeds = self.model.get_input_embeddings()(input_ids.masked_fill(image_mask, 0))
+        image_mask = image_mask.unsqueeze(-1).expand_as(embeds)
+        return embeds.masked_scatter(image_mask, image_features.to(embeds.device, embeds.dtype))
+    
+    def _merge_into_batch(self, request: GenerationRequest):
+        """Add a prefilled sequence to the running batch, left-padding rows to a common length."""
+        if self.kv_pool is not None:
+            self._merge_into_pool(request)
+            return
+        
+        request_mask = torch.ones((1, request.prompt_len), dtype=torch.long, device=self.device)
+        
+        if self._batch_cache is None:
+            self._batch_cache = request.cache
+            self._attention_mask = request_mask
+        else:
+            target_len = max(self._attention_mask.shape[1], request_mask.shape[1])
+            layers = []
+            for (batch_k, batch_v), (req_k, req_v) in zip(
+                _cache_layers(self._batch_cache), _cache_layers(request.cache)
+            ):
+                layers.append((
+                    torch.cat([_left_pad(batch_k, target_len, 2), _left_pad(req_k, target_len, 2)], dim=0),
+                    torch.cat([_left_pad(batch_v, target_len, 2), _left_pad(req_v, target_len, 2)], dim=0),
+                ))
+            self._batch_cache = _rebuild_cache(layers)
+            self._attention_mask = torch.cat([
+                _left_pad(self._attention_mask, target_len, 1),
+                _left_pad(request_mask, target_len, 1),
+            ], dim=0)
+        
+        request.cache = None
+        self._active.append(request)
+    
+    def _merge_into_pool(self, request: GenerationRequest):
+        """Move a prefilled sequence's KV into pool blocks, sharing identical prompt-prefix blocks."""
+        token_ids = request.inputs["input_ids"][0].tolist()
+        try:
+            request.block_table = self.kv_pool.add_sequence(
+                token_ids, _cache_layers(request.cache), self._cacheable_prefix_length(token_ids)
+            )
+        except KVPoolExhausted:
+            # Running sequences grew since admission: prefill again once blocks are free
+            request.cache = None
+            self._requeue(request)
+            return
+        request.cache = None
+        self._active.append(request)
+    
+    def _preempt_for_kv_blocks(self):
+        """Requeue the newest sequences until every active sequence can take its next token."""
+        tables = [r.block_table for r in self._active]
+        while self._active and self.kv_pool.blocks_needed_for_step(tables) > self.kv_pool.free_blocks:
+            request = self._active.pop()
+            tables.pop()
+            self._release_blocks(request)
+            self._stats["kv_preemptions"] += 1
+            logger.info(f"[SCHEDULER] KV pool full, preempted {request.request_id} ({len(request.output_ids)} tokens so far)")
+            self._requeue(request)
+    
+    def _requeue(self, request: GenerationRequest):
+        """Put a request back at the front of the queue; it re-prefills prompt + output so far."""
+        self._prepare_resume(request)
+        with self._cond:
+            self._pending.appendleft(request)
+    
+    def _release_blocks(self, request: GenerationRequest):
+        if request.block_table is not None:
+            self.kv_pool.free(request.block_table)
+            request.block_table = None
+    
+    def _decode_step(self):
+        """Decode one token for every active sequence."""
+        # Cancelled sequences leave the batch before spending another forward pass on them
+        cancelled = [r for r in self._active if self._finish_if_cancelled(r)]
+        if cancelled:
+            logger.info(f"[SCHEDULER] Dropped {len(cancelled)} cancelled request(s)")
+            self._retire_finished()
+            if not self._active:
+                return
+        
+        t0 = time.time()
+        if self.kv_pool is not None:
+            self._preempt_for_kv_blocks()
+            if not self._active:
+                return
+        batch = self._active
+        
+        input_ids = torch.tensor([[r.output_ids[-1]] for r in batch], dtype=torch.long, device=self.device)
+        # Position of the token being fed = number of real tokens already in the cache
+        position_ids = torch.tensor(
+            [[r.prompt_len + len(r.output_ids) - r.resumed_tokens - 1] for r in batch],
+            dtype=torch.long,
+            device=self.device
+        )
+        if self.kv_pool is not None:
+            layers, past_mask = self.kv_pool.gather([r.block_table for r in batch])
+            past_key_values = _rebuild_cache(layers)
+            # The cache is the only reference, so each layer's gathered copy is freed
+            # as soon as the forward has extended it
+            del layers
+            slots = [self.kv_pool.append_slot(r.block_table) for r in batch]
+        else:
+            past_key_values = self._batch_cache
+            past_mask = self._attention_mask
+        past_len = past_mask.shape[1]
+        attention_mask = torch.cat([
+            past_mask,
+            torch.ones((len(batch), 1), dtype=torch.long, device=self.device),
+        ], dim=1)
+        
+        try:
+            with torch.no_grad():
+                outputs = self.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    cache_position=torch.tensor([past_len], dtype=torch.long, device=self.device),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    logits_to_keep=1,
+                )
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Decode step failed, failing {len(batch)} requests: {e}", exc_info=True)
+            for request in batch:
+                self._finish(request, error=e)
+            self._reset_batch()
+            return
+        
+        if self.kv_pool is not None:
+            # Only the new token's K/V goes back to the pool; the gathered cache is dropped
+            self.kv_pool.write(slots, [
+                (k[:, :, -1].transpose(0, 1), v[:, :, -1].transpose(0, 1))
+                for k, v in _cache_layers(outputs.past_key_values)
+            ])
+        else:
+            self._batch_cache = outputs.past_key_values
+            self._attention_mask = attention_mask
+        next_tokens = outputs.logits[:, -1].argmax(-1).tolist()
+        
+        for request, token in zip(batch, next_tokens):
+            try:
+                self._append_token(request, token)
+            except Exception as e:
+                # A failing streamer or stop condition only ends its own request
+                logger.error(f"[SCHEDULER] Handling a token failed for {request.request_id}: {e}", exc_info=True)
+                self._finish(request, error=e)
+        
+        self._stats["decode_steps"] += 1
+        self._stats["decode_time_s"] += time.time() - t0
+        self._retire_finished()
+    
+    def _append_token(self, request: GenerationRequest, token: int):
+        """Record a newly decoded token and check the stopping conditions."""
+        request.output_ids.append(token)
+        self._stats["tokens_generated"] += 1
+        if request.first_token_at is None:
+            request.first_token_at = time.time()
+        
+        if request.streamer is not None and token not in self.eos_token_ids:
+            request.streamer.put(torch.tensor([token]))
+        
+        stop_reason = None
+        if token in self.eos_token_ids:
+            stop_reason = "eos"
+        elif request.stop is not None:
+            stop_reason = request.stop.feed(request.stop_detokenizer.add([token]))
+            if stop_reason is not None:
+                self._stats[f"stopped_{stop_reason}"] += 1
+        if stop_reason is None and request.repetition is not None and request.repetition.add(token):
+            stop_reason = "repetition"
+            self._stats["stopped_repetition"] += 1
+            self._stats["repetition_tokens_saved"] += request.max_new_tokens - len(request.output_ids)
+            logger.warning(
+                f"[SCHEDULER] Repetition loop in {request.request_id} after {len(request.output_ids)} tokens: "
+                f"{self.tokenizer.decode(list(request.repetition.repeated))!r}"
+            )
+        if stop_reason is None and len(request.output_ids) >= request.max_new_tokens:
+            stop_reason = "length"
+        if stop_reason is not None:
+            request.stop_reason = stop_reason
+            self._finish(request)
+    
+    def _retire_finished(self):
+        """Drop finished sequences from the batch cache and trim shared left padding."""
+        keep = [i for i, r in enumerate(self._active) if not r.finished]
+        if len(keep) == len(self._active):
+            return
+        
+        if self.session_store is not None:
+            for row, request in enumerate(self._active):
+                if request.finished and request.error is None and request.session_id is not None:
+                    self._store_session_kv(row, request)
+        
+        if self.kv_pool is not None:
+            for request in self._active:
+                if request.finished:
+                    self._release_blocks(request)
+            self._active = [self._active[i] for i in keep]
+            return
+        
+        self._active = [self._active[i] for i in keep]
+        if not self._active:
+            self._reset_batch()
+            return
+        
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        mask = self._attention_mask.index_select(0, index)
+        # Columns that are padding for every remaining row can be dropped
+        first_real = int((mask.sum(dim=0) > 0).nonzero()[0])
+        
+        self._batch_cache = _rebuild_cache([
+            (k.index_select(0, index)[:, :, first_real:], v.index_select(0, index)[:, :, first_real:])
+            for k, v in _cache_layers(self._batch_cache)
+        ])
+        self._attention_mask = mask[:, first_real:]
+    
+    def _store_session_kv(self, row: int, request: GenerationRequest):
+        """Hand one finished row's KV state (without padding) to the session store."""
+        if self.kv_pool is not None:
+            layers, _ = self.kv_pool.gather([request.block_table])
+            layers = [(k.contiguous(), v.contiguous()) for k, v in layers]
+        else:
+            padding = int((self._attention_mask[row] == 0).sum())
+            layers = [
+                (k[row:row + 1, :, padding:].clone(), v[row:row + 1, :, padding:].clone())
+                for k, v in _cache_layers(self._batch_cache)
+            ]
+        # The last sampled token was never fed back, so the cache stops before it
+        token_ids = request.inputs["input_ids"][0].tolist() + request.output_ids[request.resumed_tokens:-1]
+        self.session_store.put(request.session_id, token_ids, layers)
+    
+    def _reset_batch(self):
+        if self.kv_pool is not None:
+            for request in self._active:
+                self._release_blocks(request)
+        self._active = []
+        self._batch_cache = None
+        self._attention_mask = None
+    
+    def _finish(self, request: GenerationRequest, error: Optional[BaseException] = None):
+        """Mark a request finished, close its streamer and wake its waiter."""
+        if request.finished:
+            return
+        request.finished = True
+        request.error = error
+        request.finished_at = time.time()
+        request.cache = None
+        
+        if error is None:
+            self._stats["requests_completed"] += 1
+        elif isinstance(error, GenerationCancelled):
+            self._stats["requests_cancelled"] += 1
+        else:
+            self._stats["requests_failed"] += 1
+        
+        try:
+            if request.streamer is not None:
+                if error is not None and hasattr(request.streamer, "error"):
+                    request.streamer.error(error)
+                else:
+                    request.streamer.end()
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Closing the streamer of {request.request_id} failed: {e}", exc_info=True)
+        finally:
+            request._done.set()
+
+
+DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
 def get_device_and_dtype():
-    """Determine the best device and dtype for the model."""
+    """Determine the best device and dtype for the model.
+    
+    `settings.model_dtype` overrides the per-device default unless it is "auto".
+    """
     # Check for environment variable to force CPU (useful for API server with MPS issues)
     import os
     if os.environ.get("FORCE_CPU", "false").lower() == "true":
-        return torch.device("cpu"), torch.float32
-    
-    if torch.cuda.is_available():
-        return torch.device("cuda"), torch.float16
-    if getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
+        device, dtype = torch.device("cpu"), torch.float32
+    elif torch.cuda.is_available():
+        device, dtype = torch.device("cuda"), torch.float16
+    elif getattr(torch.backends, "mps", None) and torch.backends.mps.is_available():
         # MPS often has limited float16 support; use float32 on MPS
-        return torch.device("mps"), torch.float32
-    return torch.device("cpu"), torch.float32
+        device, dtype = torch.device("mps"), torch.float32
+    else:
+        device, dtype = torch.device("cpu"), torch.float32
+    
+    if settings.model_dtype != "auto":
+        if settings.model_dtype not in DTYPES:
+            raise ValueError(f"Unsupported model_dtype '{settings.model_dtype}', expected auto or one of {list(DTYPES)}")
+        dtype = DTYPES[settings.model_dtype]
+    
+    # int4 CPU kernels run on bfloat16 activations
+    if settings.model_quantization == "int4" and device.type == "cpu":
+        dtype = torch.bfloat16
+    
+    return device, dtype
+
+
+def build_quantization_config(mode: str):
+    """Build a transformers quantization config for weight-only CPU quantization.
+    
+    Args:
+        mode: "none", "int8" or "int4"
+        
+    Returns:
+        A TorchAoConfig, or None when quantization is disabled
+    """
+    if mode in ("none", ""):
+        return None
+    
+    try:
+        from transformers import TorchAoConfig
+        from torchao.quantization import Int4WeightOnlyConfig, Int8WeightOnlyConfig
+    except ImportError as e:
+        raise RuntimeError(f"model_quantization='{mode}' requires torchao (pip install torchao)") from e
+    
+    # Keep the vision encoder, projector and output head in full precision
+    keep_full_precision = ["vision_tower", "multi_modal_projector", "lm_head"]
+    
+    if mode == "int8":
+        return TorchAoConfig(quant_type=Int8WeightOnlyConfig(), modules_to_not_convert=keep_full_precision)
+    if mode == "int4":
+        from torchao.dtypes import Int4CPULayout
+        return TorchAoConfig(
+            quant_type=Int4WeightOnlyConfig(group_size=128, layout=Int4CPULayout()),
+            modules_to_not_convert=keep_full_precision
+        )
+    raise ValueError(f"Unsupported model_quantization '{mode}', expected none, int8 or int4")
 
 
 class MedGemmaService:
@@ -89,29 +1388,267 @@ class MedGemmaService:
         self.device, self.dtype = get_device_and_dtype()
         self.model = None
         self.processor = None
+        self.scheduler: Optional[GenerationScheduler] = None
+        self.prefix_cache: Optional[PrefixKVCache] = None
+        self.session_store: Optional[SessionKVStore] = None
+        self.vision_cache: Optional[VisionEmbeddingCache] = None
+        self.history_window: Optional[HistoryWindow] = None
+        self.response_cache: Optional[ResponseCache] = None
+        self.semantic_cache: Optional[SemanticAnswerCache] = None
+        self.draft_model = None
+        self.preprocess_pool: Optional[PreprocessPool] = None
         self.model_loaded = False
+        # Where the weights came from, load time and peak RSS (set by load_weights)
+        self.load_stats: Optional[Dict[str, Any]] = None
+        self.readiness = ModelReadiness()
+        self._load_lock = threading.Lock()
+        
+        # Requests that can be cancelled by id (None until submitted to the scheduler)
+        self._inflight: Dict[str, Optional[GenerationRequest]] = {}
+        self._cancel_requested = set()
+        self._inflight_lock = threading.Lock()
         
+    def start_background_load(self) -> bool:
+        """Load the model on a background thread; progress is in `readiness`."""
+        return self.readiness.load_in_background(self.load_model, "medgemma-loader")
+    
     def load_model(self):
-        """Load the MedGemma model and processor."""
-        if self.model_loaded:
-            return
-            
-        print(f"Loading MedGemma model on {self.device} with dtype {self.dtype}...")
+        """Load the MedGemma model and processor (concurrent callers wait for one load)."""
+        with self._load_lock:
+            if self.model_loaded:
+                return
+            self.readiness.set(ModelState.LOADING, "loading weights")
+            try:
+                self._load_model()
+            except BaseException as e:
+                self.readiness.fail(e)
+                raise
+            self.readiness.set(ModelState.READY)
+    
+    def _load_model(self):
+        print(
+            f"Loading MedGemma model on {self.device} with dtype {self.dtype}"
+            f" (quantization: {settings.model_quantization})..."
+        )
+        
+        self.load_weights()
+        if (
+            self.load_stats["source"] == "hub"
+            and settings.model_snapshot_create
+            and self.snapshot_path() is not None
+        ):
+            # Pay the conversion once; the next start maps the snapshot instead
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                logger.warning(f"[MEDGEMMA] Could not write model snapshot: {e}")
+        
+        self.readiness.set(ModelState.WARMING, "setting up caches")
+        if settings.preprocess_workers > 0:
+            self.preprocess_pool = PreprocessPool(settings.preprocess_workers, settings.preprocess_queue_depth)
+        if settings.history_max_tokens > 0:
+            self.history_window = HistoryWindow(
+                self.processor.tokenizer,
+                max_tokens=settings.history_max_tokens,
+                min_recent_messages=settings.history_min_recent_messages,
+                trim_ratio=settings.history_trim_ratio
+            )
+        if settings.vision_cache_enabled:
+            self.vision_cache = VisionEmbeddingCache(
+                max_bytes=settings.vision_cache_max_mb * 1024 * 1024,
+                disk_dir=settings.vision_cache_disk_dir,
+                device=self.device
+            )
+        if settings.response_cache_enabled:
+            self.response_cache = ResponseCache(
+                max_entries=settings.response_cache_max_entries,
+                ttl_s=settings.response_cache_ttl_s,
+                sqlite_path=settings.response_cache_sqlite_path
+            )
+            # Replies rendered from old system prompts must not outlive them
+            on_prompt_cache_clear(self.response_cache.clear)
+        if settings.semantic_cache_enabled:
+            print(f"Loading semantic cache embedding model {settings.semantic_cache_embedding_model}...")
+            self.semantic_cache = SemanticAnswerCache(
+                TextEmbedder(settings.semantic_cache_embedding_model, self.device),
+                threshold=settings.semantic_cache_threshold,
+                max_entries_per_scope=settings.semantic_cache_max_entries,
+                audit_log_path=settings.semantic_cache_audit_path
+            )
+            on_prompt_cache_clear(self.semantic_cache.clear)
+        
+        # The scheduler thread runs every forward pass from here on
+        self.scheduler = self._create_scheduler()
+        self.scheduler.start()
+        
+        self.model_loaded = True
+        print("MedGemma model loaded successfully!")
+    
+    def _create_scheduler(self) -> GenerationScheduler:
+        """Build the generation scheduler with its KV caches and decoding options."""
+        if settings.prefix_cache_enabled:
+            self.prefix_cache = PrefixKVCache(max_bytes=settings.prefix_cache_max_mb * 1024 * 1024)
+        if settings.session_kv_enabled:
+            self.session_store = SessionKVStore(
+                ram_budget_bytes=settings.session_kv_ram_mb * 1024 * 1024,
+                disk_budget_bytes=settings.session_kv_disk_mb * 1024 * 1024,
+                idle_spill_s=settings.session_kv_idle_spill_s,
+                device=self.device
+            )
         
-        # Load processor
-        self.processor = AutoProcessor.from_pretrained(settings.model_name)
+        draft_tokenizer = None
+        if settings.speculative_enabled:
+            self.readiness.set(ModelState.WARMING, f"loading draft model {settings.speculative_draft_model}")
+            self.draft_model, draft_tokenizer = self._load_draft_model()
         
-        # Load model (transformers 5.0: don't use device_map with MPS, has bugs)
-        self.model = AutoModelForImageTextToText.from_pretrained(
+        kv_pool = None
+        if settings.kv_pool_mb > 0:
+            kv_pool = self._create_kv_pool()
+        
+        eos_token_id = self.model.generation_config.eos_token_id
+        eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        scheduler = GenerationScheduler(
+            self.model,
+            eos_token_ids=[t for t in eos_token_ids if t is not None],
+            max_batch_size=settings.scheduler_max_batch_size,
+            prefix_cache=self.prefix_cache,
+            session_store=self.session_store,
+            vision_cache=self.vision_cache,
+            draft_model=self.draft_model,
+            tokenizer=self.processor.tokenizer,
+            draft_tokenizer=draft_tokenizer,
+            prompt_lookup_num_tokens=settings.prompt_lookup_num_tokens,
+            prompt_lookup_max_ngram=settings.prompt_lookup_max_ngram,
+            compiled_buckets=settings.compiled_prompt_buckets if settings.compiled_mode_enabled else None,
+            compiled_max_new_tokens=settings.compiled_max_new_tokens,
+            prefill_chunk_tokens=settings.prefill_chunk_tokens,
+            kv_pool=kv_pool
+        )
+        if settings.compiled_mode_enabled:
+            self.readiness.set(ModelState.WARMING, f"compiling prompt buckets {settings.compiled_prompt_buckets}")
+            print(f"Compiling and warming up (prompt buckets: {settings.compiled_prompt_buckets})...")
+            t0 = time.time()
+            scheduler.warmup(num_tokens=settings.compiled_warmup_tokens)
+            print(f"Compiled mode warmup finished in {time.time()-t0:.1f}s")
+        return scheduler
+    
+    def snapshot_path(self) -> Optional[Path]:
+        """Directory of this model's snapshot, or None when snapshots are disabled."""
+        if not settings.model_snapshot_dir:
+            return None
+        return model_snapshot.snapshot_path(
+            settings.model_snapshot_dir,
             settings.model_name,
-            dtype=self.dtype
+            str(self.dtype).replace("torch.", ""),
+            settings.model_quantization
         )
-        # Move to device manually (bypass accelerate bug with MPS in transformers 5.0)
+    
+    def load_weights(self, use_snapshot: bool = True):
+        """Load the processor and model, from the local snapshot when a complete one exists.
+        
+        Records the source, load time and peak RSS in `load_stats`.
+        """
+        t0 = time.time()
+        path = self.snapshot_path() if use_snapshot else None
+        snapshot = model_snapshot.read_snapshot(path) if path is not None else None
+        
+        if snapshot is not None:
+            print(f"Loading model snapshot {path}...")
+            self.processor = AutoProcessor.from_pretrained(path)
+            # Stored in the serving dtype and quantization: safetensors are memory-mapped
+            # and loaded straight onto the device, with no conversion pass.
+            # transformers 5.0: don't use device_map with MPS, has bugs
+            load_kwargs = {} if self.device.type == "mps" else {"device_map": self.device}
+            self.model = AutoModelForImageTextToText.from_pretrained(path, dtype=self.dtype, **load_kwargs)
+        else:
+            self.processor = AutoProcessor.from_pretrained(settings.model_name)
+            quantization_config = build_quantization_config(settings.model_quantization)
+            load_kwargs = {"quantization_config": quantization_config} if quantization_config else {}
+            self.model = AutoModelForImageTextToText.from_pretrained(
+                settings.model_name,
+                dtype=self.dtype,
+                **load_kwargs
+            )
+        # Move to device manually (bypass accelerate bug with MPS in transformers 5.0); no-op when already there
         self.model = self.model.to(self.device)
+        self.model.eval()
         
-        self.model_loaded = True
-        print("MedGemma model loaded successfully!")
+        self.load_stats = {
+            "source": "snapshot" if snapshot is not None else "hub",
+            "path": str(path) if snapshot is not None else settings.model_name,
+            "load_time_s": round(time.time() - t0, 2),
+            "peak_rss_mb": round(model_snapshot.peak_rss_mb(), 1),
+        }
+        print(
+            f"Model weights loaded from {self.load_stats['source']} in {self.load_stats['load_time_s']}s "
+            f"(peak RSS {self.load_stats['peak_rss_mb']:.0f} MB)"
+        )
+    
+    def save_snapshot(self):
+        """Write the loaded model and processor to this model's snapshot directory."""
+        import transformers
+        model_snapshot.save_snapshot(
+            self.snapshot_path(),
+            self.model,
+            self.processor,
+            {
+                "model_name": settings.model_name,
+                "dtype": str(self.dtype).replace("torch.", ""),
+                "quantization": settings.model_quantization,
+                "transformers_version": transformers.__version__,
+            }
+        )
+    
+    def _create_kv_pool(self) -> KVBlockPool:
+        """Preallocate the paged KV block pool for the decode batch (`kv_pool_mb`)."""
+        text_config = getattr(self.model.config, "text_config", self.model.config)
+        num_kv_heads = text_config.num_key_value_heads
+        head_dim = getattr(text_config, "head_dim", None) or text_config.hidden_size // text_config.num_attention_heads
+        num_blocks = KVBlockPool.blocks_for_budget(
+            settings.kv_pool_mb * 1024 * 1024,
+            text_config.num_hidden_layers,
+            num_kv_heads,
+            head_dim,
+            settings.kv_block_size,
+            self.dtype
+        )
+        kv_pool = KVBlockPool(
+            num_layers=text_config.num_hidden_layers,
+            num_kv_heads=num_kv_heads,
+            head_dim=head_dim,
+            num_blocks=num_blocks,
+            block_size=settings.kv_block_size,
+            dtype=self.dtype,
+            device=self.device
+        )
+        print(f"KV block pool: {num_blocks - 1} blocks of {settings.kv_block_size} tokens ({settings.kv_pool_mb} MB)")
+        return kv_pool
+    
+    def _load_draft_model(self):
+        """Load the speculative-decoding draft model.
+        
+        Returns:
+            (draft_model, draft_tokenizer); the tokenizer is only returned when the
+            draft's vocabulary differs from MedGemma's and drafts must be re-tokenized
+        """
+        t0 = time.time()
+        print(f"Loading draft model {settings.speculative_draft_model}...")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            settings.speculative_draft_model,
+            dtype=self.dtype
+        )
+        draft_model = draft_model.to(self.device)
+        draft_model.eval()
+        draft_model.generation_config.num_assistant_tokens = settings.speculative_num_draft_tokens
         
+        draft_tokenizer = None
+        main_vocab = self.model.config.get_text_config().vocab_size
+        if draft_model.config.get_text_config().vocab_size != main_vocab:
+            draft_tokenizer = AutoTokenizer.from_pretrained(settings.speculative_draft_model)
+        
+        logger.info(f"[MEDGEMMA] Draft model loaded: {time.time()-t0:.2f}s")
+        return draft_model, draft_tokenizer
+    
     def load_image(self, image_path: str) -> Image.Image:
         """Load an image from path."""
         img = Image.open(image_path).convert("RGB")
@@ -126,7 +1663,7 @@ class MedGemmaService:
         self,
         conversation_history: List[Dict[str, Any]],
         user_message: str,
-        image: Optional[Image.Image] = None,
+        image: Optional[Union[Image.Image, str]] = None,
         domain: ChatDomain = ChatDomain.GENERAL,
         mode: ChatMode = ChatMode.CONSULT,
         tools: Optional[List[Dict[str, Any]]] = None
@@ -136,7 +1673,7 @@ class MedGemmaService:
         Args:
             conversation_history: Previous messages in the conversation
             user_message: Current user message
-            image: Optional image for multimodal input
+            image: Optional image (or image path) for multimodal input
             domain: Medical domain for specialized behavior
             mode: Interaction mode for specialized behavior
             tools: Optional list of tool schemas to inject into system prompt
@@ -190,17 +1727,21 @@ class MedGemmaService:
         
         return messages
     
-    def generate_response(
+    def prepare_inputs(
         self,
         user_message: str,
         conversation_history: List[Dict[str, Any]] = None,
         image_path: Optional[str] = None,
         domain: ChatDomain = ChatDomain.GENERAL,
         mode: ChatMode = ChatMode.CONSULT,
-        max_new_tokens: int = DEFAULT_MAX_TOKENS,
-        tools: Optional[List[Dict[str, Any]]] = None
-    ) -> str:
-        """Generate a response from MedGemma.
+        tools: Optional[List[Dict[str, Any]]] = None,
+        session_id: Optional[str] = None
+    ) -> Dict[str, torch.Tensor]:
+        """Build model-ready input tensors for a request.
+        
+        Loads the image, renders the chat template and runs the processor. This is
+        plain CPU work and runs on a preprocessing worker (or the caller's thread
+        without a pool), overlapping the scheduler thread's decode steps.
         
         Args:
             user_message: The user's message text
@@ -208,32 +1749,44 @@ class MedGemmaService:
             image_path: Optional path to an image file
             domain: Medical domain for specialized behavior
             mode: Interaction mode for specialized behavior
-            max_new_tokens: Maximum number of tokens to generate
             tools: Optional list of tool schemas from MCP server
+            session_id: Session the turn belongs to, keeps its history window stable
             
         Returns:
-            The generated response text
+            Processor outputs moved to the model device
         """
-        gen_start = time.time()
-        
-        if not self.model_loaded:
-            logger.info("[MEDGEMMA] Model not loaded, loading now...")
-            t0 = time.time()
-            self.load_model()
-            logger.info(f"[MEDGEMMA] Model loaded: {time.time()-t0:.2f}s")
-        
         if conversation_history is None:
             conversation_history = []
         
-        # Load image if provided, otherwise use dummy
+        # Fit the history to the token budget (system prompt is always kept)
+        if self.history_window is not None:
+            t0 = time.time()
+            conversation_history = self.history_window.fit(conversation_history, session_id)
+            logger.info(f"[MEDGEMMA] Windowed history ({len(conversation_history)} msgs): {time.time()-t0:.3f}s")
+        
+        # Load image if provided; text-only requests skip the vision tower entirely
         t1 = time.time()
+        image = None
+        image_hash = None
+        cached_image = None
         if image_path and Path(image_path).exists():
-            image = self.load_image(image_path)
-            logger.info(f"[MEDGEMMA] Loaded image from {image_path}: {time.time()-t1:.3f}s")
-        else:
-            # MedGemma requires an image, use dummy for text-only
+            if self.vision_cache is not None or self.response_cache is not None:
+                image_hash = VisionEmbeddingCache.hash_file(image_path)
+            if self.vision_cache is not None:
+                cached_image = self.vision_cache.get(image_hash)
+            if cached_image is not None:
+                # Only the chat template needs to know there is an image
+                image = image_path
+                logger.info(f"[MEDGEMMA] Vision cache hit for {image_path} ({image_hash[:12]}): {time.time()-t1:.3f}s")
+            else:
+                image = self.load_image(image_path)
+                logger.info(f"[MEDGEMMA] Loaded image from {image_path}: {time.time()-t1:.3f}s")
+        elif not settings.text_only_fast_path:
+            # Legacy path: feed a dummy image through the vision encoder
             image = self.create_dummy_image()
             logger.info(f"[MEDGEMMA] Created dummy image: {time.time()-t1:.3f}s")
+        else:
+            logger.info("[MEDGEMMA] Text-only request, no image tokens")
         
         # Prepare messages with domain/mode
         t2 = time.time()
@@ -249,13 +1802,27 @@ class MedGemmaService:
         )
         logger.info(f"[MEDGEMMA] Applied chat template: {time.time()-t3:.3f}s")
         
-        # Process inputs (tokenize + add image - like test script)
+        # Process inputs (tokenize + add image if any - like test script)
         t4 = time.time()
-        inputs = self.processor(
-            text=prompt,
-            images=image,
-            return_tensors="pt"
-        )
+        if cached_image is not None:
+            # Expand the image placeholder ourselves and skip image preprocessing
+            inputs = self.processor(
+                text=prompt.replace(self.processor.boi_token, self.processor.full_image_sequence),
+                images=None,
+                return_tensors="pt"
+            )
+            if cached_image.image_features is not None:
+                inputs["image_features"] = cached_image.image_features
+            else:
+                inputs["pixel_values"] = cached_image.pixel_values
+        else:
+            inputs = self.processor(
+                text=prompt,
+                images=image,
+                return_tensors="pt"
+            )
+            if image_hash is not None and self.vision_cache is not None:
+                self.vision_cache.put_pixel_values(image_hash, inputs["pixel_values"])
         logger.info(f"[MEDGEMMA] Processed inputs: {time.time()-t4:.3f}s")
         
         # Move tensors to device
@@ -268,46 +1835,250 @@ class MedGemmaService:
                     inputs[k] = v.to(device=self.device)
         logger.info(f"[MEDGEMMA] Moved tensors to {self.device}: {time.time()-t5:.3f}s")
         
-        # Get input length for slicing
-        input_len = inputs["input_ids"].shape[1]
-        logger.info(f"[MEDGEMMA] Input tokens: {input_len}")
-        
-        # Generate
-        t6 = time.time()
-        logger.info("[MEDGEMMA] Starting generation...")
+        inputs = dict(inputs)
+        if image_hash is not None:
+            inputs["image_hash"] = image_hash
+        return inputs
+    
+    def generate_response(self, *args, **kwargs) -> str:
+        """Generate a response from MedGemma and return its text (see `generate`)."""
+        return self.generate(*args, **kwargs).text
+    
+    def generate(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, Any]] = None,
+        image_path: Optional[str] = None,
+        domain: ChatDomain = ChatDomain.GENERAL,
+        mode: ChatMode = ChatMode.CONSULT,
+        max_new_tokens: int = DEFAULT_MAX_TOKENS,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        session_id: Optional[str] = None,
+        prompt_lookup: Optional[bool] = None,
+        streamer: Optional[BaseStreamer] = None,
+        request_id: Optional[str] = None,
+        stop: Optional[List[str]] = None
+    ) -> GenerationResult:
+        """Generate a response from MedGemma.
         
-        # Force MPS synchronization before generation
-        if self.device.type == "mps":
-            torch.mps.synchronize()
-            logger.info("[MEDGEMMA] MPS synchronized before generation")
+        The prepared inputs are submitted to the generation scheduler, which decodes
+        them together with any other in-flight requests; this call blocks until the
+        sequence is finished.
         
-        with torch.no_grad():
-            generation = self.model.generate(
-                **inputs,
+        Args:
+            user_message: The user's message text
+            conversation_history: Previous messages in the conversation
+            image_path: Optional path to an image file
+            domain: Medical domain for specialized behavior
+            mode: Interaction mode for specialized behavior
+            max_new_tokens: Maximum number of tokens to generate
+            tools: Optional list of tool schemas from MCP server
+            session_id: Session the turn belongs to, used to reuse its KV state
+            prompt_lookup: Use prompt-lookup decoding (None = per-mode default from settings)
+            streamer: Optional streamer that receives token ids as they are decoded
+            request_id: Id the request can be cancelled by (see `cancel`)
+            stop: Stop sequences; generation ends once the reply contains one of them
+            
+        Returns:
+            The generated response (with tools, it ends after the first complete tool call)
+            and why decoding stopped
+            
+        Raises:
+            GenerationCancelled: If the request was cancelled before it finished
+        """
+        request_id = request_id or uuid.uuid4().hex
+        self.register_request(request_id)
+        try:
+            gen_start = time.time()
+            
+            if not self.model_loaded:
+                logger.info("[MEDGEMMA] Model not loaded, loading now...")
+                t0 = time.time()
+                self.load_model()
+                logger.info(f"[MEDGEMMA] Model loaded: {time.time()-t0:.2f}s")
+            
+            # Standalone questions (no history, image or tools) can reuse the answer to a similar one
+            semantic_scope = None
+            semantic_embedding = None
+            if (
+                self.semantic_cache is not None
+                and not conversation_history
+                and not image_path
+                and not tools
+                and not stop
+                and mode.value in settings.semantic_cache_modes
+            ):
+                semantic_scope = (domain.value, mode.value)
+                cached_answer, semantic_embedding = self.semantic_cache.lookup(semantic_scope, user_message)
+                if cached_answer is not None:
+                    if streamer is not None:
+                        self._replay_tokens(streamer, torch.zeros((1, 0), dtype=torch.long), cached_answer.token_ids)
+                    logger.info(f"[MEDGEMMA] Total generation time: {time.time()-gen_start:.2f}s")
+                    return GenerationResult(cached_answer.text, cached_answer.token_ids, "cache")
+            
+            prepare_args = (user_message, conversation_history, image_path, domain, mode, tools, session_id)
+            if self.preprocess_pool is not None:
+                inputs = self.preprocess_pool.run(self.prepare_inputs, *prepare_args)
+            else:
+                inputs = self.prepare_inputs(*prepare_args)
+            
+            input_len = inputs["input_ids"].shape[1]
+            logger.info(f"[MEDGEMMA] Input tokens: {input_len}")
+            
+            if prompt_lookup is None:
+                prompt_lookup = mode.value in settings.prompt_lookup_modes
+            
+            # The client runs a tool and sends a new request, so nothing after the call is needed
+            stop_on_tool_call = bool(tools) and settings.stop_on_tool_call
+            stop_condition = StopCondition(stop, stop_on_tool_call=stop_on_tool_call)
+            
+            # Greedy decoding: an identical prompt, image and parameters give the same reply
+            cache_key = None
+            if self.response_cache is not None:
+                cache_key = ResponseCache.make_key(
+                    inputs["input_ids"][0].tolist(),
+                    inputs.get("image_hash"),
+                    {
+                        "model": settings.model_name,
+                        "quantization": settings.model_quantization,
+                        "dtype": str(self.dtype),
+                        "backend": settings.inference_backend,
+                        "max_new_tokens": max_new_tokens,
+                        "stop": sorted(stop or []),
+                        "stop_on_tool_call": stop_on_tool_call,
+                    }
+                )
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"[MEDGEMMA] Response cache hit ({len(cached.token_ids)} tokens)")
+                    if streamer is not None:
+                        self._replay_tokens(streamer, inputs["input_ids"], cached.token_ids)
+                    logger.info(f"[MEDGEMMA] Total generation time: {time.time()-gen_start:.2f}s")
+                    return GenerationResult(cached.text, cached.token_ids, "cache")
+            
+            # Generate
+            t6 = time.time()
+            logger.info("[MEDGEMMA] Submitting to generation scheduler...")
+            request = GenerationRequest(
+                inputs=inputs,
                 max_new_tokens=max_new_tokens,
-                do_sample=False  # Match test script exactly
+                streamer=streamer,
+                session_id=session_id,
+                prompt_lookup=prompt_lookup,
+                request_id=request_id,
+                stop=stop_condition if stop_condition else None,
+                repetition=RepetitionDetector(
+                    settings.repetition_ngram_tokens, settings.repetition_max_repeats
+                ) if settings.repetition_stop_enabled else None
             )
+            with self._inflight_lock:
+                self._inflight[request_id] = request
+                # Cancelled while the inputs were being prepared: dropped at admission
+                request.cancelled = request_id in self._cancel_requested
+            self.scheduler.submit(request)
+            gen_tokens = request.wait()
+            
+            gen_time = time.time() - t6
+            logger.info(
+                f"[MEDGEMMA] Generation complete: {gen_time:.2f}s "
+                f"(queued {request.first_token_at - request.submitted_at:.2f}s before first token, "
+                f"stopped on {request.stop_reason})"
+            )
+            
+            # Decode the response
+            t7 = time.time()
+            response = self.processor.decode(gen_tokens, skip_special_tokens=True)
+            logger.info(f"[MEDGEMMA] Decoded {len(gen_tokens)} tokens: {time.time()-t7:.3f}s")
+            logger.info(f"[MEDGEMMA] Tokens/sec: {len(gen_tokens)/gen_time:.2f}")
+            logger.info(f"[MEDGEMMA] Total generation time: {time.time()-gen_start:.2f}s")
+            
+            if request.stop_reason == "repetition":
+                # Degenerate output is returned once, never reused
+                logger.warning(f"[MEDGEMMA] Response {request_id} cut off by repetition detection")
+            elif cache_key is not None:
+                self.response_cache.put(cache_key, response, gen_tokens)
+            if semantic_scope is not None and gen_tokens and gen_tokens[-1] in self.scheduler.eos_token_ids:
+                # Only complete answers; a reply cut off at max_new_tokens is not reused
+                self.semantic_cache.put(semantic_scope, user_message, semantic_embedding, response, gen_tokens)
+            
+            return GenerationResult(response, gen_tokens, request.stop_reason)
+        finally:
+            self._unregister_request(request_id)
+    
+    def cancel(self, request_id: str) -> bool:
+        """Cancel an in-flight generation.
         
-        # Force MPS synchronization after generation
-        if self.device.type == "mps":
-            torch.mps.synchronize()
-            logger.info("[MEDGEMMA] MPS synchronized after generation")
-        
-        gen_time = time.time() - t6
-        logger.info(f"[MEDGEMMA] Generation complete: {gen_time:.2f}s")
-        
-        # Slice off the prompt tokens and decode
-        t7 = time.time()
-        gen_tokens = generation[0, input_len:]
-        gen_tokens_cpu = gen_tokens.detach().cpu().tolist()
+        The scheduler drops the sequence before its next decode step, so the model
+        is free for other requests within one token.
         
-        # Decode the response
-        response = self.processor.decode(gen_tokens_cpu, skip_special_tokens=True)
-        logger.info(f"[MEDGEMMA] Decoded {len(gen_tokens_cpu)} tokens: {time.time()-t7:.3f}s")
-        logger.info(f"[MEDGEMMA] Tokens/sec: {len(gen_tokens_cpu)/gen_time:.2f}")
-        logger.info(f"[MEDGEMMA] Total generation time: {time.time()-gen_start:.2f}s")
+        Returns:
+            False if no request with this id is in flight
+        """
+        with self._inflight_lock:
+            if request_id not in self._inflight:
+                return False
+            self._cancel_requested.add(request_id)
+            request = self._inflight[request_id]
+        if request is not None:
+            self.scheduler.cancel(request)
+        logger.info(f"[MEDGEMMA] Cancel requested for {request_id}")
+        return True
+    
+    def register_request(self, request_id: str):
+        """Make `request_id` cancellable before `generate` is called with it.
         
-        return response
+        A cancel that arrives in between is applied when the request is submitted.
+        """
+        with self._inflight_lock:
+            self._inflight.setdefault(request_id, None)
+    
+    def _unregister_request(self, request_id: str):
+        with self._inflight_lock:
+            self._inflight.pop(request_id, None)
+            self._cancel_requested.discard(request_id)
+    
+    def _replay_tokens(self, streamer: BaseStreamer, input_ids: torch.Tensor, token_ids: List[int]):
+        """Feed a cached reply through a streamer the way the scheduler would."""
+        streamer.put(input_ids.cpu())
+        for token in token_ids:
+            if token not in self.scheduler.eos_token_ids:
+                streamer.put(torch.tensor([token]))
+        streamer.end()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Return generation counters for the admin stats endpoint."""
+        stats: Dict[str, Any] = {"model_loaded": self.model_loaded, "readiness": self.readiness.get_status()}
+        if self.load_stats is not None:
+            stats["load"] = self.load_stats
+        if self.scheduler is not None:
+            stats["scheduler"] = self.scheduler.get_stats()
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.get_stats()
+        if self.session_store is not None:
+            stats["session_kv"] = self.session_store.get_stats()
+        if self.vision_cache is not None:
+            stats["vision_cache"] = self.vision_cache.get_stats()
+        if self.history_window is not None:
+            stats["history_window"] = self.history_window.get_stats()
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.get_stats()
+        if self.semantic_cache is not None:
+            stats["semantic_cache"] = self.semantic_cache.get_stats()
+        if self.preprocess_pool is not None:
+            stats["preprocess"] = self.preprocess_pool.get_stats()
+        return stats
+    
+    def forget_session(self, session_id: str):
+        """Drop any KV state kept for a deleted session."""
+        if self.session_store is not None:
+            self.session_store.drop(session_id)
+    
+    def shutdown(self):
+        """Stop the generation scheduler and preprocessing workers."""
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        if self.preprocess_pool is not None:
+            self.preprocess_pool.shutdown()
     
     async def generate_response_stream(
         self,
@@ -317,12 +2088,21 @@ class MedGemmaService:
         domain: ChatDomain = ChatDomain.GENERAL,
         mode: ChatMode = ChatMode.CONSULT,
         max_new_tokens: int = DEFAULT_MAX_TOKENS,
-        tools: Optional[List[Dict[str, Any]]] = None
+        tools: Optional[List[Dict[str, Any]]] = None,
+        session_id: Optional[str] = None,
+        prompt_lookup: Optional[bool] = None,
+        request_id: Optional[str] = None,
+        stop: Optional[List[str]] = None
     ) -> AsyncIterator[str]:
         """Generate a streaming response from MedGemma.
         
-        This is a simplified streaming implementation that generates the full response
-        and yields it in chunks. A true streaming implementation would use TextIteratorStreamer.
+        Generation runs in a worker thread with an `AsyncTokenStreamer` attached, so
+        text is yielded as soon as each token is decoded rather than after the full
+        response is finished. Newlines are yielded as separate chunks to preserve
+        markdown formatting over SSE.
+        
+        If the consumer stops iterating early (Starlette cancels the response when
+        the client disconnects), the generation is cancelled as well.
         
         Args:
             user_message: The user's message text
@@ -332,36 +2112,85 @@ class MedGemmaService:
             mode: Interaction mode for specialized behavior
             max_new_tokens: Maximum number of tokens to generate
             tools: Optional list of tool schemas from MCP server
+            session_id: Session the turn belongs to, used to reuse its KV state
+            prompt_lookup: Use prompt-lookup decoding (None = per-mode default from settings)
+            request_id: Id the request can be cancelled by (see `cancel`)
+            stop: Stop sequences; generation ends once the reply contains one of them
             
         Yields:
             Chunks of the generated response
         """
-        # For now, generate full response and stream it in chunks
-        response = await asyncio.to_thread(
-            self.generate_response,
-            user_message,
-            conversation_history,
-            image_path,
-            domain,
-            mode,
-            max_new_tokens,
-            tools
-        )
+        if not self.model_loaded:
+            await asyncio.to_thread(self.load_model)
         
-        # Stream the response line by line to preserve markdown formatting
-        lines = response.split('\n')
-        for i, line in enumerate(lines):
-            if i > 0:
-                yield '\n'  # Yield newline to preserve formatting
-            
-            # Stream each line word by word
-            words = line.split()
-            for j, word in enumerate(words):
-                if j > 0:
-                    yield ' '
-                yield word
-                await asyncio.sleep(0.01)  # Small delay for streaming effect
+        streamer = AsyncTokenStreamer(self.processor.tokenizer, asyncio.get_running_loop())
+        request_id = request_id or uuid.uuid4().hex
+        
+        def run_generation():
+            try:
+                return self.generate_response(
+                    user_message,
+                    conversation_history,
+                    image_path,
+                    domain,
+                    mode,
+                    max_new_tokens,
+                    tools,
+                    session_id=session_id,
+                    prompt_lookup=prompt_lookup,
+                    streamer=streamer,
+                    request_id=request_id,
+                    stop=stop
+                )
+            except BaseException as e:
+                streamer.error(e)
+                raise
+        
+        generation_task = asyncio.ensure_future(asyncio.to_thread(run_generation))
+        
+        first_chunk = True
+        completed = False
+        t0 = time.time()
+        try:
+            async for text in streamer:
+                if first_chunk:
+                    logger.info(f"[MEDGEMMA] Time to first chunk: {time.time()-t0:.2f}s")
+                    first_chunk = False
+                
+                for piece in split_stream_text(text):
+                    yield piece
+            completed = True
+        finally:
+            if not completed:
+                # Client went away (or generation failed): free the model for the next request
+                self.cancel(request_id)
+                generation_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            # Surface generation errors (the streamer only forwards them) and never
+            # leave the worker thread's result unobserved
+            try:
+                await generation_task
+            except GenerationCancelled:
+                # Already raised through the streamer, or nobody is listening any more
+                pass
+
+
+def create_service() -> MedGemmaService:
+    """A service for the configured `inference_backend` (torch or onnx)."""
+    if settings.inference_backend == "onnx":
+        from server.services.onnx_backend import OnnxMedGemmaService
+        return OnnxMedGemmaService()
+    if settings.inference_backend != "torch":
+        raise ValueError(f"Unknown inference backend: {settings.inference_backend} (expected torch or onnx)")
+    return MedGemmaService()
 
 
-# Global service instance
-medgemma_service = MedGemmaService()
+# Global service instance (a dispatcher over worker processes when replicas are configured)
+if settings.inference_replicas > 1:
+    from server.services.worker_pool import ReplicaWorkerPool
+    medgemma_service = ReplicaWorkerPool(
+        settings.inference_replicas,
+        threads_per_replica=settings.inference_threads_per_replica,
+        pin_cores=settings.inference_pin_cores
+    )
+else:
+    medgemma_service = create_service()
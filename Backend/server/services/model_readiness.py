@@ -0,0 +1,107 @@
+"""Readiness state of the generation model.
+
+Loading MedGemma takes from seconds (a local snapshot) to minutes (a Hub
+checkpoint, a draft model, compiled-mode warmup). Sessions, DICOM, PDF and
+health endpoints do not need the model, so the server starts answering as soon
+as the database is up, and the model loads on a background thread:
+
+    not_loaded -> loading -> warming -> ready
+                        \\-> failed
+
+`loading` covers reading the weights, `warming` everything after that (caches,
+draft model, scheduler start, compiled warmup). Only generation waits for
+`ready`; until then its endpoints return 503 with the state and progress.
+"""
+
+import threading
+import time
+from enum import Enum
+from typing import Any, Callable, Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ModelState(str, Enum):
+    """Lifecycle of the generation model."""
+    NOT_LOADED = "not_loaded"
+    LOADING = "loading"
+    WARMING = "warming"
+    READY = "ready"
+    FAILED = "failed"
+
+
+class ModelReadiness:
+    """Thread-safe model state with a progress note, waitable until ready."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.state = ModelState.NOT_LOADED
+        self.progress: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+
+    def set(self, state: ModelState, progress: Optional[str] = None):
+        """Move to `state` with an optional note on the current step."""
+        with self._cond:
+            if state == ModelState.LOADING and self.state in (ModelState.NOT_LOADED, ModelState.FAILED):
+                self.started_at = time.time()
+                self.error = None
+            if state == ModelState.READY:
+                self.ready_at = time.time()
+            self.state = state
+            self.progress = progress
+            self._cond.notify_all()
+        if progress:
+            logger.info(f"[MODEL] {state.value}: {progress}")
+
+    def fail(self, error: BaseException):
+        """Record a failed load."""
+        with self._cond:
+            self.state = ModelState.FAILED
+            self.error = str(error) or type(error).__name__
+            self._cond.notify_all()
+
+    def wait(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for the model; False if it is not ready (or failed)."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.state not in (ModelState.READY, ModelState.FAILED):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self.state == ModelState.READY
+
+    def load_in_background(self, load: Callable[[], None], name: str) -> bool:
+        """Run `load` on a daemon thread unless a load is running or has finished.
+
+        Returns:
+            Whether a new load was started
+        """
+        with self._cond:
+            if self.state not in (ModelState.NOT_LOADED, ModelState.FAILED):
+                return False
+            self.state = ModelState.LOADING
+            self.progress = "starting"
+            self.started_at = time.time()
+            self.error = None
+
+        def run():
+            try:
+                load()
+            except Exception as e:
+                logger.error(f"[MODEL] Background load failed: {e}", exc_info=True)
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return True
+
+    def get_status(self) -> Dict[str, Any]:
+        """State, progress note, error and load timing."""
+        with self._cond:
+            status: Dict[str, Any] = {"state": self.state.value, "progress": self.progress, "error": self.error}
+            if self.started_at is not None:
+                end = self.ready_at if self.state == ModelState.READY else time.time()
+                status["elapsed_s"] = round(end - self.started_at, 1)
+            return status
@@ -0,0 +1,107 @@
+"""Pre-converted local model snapshots for fast startup.
+
+Loading from the Hub cache runs `from_pretrained` on the original checkpoint:
+float32 weights are materialized, cast or quantized, then copied again by
+`.to(device)`, so a cold start takes minutes and peak memory briefly doubles.
+
+A snapshot is the loaded model saved once with `save_pretrained` as safetensors,
+already in the target dtype and quantization, next to its processor files.
+`from_pretrained` memory-maps safetensors and the tensors need no cast, so a
+restart maps the weights straight in instead of converting them again.
+
+Snapshots live in one directory per (model, dtype, quantization). A snapshot is
+written to a temporary directory and renamed into place, with `snapshot.json`
+as the completeness marker, so a crash while saving never leaves a half-written
+snapshot that later loads.
+
+Convert ahead of time (e.g. in the deploy image) with:
+
+    MODEL_SNAPSHOT_DIR=./storage/snapshots python -m server.services.model_snapshot
+"""
+
+import json
+import os
+import resource
+import shutil
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+MARKER_FILE = "snapshot.json"
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def snapshot_path(base_dir: str, model_name: str, dtype: str, quantization: str) -> Path:
+    """Directory of the snapshot for one model, dtype and quantization."""
+    name = f"{model_name.replace('/', '--')}-{dtype}-{quantization or 'none'}"
+    return Path(base_dir) / name
+
+
+def read_snapshot(path: Path) -> Optional[Dict[str, Any]]:
+    """Metadata of a complete snapshot, or None if there is none at `path`."""
+    try:
+        return json.loads((path / MARKER_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def save_snapshot(path: Path, model, processor, metadata: Dict[str, Any]):
+    """Save a loaded model and its processor as a snapshot.
+
+    Args:
+        path: Snapshot directory (see `snapshot_path`)
+        model: The model, in its serving dtype and quantization
+        processor: The model's processor (tokenizer and image processor)
+        metadata: Written to the completeness marker
+    """
+    t0 = time.time()
+    # Per-process temporary name: replicas starting together may all convert
+    tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    try:
+        model.save_pretrained(tmp, safe_serialization=True)
+        processor.save_pretrained(tmp)
+        metadata = dict(metadata, saved_at=time.time())
+        (tmp / MARKER_FILE).write_text(json.dumps(metadata, indent=2))
+        if read_snapshot(path) is not None:
+            logger.info(f"[SNAPSHOT] {path} was written by another process meanwhile")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        # An incomplete directory (crash while renaming) is never loaded; replace it
+        shutil.rmtree(path, ignore_errors=True)
+        tmp.rename(path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    size_mb = sum(f.stat().st_size for f in path.iterdir()) / (1024 * 1024)
+    logger.info(f"[SNAPSHOT] Saved {path} ({size_mb:.0f} MB) in {time.time()-t0:.1f}s")
+
+
+def main():
+    """Load the configured model from the Hub and write its snapshot."""
+    from server.config import settings
+    from server.services.medgemma import MedGemmaService
+
+    if not settings.model_snapshot_dir:
+        sys.exit("Set MODEL_SNAPSHOT_DIR to the directory snapshots are written to")
+    service = MedGemmaService()
+    path = service.snapshot_path()
+    service.load_weights(use_snapshot=False)
+    service.save_snapshot()
+    print(f"Snapshot written to {path}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,537 @@
+"""ONNX Runtime CPU backend for MedGemma.
+
+On CPU-only hosts, PyTorch eager decode spends much of each step on Python and
+operator-dispatch overhead. With `inference_backend="onnx"`, the language model
+and vision encoder run as exported ONNX graphs in ONNX Runtime, with all of its
+graph optimizations (operator fusion, constant folding, memory planning).
+
+Two graphs are exported once, in float32:
+
+- `decoder.onnx`: one forward step of the language model over explicit KV
+  tensors, for a batch of rows. Inputs are `input_ids`, `image_features`
+  (scattered into the image-token slots), `position_ids`, one additive
+  attention mask each for the full and sliding-window layers, and
+  `past_key_values.{i}.key/value`. Outputs are the logits of the last position
+  of each row and `present.{i}.key/value`.
+- `vision.onnx`: SigLIP encoder and projector, `pixel_values` to image features.
+
+The attention masks are built here, not in the graph. They combine the causal
+mask, the sliding window, bidirectional attention inside each image and the
+left padding of batched rows, so one graph serves prefill and decode, text and
+images.
+
+`OnnxMedGemmaService` is a `MedGemmaService`: prompt building, caches, stop
+conditions, streaming and cancellation are shared. Only the scheduler differs.
+`OnnxScheduler` is the torch `GenerationScheduler` with ONNX Runtime doing the
+forward passes: each prompt is prefilled on its own, then joins the left-padded
+decode batch, and every step decodes all active rows in one decoder run. The
+torch scheduler's prefix/session KV reuse, speculative, compiled and paged-KV
+paths are not available in this backend.
+
+Export with (needs the torch model, `onnxruntime`, `onnx` and `onnxscript`):
+
+    ONNX_MODEL_DIR=./storage/onnx python -m server.services.onnx_backend export
+
+Greedy parity with the torch backend is checked by `server/tests/test_onnx_backend.py`,
+on an exported tiny random Gemma 3 and, with `ONNX_MODEL_DIR` set, on MedGemma.
+"""
+
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+import numpy as np
+import torch
+from transformers import AutoProcessor, DynamicCache
+
+from server.config import settings
+from server.services import model_snapshot
+from server.services.medgemma import (
+    MedGemmaService, GenerationScheduler, GenerationRequest,
+    _rebuild_cache, _cache_layers
+)
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = "onnx_config.json"
+DECODER_FILE = "decoder.onnx"
+VISION_FILE = "vision.onnx"
+
+# Additive mask value for blocked positions
+MASK_MIN = np.finfo(np.float32).min
+
+
+def image_groups(input_ids: np.ndarray, image_token_id: Optional[int]) -> np.ndarray:
+    """Per-position image id: contiguous runs of image tokens get 0, 1, ...; text gets -1."""
+    groups = np.full(len(input_ids), -1, dtype=np.int64)
+    if image_token_id is None:
+        return groups
+    is_image = input_ids == image_token_id
+    # A run starts where an image token follows a non-image token
+    starts = is_image & ~np.concatenate([[False], is_image[:-1]])
+    run_ids = np.cumsum(starts) - 1
+    groups[is_image] = run_ids[is_image]
+    return groups
+
+
+def attention_masks(
+    groups: np.ndarray,
+    q_start: int,
+    sliding_window: Optional[int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Additive masks for the queries `q_start:` over keys `0:len(groups)`.
+
+    Gemma 3 attends causally, except that tokens of the same image attend to each
+    other in both directions; sliding-window layers also drop keys more than
+    `sliding_window` positions back.
+
+    Returns:
+        (full, sliding) masks shaped [1, 1, queries, keys]
+    """
+    kv_len = len(groups)
+    q = np.arange(q_start, kv_len)[:, None]
+    k = np.arange(kv_len)[None, :]
+    causal = k <= q
+    q_groups = groups[q_start:, None]
+    same_image = (q_groups >= 0) & (q_groups == groups[None, :])
+
+    full = causal | same_image
+    sliding = causal if sliding_window is None else causal & (q - k < sliding_window)
+    sliding = sliding | same_image
+    return _additive(full)[None, None], _additive(sliding)[None, None]
+
+
+def decode_masks(padding_mask: np.ndarray, sliding_window: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Additive masks for one new text token per row on top of left-padded past keys.
+
+    Args:
+        padding_mask: [batch, past] with 1 for real past tokens and 0 for left padding
+
+    Returns:
+        (full, sliding) masks shaped [batch, 1, 1, past + 1]
+    """
+    batch, past_len = padding_mask.shape
+    full = np.concatenate([padding_mask.astype(bool), np.ones((batch, 1), dtype=bool)], axis=1)
+    # Padding shifts the query and its keys alike, so distances are the real ones
+    sliding = full if sliding_window is None else full & (past_len - np.arange(past_len + 1) < sliding_window)
+    return _additive(full)[:, None, None], _additive(sliding)[:, None, None]
+
+
+def _additive(allowed: np.ndarray) -> np.ndarray:
+    return np.where(allowed, 0.0, MASK_MIN).astype(np.float32)
+
+
+class _DecoderStep(torch.nn.Module):
+    """One language-model step over flat KV tensors (the exported decoder graph)."""
+
+    def __init__(self, model, image_token_id: int):
+        super().__init__()
+        text_config = getattr(model.config, "text_config", model.config)
+        self.embed_tokens = model.get_input_embeddings()
+        self.language_model = model.model.language_model
+        self.lm_head = model.lm_head
+        self.image_token_id = image_token_id
+        self.softcap = getattr(text_config, "final_logit_softcapping", None)
+
+    def forward(self, input_ids, image_features, position_ids, full_mask, sliding_mask, *past):
+        image_mask = input_ids == self.image_token_id
+        embeds = self.embed_tokens(input_ids.masked_fill(image_mask, 0))
+        embeds = embeds.masked_scatter(image_mask.unsqueeze(-1).expand_as(embeds), image_features.to(embeds.dtype))
+        cache = _rebuild_cache([(past[i], past[i + 1]) for i in range(0, len(past), 2)])
+        outputs = self.language_model(
+            inputs_embeds=embeds,
+            position_ids=position_ids,
+            # Precomputed masks per layer type; the model uses them as given
+            attention_mask={"full_attention": full_mask, "sliding_attention": sliding_mask},
+            past_key_values=cache,
+            use_cache=True
+        )
+        logits = self.lm_head(outputs.last_hidden_state[:, -1])
+        if self.softcap:
+            logits = torch.tanh(logits / self.softcap) * self.softcap
+        present = [t for k, v in _cache_layers(outputs.past_key_values) for t in (k, v)]
+        return (logits, *present)
+
+
+class _VisionEncoder(torch.nn.Module):
+    """Vision tower and projector (the exported vision graph)."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        features = self.model.get_image_features(pixel_values=pixel_values)
+        if not isinstance(features, torch.Tensor):
+            features = getattr(features, "pooler_output", features)
+        return features.reshape(-1, features.shape[-1])
+
+
+def export_onnx(model, processor, output_dir: str, opset: int = 18):
+    """Export the decoder and vision graphs, the processor and the backend config.
+
+    Args:
+        model: MedGemma (`AutoModelForImageTextToText`), loaded in float32 on the CPU
+        processor: Its processor, saved alongside the graphs (None to skip)
+        output_dir: Directory to write (the `onnx_model_dir` setting)
+        opset: ONNX opset version
+    """
+    out = Path(output_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    # Eager attention adds the mask to the scores, which exports cleanly
+    model.set_attn_implementation("eager")
+    model.eval()
+
+    text_config = getattr(model.config, "text_config", model.config)
+    num_layers = text_config.num_hidden_layers
+    num_kv_heads = text_config.num_key_value_heads
+    head_dim = getattr(text_config, "head_dim", None) or text_config.hidden_size // text_config.num_attention_heads
+    image_token_id = getattr(model.config, "image_token_id", None)
+    if image_token_id is None:
+        image_token_id = getattr(model.config, "image_token_index", None)
+    dynamic = torch.export.Dim.DYNAMIC
+
+    # Sizes avoid 0 and 1, which the exporter would specialize on
+    batch, seq_len, past_len, image_tokens = 2, 3, 4, 2
+    past = []
+    for _ in range(num_layers):
+        past += [torch.zeros(batch, num_kv_heads, past_len, head_dim), torch.zeros(batch, num_kv_heads, past_len, head_dim)]
+    full_mask, sliding_mask = (
+        torch.from_numpy(m).expand(batch, -1, -1, -1).contiguous()
+        for m in attention_masks(np.full(past_len + seq_len, -1), past_len, text_config.sliding_window)
+    )
+    args = (
+        torch.tensor([[2, 3, 4]]).expand(batch, -1).contiguous(),
+        torch.zeros(image_tokens, text_config.hidden_size),
+        torch.arange(past_len, past_len + seq_len).expand(batch, -1).contiguous(),
+        full_mask,
+        sliding_mask,
+        *past
+    )
+    past_names = [f"past_key_values.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    present_names = [f"present.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+
+    t0 = time.time()
+    with torch.no_grad():
+        torch.onnx.export(
+            _DecoderStep(model, image_token_id).eval(),
+            args,
+            str(out / DECODER_FILE),
+            input_names=["input_ids", "image_features", "position_ids", "full_mask", "sliding_mask", *past_names],
+            output_names=["logits", *present_names],
+            dynamic_shapes=(
+                {0: dynamic, 1: dynamic},
+                {0: dynamic},
+                {0: dynamic, 1: dynamic},
+                {0: dynamic, 2: dynamic, 3: dynamic},
+                {0: dynamic, 2: dynamic, 3: dynamic},
+                # `*past` is one (tuple) input to torch.export
+                ({0: dynamic, 2: dynamic},) * len(past_names)
+            ),
+            opset_version=opset,
+            dynamo=True,
+            external_data=True,
+            optimize=True
+        )
+    logger.info(f"[ONNX] Exported decoder in {time.time()-t0:.1f}s")
+
+    image_size = model.config.vision_config.image_size
+    t0 = time.time()
+    with torch.no_grad():
+        torch.onnx.export(
+            _VisionEncoder(model).eval(),
+            (torch.zeros(2, 3, image_size, image_size),),
+            str(out / VISION_FILE),
+            input_names=["pixel_values"],
+            output_names=["image_features"],
+            dynamic_shapes=({0: dynamic},),
+            opset_version=opset,
+            dynamo=True,
+            external_data=True,
+            optimize=True
+        )
+    logger.info(f"[ONNX] Exported vision encoder in {time.time()-t0:.1f}s")
+
+    if processor is not None:
+        processor.save_pretrained(out)
+    eos_token_id = model.generation_config.eos_token_id
+    eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+    (out / CONFIG_FILE).write_text(json.dumps({
+        "model_name": settings.model_name,
+        "num_layers": num_layers,
+        "num_kv_heads": num_kv_heads,
+        "head_dim": head_dim,
+        "hidden_size": text_config.hidden_size,
+        "sliding_window": text_config.sliding_window,
+        "image_token_id": image_token_id,
+        "eos_token_ids": [t for t in eos_token_ids if t is not None],
+        "opset": opset,
+        "exported_at": time.time(),
+    }, indent=2))
+
+
+class OnnxGemmaRunner:
+    """ONNX Runtime sessions for the exported decoder and vision graphs."""
+
+    def __init__(self, model_dir: str, intra_op_threads: int = 0):
+        """
+        Args:
+            model_dir: Directory written by `export_onnx`
+            intra_op_threads: ONNX Runtime intra-op threads (0 = its default)
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise RuntimeError("inference_backend='onnx' requires onnxruntime (pip install onnxruntime)") from e
+
+        path = Path(model_dir)
+        self.config = json.loads((path / CONFIG_FILE).read_text())
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        providers = ["CPUExecutionProvider"]
+        self.decoder = ort.InferenceSession(str(path / DECODER_FILE), options, providers=providers)
+        self.vision = ort.InferenceSession(str(path / VISION_FILE), options, providers=providers)
+
+        self.num_layers = self.config["num_layers"]
+        self.hidden_size = self.config["hidden_size"]
+        self.sliding_window = self.config["sliding_window"]
+        self.image_token_id = self.config["image_token_id"]
+        self._past_names = [f"past_key_values.{i}.{kind}" for i in range(self.num_layers) for kind in ("key", "value")]
+
+    def empty_past(self) -> List[np.ndarray]:
+        shape = (1, self.config["num_kv_heads"], 0, self.config["head_dim"])
+        return [np.zeros(shape, dtype=np.float32) for _ in self._past_names]
+
+    def no_image_features(self) -> np.ndarray:
+        return np.zeros((0, self.hidden_size), dtype=np.float32)
+
+    def encode_image(self, pixel_values: np.ndarray) -> np.ndarray:
+        """Image features [images * tokens, hidden] for `pixel_values`."""
+        return self.vision.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+
+    def run(
+        self,
+        input_ids: np.ndarray,
+        image_features: np.ndarray,
+        position_ids: np.ndarray,
+        full_mask: np.ndarray,
+        sliding_mask: np.ndarray,
+        past: List[np.ndarray]
+    ) -> Tuple[np.ndarray, List[np.ndarray]]:
+        """One decoder run over a batch of rows.
+
+        Returns:
+            (logits of each row's last position, KV tensors of all positions)
+        """
+        feeds = {
+            "input_ids": input_ids.astype(np.int64),
+            "image_features": image_features,
+            "position_ids": position_ids.astype(np.int64),
+            "full_mask": full_mask,
+            "sliding_mask": sliding_mask,
+        }
+        feeds.update(zip(self._past_names, past))
+        outputs = self.decoder.run(None, feeds)
+        return outputs[0], outputs[1:]
+
+    def prefill(self, input_ids: np.ndarray, image_features: np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+        """Run a whole prompt.
+
+        Args:
+            input_ids: Prompt token ids
+            image_features: Features for its image tokens ([0, hidden] if none)
+
+        Returns:
+            (logits of the last position, KV tensors of the prompt)
+        """
+        groups = image_groups(input_ids, self.image_token_id)
+        full_mask, sliding_mask = attention_masks(groups, 0, self.sliding_window)
+        logits, present = self.run(
+            input_ids[None], image_features, np.arange(len(input_ids))[None], full_mask, sliding_mask, self.empty_past()
+        )
+        return logits[0], present
+
+    def decode(
+        self,
+        input_ids: np.ndarray,
+        position_ids: np.ndarray,
+        padding_mask: np.ndarray,
+        past: List[np.ndarray]
+    ) -> Tuple[np.ndarray, List[np.ndarray]]:
+        """Feed one text token per row on top of a left-padded batch.
+
+        Args:
+            input_ids: [batch, 1] tokens
+            position_ids: [batch, 1] positions of those tokens in their sequences
+            padding_mask: [batch, past] with 0 for the left padding of `past`
+            past: Batched KV tensors of the earlier positions
+
+        Returns:
+            (logits [batch, vocab], KV tensors with the new position appended)
+        """
+        full_mask, sliding_mask = decode_masks(padding_mask, self.sliding_window)
+        return self.run(input_ids, self.no_image_features(), position_ids, full_mask, sliding_mask, past)
+
+
+def _cache_from_arrays(arrays: List[np.ndarray]) -> DynamicCache:
+    """Wrap the decoder's flat KV outputs in a scheduler cache, without copying."""
+    return _rebuild_cache([
+        (torch.from_numpy(arrays[i]), torch.from_numpy(arrays[i + 1])) for i in range(0, len(arrays), 2)
+    ])
+
+
+class OnnxScheduler(GenerationScheduler):
+    """`GenerationScheduler` whose forward passes run on ONNX Runtime.
+
+    Admission, batching, retirement, cancellation, stop conditions, streaming and
+    failure handling are inherited. The batch state keeps the torch layout (a
+    left-padded cache and padding mask); its tensors share memory with the
+    decoder's inputs and outputs, so each step decodes all active rows in one run.
+    """
+
+    def __init__(self, runner: OnnxGemmaRunner, eos_token_ids: List[int], tokenizer, max_batch_size: int = 8):
+        super().__init__(runner, eos_token_ids, max_batch_size=max_batch_size, tokenizer=tokenizer)
+
+    def _init_model(self, runner: OnnxGemmaRunner):
+        self.runner = runner
+        self.image_token_id = runner.image_token_id
+
+    @property
+    def device(self) -> torch.device:
+        return torch.device("cpu")
+
+    def _single_sequence_method(self, request: GenerationRequest) -> Optional[str]:
+        # Speculative and compiled runs go through torch `generate`
+        return None
+
+    def _prefill(self, request: GenerationRequest):
+        """Run the whole prompt and sample the first token; the KV state joins the batch next."""
+        t0 = time.time()
+        if request.streamer is not None and not request.prompt_streamed:
+            request.streamer.put(request.inputs["input_ids"].cpu())
+            request.prompt_streamed = True
+
+        input_ids = request.inputs["input_ids"][0].cpu().numpy()
+        if "image_features" in request.inputs:
+            features = request.inputs["image_features"].float().cpu().numpy()
+            image_features = features.reshape(-1, self.runner.hidden_size)
+        elif "pixel_values" in request.inputs:
+            image_features = self.runner.encode_image(request.inputs["pixel_values"].float().cpu().numpy())
+        else:
+            image_features = self.runner.no_image_features()
+
+        logits, present = self.runner.prefill(input_ids, image_features)
+        request.cache = _cache_from_arrays(present)
+        self._stats["prefill_tokens"] += len(input_ids)
+        self._stats["prefill_time_s"] += time.time() - t0
+        logger.info(f"[ONNX] Prefilled {request.request_id} ({len(input_ids)} tokens): {time.time()-t0:.2f}s")
+        self._append_token(request, int(logits.argmax()))
+
+    def _decode_step(self):
+        """Decode one token for every active sequence in a single decoder run."""
+        cancelled = [r for r in self._active if self._finish_if_cancelled(r)]
+        if cancelled:
+            logger.info(f"[ONNX] Dropped {len(cancelled)} cancelled request(s)")
+            self._retire_finished()
+            if not self._active:
+                return
+
+        t0 = time.time()
+        batch = self._active
+        input_ids = np.array([[r.output_ids[-1]] for r in batch], dtype=np.int64)
+        position_ids = np.array([[r.prompt_len + len(r.output_ids) - 1] for r in batch], dtype=np.int64)
+        # Retiring rows leaves sliced views; ONNX Runtime takes contiguous arrays
+        past = [np.ascontiguousarray(t.numpy()) for layer in _cache_layers(self._batch_cache) for t in layer]
+
+        try:
+            logits, present = self.runner.decode(input_ids, position_ids, self._attention_mask.numpy(), past)
+        except Exception as e:
+            logger.error(f"[ONNX] Decode step failed, failing {len(batch)} requests: {e}", exc_info=True)
+            for request in batch:
+                self._finish(request, error=e)
+            self._reset_batch()
+            return
+
+        self._batch_cache = _cache_from_arrays(present)
+        self._attention_mask = torch.cat([
+            self._attention_mask,
+            torch.ones((len(batch), 1), dtype=torch.long),
+        ], dim=1)
+
+        for request, token in zip(batch, logits.argmax(-1).tolist()):
+            try:
+                self._append_token(request, token)
+            except Exception as e:
+                logger.error(f"[ONNX] Handling a token failed for {request.request_id}: {e}", exc_info=True)
+                self._finish(request, error=e)
+
+        self._stats["decode_steps"] += 1
+        self._stats["decode_time_s"] += time.time() - t0
+        self._retire_finished()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return scheduler counters and current queue/batch sizes."""
+        stats = super().get_stats()
+        stats["backend"] = "onnxruntime"
+        return stats
+
+
+class OnnxMedGemmaService(MedGemmaService):
+    """`MedGemmaService` that runs the model on ONNX Runtime instead of PyTorch."""
+
+    def __init__(self):
+        super().__init__()
+        # The graphs are exported in float32 and run on the CPU
+        self.device, self.dtype = torch.device("cpu"), torch.float32
+        self.runner: Optional[OnnxGemmaRunner] = None
+
+    def load_weights(self, use_snapshot: bool = True):
+        """Load the processor and ONNX Runtime sessions from `onnx_model_dir`."""
+        if not settings.onnx_model_dir or not (Path(settings.onnx_model_dir) / CONFIG_FILE).exists():
+            raise RuntimeError(
+                "inference_backend='onnx' needs an exported model in ONNX_MODEL_DIR "
+                "(python -m server.services.onnx_backend export)"
+            )
+        t0 = time.time()
+        print(f"Loading ONNX Runtime backend from {settings.onnx_model_dir}...")
+        self.processor = AutoProcessor.from_pretrained(settings.onnx_model_dir)
+        self.runner = OnnxGemmaRunner(settings.onnx_model_dir, settings.onnx_intra_op_threads)
+        self.load_stats = {
+            "source": "onnx",
+            "path": settings.onnx_model_dir,
+            "load_time_s": round(time.time() - t0, 2),
+            "peak_rss_mb": round(model_snapshot.peak_rss_mb(), 1),
+        }
+        print(f"ONNX Runtime sessions ready in {self.load_stats['load_time_s']}s")
+
+    def _create_scheduler(self) -> OnnxScheduler:
+        return OnnxScheduler(
+            self.runner,
+            eos_token_ids=self.runner.config["eos_token_ids"],
+            tokenizer=self.processor.tokenizer,
+            max_batch_size=settings.scheduler_max_batch_size
+        )
+
+
+def main():
+    """Export the configured model to `onnx_model_dir`."""
+    if len(sys.argv) < 2 or sys.argv[1] != "export":
+        sys.exit("Usage: python -m server.services.onnx_backend export")
+    if not settings.onnx_model_dir:
+        sys.exit("Set ONNX_MODEL_DIR to the directory the graphs are written to")
+
+    service = MedGemmaService()
+    service.device, service.dtype = torch.device("cpu"), torch.float32
+    service.load_weights()
+    export_onnx(service.model, service.processor, settings.onnx_model_dir)
+    print(f"ONNX model written to {settings.onnx_model_dir}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,218 @@
+"""Cross-request prefix KV cache.
+
+Every request starts with the same system prompt for its domain/mode (plus the
+tool instructions and tool list when tools are sent), so the scheduler would
+otherwise re-prefill hundreds of identical tokens per turn. This module keeps the
+KV state of previously seen prompt prefixes in a radix tree keyed on token ids;
+a new prompt only needs to prefill the part after its longest cached prefix.
+
+KV tensors are stored per tree edge (one slice per layer), so prompts sharing a
+system prompt share the same storage. Least-recently-used leaves are evicted
+when the cache exceeds its memory budget.
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Per-layer (keys, values), each shaped [1, num_heads, seq_len, head_dim]
+KVLayers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def _slice_layers(layers: KVLayers, start: int, end: int) -> KVLayers:
+    """Copy positions [start, end) out of every layer so the source can be freed."""
+    return [
+        (k[:, :, start:end].contiguous(), v[:, :, start:end].contiguous())
+        for k, v in layers
+    ]
+
+
+def _layers_nbytes(layers: KVLayers) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+class _RadixNode:
+    """A tree edge: a run of token ids and the KV state for exactly those positions."""
+
+    __slots__ = ("tokens", "kv", "children", "parent", "last_access", "nbytes")
+
+    def __init__(self, tokens: Tuple[int, ...], kv: Optional[KVLayers], parent: Optional["_RadixNode"]):
+        self.tokens = tokens
+        self.kv = kv
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.parent = parent
+        self.last_access = time.monotonic()
+        self.nbytes = _layers_nbytes(kv) if kv else 0
+
+
+class PrefixKVCache:
+    """Radix tree of prompt-prefix KV states keyed on token ids."""
+
+    def __init__(self, max_bytes: int, min_prefix_tokens: int = 16):
+        """
+        Args:
+            max_bytes: Memory budget for stored KV tensors
+            min_prefix_tokens: Matches shorter than this are ignored (not worth the copy)
+        """
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self._root = _RadixNode((), None, None)
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "hit_tokens": 0,
+            "lookup_tokens": 0,
+            "inserted_tokens": 0,
+            "evictions": 0,
+        }
+
+    def match(self, token_ids: List[int]) -> Tuple[int, Optional[KVLayers]]:
+        """Find the longest cached prefix of `token_ids`.
+
+        Returns:
+            (matched_length, kv_layers); kv_layers is None on a miss
+        """
+        with self._lock:
+            self._stats["lookup_tokens"] += len(token_ids)
+            segments: List[KVLayers] = []
+            matched = 0
+            node = self._root
+            now = time.monotonic()
+
+            while matched < len(token_ids):
+                child = node.children.get(token_ids[matched])
+                if child is None:
+                    break
+
+                # Length of the common run between this edge and the remaining prompt
+                common = 0
+                limit = min(len(child.tokens), len(token_ids) - matched)
+                while common < limit and child.tokens[common] == token_ids[matched + common]:
+                    common += 1
+
+                child.last_access = now
+                if common == len(child.tokens):
+                    segments.append(child.kv)
+                else:
+                    segments.append([(k[:, :, :common], v[:, :, :common]) for k, v in child.kv])
+                matched += common
+
+                if common < len(child.tokens):
+                    break
+                node = child
+
+            if matched < self.min_prefix_tokens:
+                self._stats["misses"] += 1
+                return 0, None
+
+            self._stats["hits"] += 1
+            self._stats["hit_tokens"] += matched
+
+            num_layers = len(segments[0])
+            layers = [
+                (
+                    torch.cat([segment[i][0] for segment in segments], dim=2),
+                    torch.cat([segment[i][1] for segment in segments], dim=2),
+                )
+                for i in range(num_layers)
+            ]
+            return matched, layers
+
+    def insert(self, token_ids: List[int], layers: KVLayers):
+        """Store the KV state for `token_ids`.
+
+        Args:
+            token_ids: Prompt prefix to cache
+            layers: KV tensors covering at least len(token_ids) positions
+        """
+        if len(token_ids) < self.min_prefix_tokens:
+            return
+
+        with self._lock:
+            node = self._root
+            pos = 0
+            now = time.monotonic()
+
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    new_node = _RadixNode(
+                        tuple(token_ids[pos:]), _slice_layers(layers, pos, len(token_ids)), node
+                    )
+                    node.children[token_ids[pos]] = new_node
+                    self._total_bytes += new_node.nbytes
+                    self._stats["inserted_tokens"] += len(token_ids) - pos
+                    break
+
+                common = 0
+                limit = min(len(child.tokens), len(token_ids) - pos)
+                while common < limit and child.tokens[common] == token_ids[pos + common]:
+                    common += 1
+
+                if common < len(child.tokens):
+                    self._split(child, common)
+
+                child.last_access = now
+                node = child
+                pos += common
+
+            self._evict()
+
+    def _split(self, node: _RadixNode, at: int):
+        """Split an edge so that its first `at` tokens become their own node."""
+        tail = _RadixNode(node.tokens[at:], [(k[:, :, at:], v[:, :, at:]) for k, v in node.kv], node)
+        tail.children = node.children
+        tail.last_access = node.last_access
+        for grandchild in tail.children.values():
+            grandchild.parent = tail
+
+        node.tokens = node.tokens[:at]
+        node.kv = [(k[:, :, :at], v[:, :, :at]) for k, v in node.kv]
+        node.children = {tail.tokens[0]: tail}
+        # Views share storage with the original slice; bytes are attributed by length
+        total = node.nbytes
+        node.nbytes = total * at // (at + len(tail.tokens))
+        tail.nbytes = total - node.nbytes
+
+    def _evict(self):
+        """Drop least-recently-used leaves until the cache fits its budget."""
+        while self._total_bytes > self.max_bytes:
+            leaves = []
+            stack = list(self._root.children.values())
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                else:
+                    leaves.append(node)
+            if not leaves:
+                return
+
+            victim = min(leaves, key=lambda n: n.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self._total_bytes -= victim.nbytes
+            self._stats["evictions"] += 1
+
+    def clear(self):
+        """Drop every cached prefix."""
+        with self._lock:
+            self._root = _RadixNode((), None, None)
+            self._total_bytes = 0
+        logger.info("[PREFIX CACHE] Cleared")
+
+    def get_stats(self) -> Dict[str, float]:
+        """Return hit/miss and memory counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+            stats["memory_mb"] = round(self._total_bytes / (1024 * 1024), 1)
+            stats["max_memory_mb"] = round(self.max_bytes / (1024 * 1024), 1)
+            return stats
@@ -0,0 +1,109 @@
+"""Bounded worker pool for request preprocessing.
+
+Preparing a request (history window, image loading, chat template, processor
+call) is CPU work that runs before the scheduler can admit it. Done on the
+calling thread, every concurrent request preprocesses at once: a burst of batch
+items or image uploads runs dozens of processor calls in parallel, and they take
+cores from the decode step, which slows the whole batch.
+
+`PreprocessPool` bounds that stage instead: at most `workers` requests are
+preprocessed at once, on dedicated threads, and at most `max_queued` more wait
+for a worker; further callers block until there is room. The call is still
+synchronous. The calling thread waits for its inputs and then does the cache
+lookups and submits to the scheduler itself, so the pool limits how much CPU
+preprocessing takes from decode rather than moving work off the caller. The
+stats report queue wait and stage time, so it is visible whether preprocessing
+keeps up with decode.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class PreprocessPool:
+    """Fixed worker threads with a bounded queue in front of them."""
+
+    def __init__(self, workers: int, max_queued: int):
+        """
+        Args:
+            workers: Requests preprocessed at once
+            max_queued: Requests allowed to wait for a worker before callers block
+        """
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="medgemma-preprocess")
+        self._capacity = threading.BoundedSemaphore(workers + max_queued)
+
+        self._lock = threading.Lock()
+        self._in_stage = 0
+        self._stats = {
+            "completed": 0,
+            "failed": 0,
+            "blocked": 0,  # callers that waited for room in the queue
+            "peak_in_stage": 0,
+            "queue_wait_s": 0.0,
+            "run_time_s": 0.0,
+        }
+
+    def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run `fn` on a preprocessing worker and return its result.
+
+        Blocks while the queue is full, then until the worker is done. Exceptions
+        from `fn` are raised here.
+        """
+        if not self._capacity.acquire(blocking=False):
+            with self._lock:
+                self._stats["blocked"] += 1
+            self._capacity.acquire()
+        with self._lock:
+            self._in_stage += 1
+            self._stats["peak_in_stage"] = max(self._stats["peak_in_stage"], self._in_stage)
+
+        queued_at = time.time()
+
+        def task():
+            started_at = time.time()
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                with self._lock:
+                    self._stats["queue_wait_s"] += started_at - queued_at
+                    self._stats["run_time_s"] += time.time() - started_at
+                    self._stats["completed" if ok else "failed"] += 1
+
+        try:
+            future = self._executor.submit(task)
+            return future.result()
+        finally:
+            with self._lock:
+                self._in_stage -= 1
+            self._capacity.release()
+
+    def shutdown(self):
+        """Stop the workers once queued work is done."""
+        self._executor.shutdown(wait=False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return throughput, queue wait and stage time counters."""
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["workers"] = self.workers
+            stats["max_queued"] = self.max_queued
+            stats["in_stage"] = self._in_stage
+        finished = stats["completed"] + stats["failed"]
+        if finished:
+            stats["avg_queue_wait_s"] = round(stats["queue_wait_s"] / finished, 4)
+            stats["avg_run_time_s"] = round(stats["run_time_s"] / finished, 4)
+        stats["queue_wait_s"] = round(stats["queue_wait_s"], 3)
+        stats["run_time_s"] = round(stats["run_time_s"], 3)
+        return stats
@@ -0,0 +1,165 @@
+"""Exact-match response cache for greedy generation.
+
+Generation is deterministic (`do_sample=False`), so a request whose rendered
+prompt, image and generation parameters are identical to an earlier one gets the
+same reply. That happens with demo scripts, repeated "summarize this workspace"
+clicks and retries after client timeouts. Replies are keyed by a hash of the
+prompt token ids, the image content hash and the generation parameters.
+
+Entries are kept least-recently-used in memory. With a SQLite path configured,
+every entry is also written to a table, which survives restarts and serves
+lookups that miss the memory tier. Entries older than the TTL are ignored and
+removed when found.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedResponse:
+    """A finished reply: decoded text plus the generated token ids (for replaying streams)."""
+    text: str
+    token_ids: List[int]
+    created_at: float
+
+
+class ResponseCache:
+    """LRU cache of generated replies with an optional SQLite tier."""
+
+    def __init__(self, max_entries: int, ttl_s: float = 3600.0, sqlite_path: Optional[str] = None):
+        """
+        Args:
+            max_entries: Number of replies kept in memory
+            ttl_s: Seconds a reply stays valid (0 keeps replies until evicted or cleared)
+            sqlite_path: Database file for the persistent tier (None disables it)
+        """
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "sqlite_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "stores": 0,
+        }
+
+        self._db: Optional[sqlite3.Connection] = None
+        if sqlite_path:
+            Path(sqlite_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, token_ids TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(token_ids: List[int], image_hash: Optional[str], params: Dict[str, Any]) -> str:
+        """Canonical key for a request.
+
+        Args:
+            token_ids: Fully rendered prompt (chat template, system prompt, history, tools)
+            image_hash: Content hash of the attached image, if any
+            params: Generation parameters that affect the output
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(token_ids, separators=(",", ":")).encode("utf-8"))
+        digest.update(b"\x00" + (image_hash or "").encode("utf-8"))
+        digest.update(b"\x00" + json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _expired(self, entry: CachedResponse) -> bool:
+        return self.ttl_s > 0 and time.time() - entry.created_at > self.ttl_s
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Return the cached reply for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(entry):
+                    self._remove_locked(key)
+                    self._stats["expired"] += 1
+                    self._stats["misses"] += 1
+                    return None
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT text, token_ids, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = CachedResponse(row[0], json.loads(row[1]), row[2])
+                    if self._expired(entry):
+                        self._remove_locked(key)
+                        self._stats["expired"] += 1
+                    else:
+                        self._insert_locked(key, entry)
+                        self._stats["sqlite_hits"] += 1
+                        return entry
+
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, text: str, token_ids: List[int]):
+        """Store a finished reply."""
+        entry = CachedResponse(text=text, token_ids=list(token_ids), created_at=time.time())
+        with self._lock:
+            self._insert_locked(key, entry)
+            self._stats["stores"] += 1
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO responses (key, text, token_ids, created_at) VALUES (?, ?, ?, ?)",
+                        (key, entry.text, json.dumps(entry.token_ids), entry.created_at)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"[RESPONSE CACHE] Failed to persist {key[:12]}: {e}")
+
+    def _insert_locked(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _remove_locked(self, key: str):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+    def clear(self):
+        """Drop every cached reply, including the SQLite tier."""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+        logger.info("[RESPONSE CACHE] Cleared")
+
+    def get_stats(self) -> Dict[str, float]:
+        """Return hit/miss counters and size."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["sqlite_hits"] + stats["misses"]
+            stats["hit_rate"] = round((stats["hits"] + stats["sqlite_hits"]) / lookups, 3) if lookups else 0.0
+            stats["entries"] = len(self._entries)
+            if self._db is not None:
+                stats["sqlite_entries"] = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return stats
@@ -0,0 +1,224 @@
+"""Semantic answer cache for standalone questions.
+
+Many general consult questions are near-duplicates ("normal adult potassium
+range", "what is the normal potassium range in adults"). For requests with no
+history, no image and no tools, the answer depends only on the question and the
+domain/mode system prompt, so a previous answer to a sufficiently similar
+question can be returned instead of running a full generation.
+
+Questions are embedded with a small sentence encoder. The index is one matrix of
+normalized embeddings per (domain, mode) scope, searched by a single matrix-vector
+product. Every hit is logged (and optionally appended to a JSONL audit file) with
+both questions and their similarity, so false hits can be reviewed and the
+threshold tuned.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import logging
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+# (domain, mode)
+Scope = Tuple[str, str]
+
+# Misses this close below the threshold are counted, to help tune it
+NEAR_MISS_MARGIN = 0.05
+
+
+class TextEmbedder:
+    """Mean-pooled, L2-normalized sentence embeddings from a small encoder model."""
+
+    def __init__(self, model_name: str, device: Optional[torch.device] = None):
+        from transformers import AutoModel, AutoTokenizer
+
+        self.device = device or torch.device("cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).to(self.device)
+        self.model.eval()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> torch.Tensor:
+        with self._lock, torch.no_grad():
+            encoded = self.tokenizer(text, return_tensors="pt", truncation=True, max_length=256).to(self.device)
+            hidden = self.model(**encoded).last_hidden_state
+            mask = encoded["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+            return F.normalize(pooled[0].float(), dim=-1).cpu()
+
+
+@dataclass
+class SemanticCacheEntry:
+    """A cached answer and the question it was generated for."""
+    question: str
+    text: str
+    token_ids: List[int]
+    created_at: float = field(default_factory=time.time)
+    last_access: float = field(default_factory=time.monotonic)
+    hits: int = 0
+
+
+class _ScopeIndex:
+    """Embeddings (one row per entry) and entries for one domain/mode."""
+
+    def __init__(self, dim: int):
+        self.vectors = torch.empty((0, dim), dtype=torch.float32)
+        self.entries: List[SemanticCacheEntry] = []
+
+    def nearest(self, embedding: torch.Tensor) -> Tuple[int, float]:
+        if not self.entries:
+            return -1, -1.0
+        scores = self.vectors @ embedding
+        index = int(scores.argmax())
+        return index, float(scores[index])
+
+    def add(self, embedding: torch.Tensor, entry: SemanticCacheEntry):
+        self.vectors = torch.cat([self.vectors, embedding.unsqueeze(0)], dim=0)
+        self.entries.append(entry)
+
+    def remove(self, index: int):
+        self.vectors = torch.cat([self.vectors[:index], self.vectors[index + 1:]], dim=0)
+        del self.entries[index]
+
+
+class SemanticAnswerCache:
+    """Nearest-neighbour answer cache scoped by domain/mode."""
+
+    def __init__(
+        self,
+        embed: Callable[[str], torch.Tensor],
+        threshold: float = 0.92,
+        max_entries_per_scope: int = 2048,
+        audit_log_path: Optional[str] = None,
+        recent_hits: int = 20
+    ):
+        """
+        Args:
+            embed: Maps a question to a normalized 1-D embedding
+            threshold: Minimum cosine similarity for a hit
+            max_entries_per_scope: Entries kept per domain/mode (least recently used are dropped)
+            audit_log_path: JSONL file every hit is appended to (None logs only)
+            recent_hits: Number of recent hits reported in the stats
+        """
+        self.embed_fn = embed
+        self.threshold = threshold
+        self.max_entries_per_scope = max_entries_per_scope
+        self.audit_log_path = Path(audit_log_path) if audit_log_path else None
+        if self.audit_log_path is not None:
+            self.audit_log_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._scopes: Dict[Scope, _ScopeIndex] = {}
+        self._recent_hits: Deque[Dict[str, Any]] = deque(maxlen=recent_hits)
+        self._lock = threading.Lock()
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "near_misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "lookup_time_s": 0.0,
+        }
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        return " ".join(question.split())
+
+    def lookup(self, scope: Scope, question: str) -> Tuple[Optional[SemanticCacheEntry], torch.Tensor]:
+        """Find the cached answer to the most similar question in `scope`.
+
+        Args:
+            scope: (domain, mode) the question was asked in
+            question: The question text
+
+        Returns:
+            (entry, embedding); entry is None below the threshold. Pass the
+            embedding to `put` to store the answer once it is generated.
+        """
+        t0 = time.time()
+        embedding = self.embed_fn(self.normalize_question(question))
+        with self._lock:
+            index = self._scopes.get(scope)
+            position, similarity = index.nearest(embedding) if index is not None else (-1, -1.0)
+            self._stats["lookups"] += 1
+
+            if position < 0 or similarity < self.threshold:
+                self._stats["misses"] += 1
+                if similarity >= self.threshold - NEAR_MISS_MARGIN:
+                    self._stats["near_misses"] += 1
+                self._stats["lookup_time_s"] += time.time() - t0
+                return None, embedding
+
+            entry = index.entries[position]
+            entry.hits += 1
+            entry.last_access = time.monotonic()
+            self._stats["hits"] += 1
+            self._stats["lookup_time_s"] += time.time() - t0
+
+            record = {
+                "time": time.time(),
+                "scope": list(scope),
+                "question": self.normalize_question(question),
+                "matched_question": entry.question,
+                "similarity": round(similarity, 4),
+            }
+            self._recent_hits.append(record)
+
+        logger.info(
+            f"[SEMANTIC CACHE] Hit in {scope[0]}/{scope[1]} (similarity {similarity:.3f}): "
+            f"{record['question']!r} -> {entry.question!r}"
+        )
+        self._audit(record)
+        return entry, embedding
+
+    def put(self, scope: Scope, question: str, embedding: torch.Tensor, text: str, token_ids: List[int]):
+        """Store the answer generated for a question."""
+        entry = SemanticCacheEntry(question=self.normalize_question(question), text=text, token_ids=list(token_ids))
+        with self._lock:
+            index = self._scopes.get(scope)
+            if index is None:
+                index = self._scopes[scope] = _ScopeIndex(embedding.shape[0])
+            index.add(embedding.float(), entry)
+            self._stats["stores"] += 1
+
+            if len(index.entries) > self.max_entries_per_scope:
+                victim = min(range(len(index.entries)), key=lambda i: index.entries[i].last_access)
+                index.remove(victim)
+                self._stats["evictions"] += 1
+
+    def _audit(self, record: Dict[str, Any]):
+        if self.audit_log_path is None:
+            return
+        try:
+            with open(self.audit_log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logger.warning(f"[SEMANTIC CACHE] Failed to write audit log: {e}")
+
+    def clear(self):
+        """Drop every cached answer."""
+        with self._lock:
+            self._scopes.clear()
+        logger.info("[SEMANTIC CACHE] Cleared")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return hit rate, lookup latency, index size and the most recent hits."""
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 3) if stats["lookups"] else 0.0
+            if stats["lookups"]:
+                stats["avg_lookup_ms"] = round(stats.pop("lookup_time_s") / stats["lookups"] * 1000, 2)
+            else:
+                stats.pop("lookup_time_s")
+            stats["threshold"] = self.threshold
+            stats["entries"] = {f"{d}/{m}": len(index.entries) for (d, m), index in self._scopes.items()}
+            stats["recent_hits"] = list(self._recent_hits)
+            return stats
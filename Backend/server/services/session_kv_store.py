@@ -0,0 +1,229 @@
+"""Per-session KV cache persistence with RAM/disk tiering.
+
+At the end of every assistant turn the scheduler hands the sequence's KV state
+(prompt + generated reply) to this store under the session id. On the next turn
+of that session the rebuilt prompt starts with the same tokens, so only the new
+user message needs to be prefilled instead of the whole conversation.
+
+Entries live in RAM while hot. Entries that have been idle for a while, or that
+are pushed out by the RAM budget (least recently used first), are spilled to a
+file under the disk directory; the disk tier has its own LRU budget.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Per-layer (keys, values), each shaped [1, num_heads, seq_len, head_dim]
+KVLayers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def _layers_nbytes(layers: KVLayers) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+@dataclass
+class _SessionEntry:
+    token_ids: List[int]
+    layers: Optional[KVLayers]  # None while the entry only exists on disk
+    nbytes: int
+    last_access: float = field(default_factory=time.monotonic)
+
+
+class SessionKVStore:
+    """LRU store of end-of-turn KV states keyed by session id."""
+
+    def __init__(
+        self,
+        ram_budget_bytes: int,
+        disk_budget_bytes: int,
+        idle_spill_s: float = 300.0,
+        disk_dir: Optional[str] = None,
+        min_match_tokens: int = 16,
+        device: Optional[torch.device] = None
+    ):
+        """
+        Args:
+            ram_budget_bytes: Maximum KV bytes held in RAM across all sessions
+            disk_budget_bytes: Maximum KV bytes spilled to disk (0 disables the disk tier)
+            idle_spill_s: Seconds without access after which a RAM entry is spilled
+            disk_dir: Directory for spilled entries (defaults to server/temp/kv_cache)
+            min_match_tokens: Matches shorter than this are ignored
+            device: Device spilled entries are loaded back onto
+        """
+        self.ram_budget_bytes = ram_budget_bytes
+        self.disk_budget_bytes = disk_budget_bytes
+        self.idle_spill_s = idle_spill_s
+        self.min_match_tokens = min_match_tokens
+        self.device = device
+
+        if disk_dir is None:
+            self.disk_dir = Path(__file__).parent.parent / "temp" / "kv_cache"
+        else:
+            self.disk_dir = Path(disk_dir)
+        if self.disk_budget_bytes > 0:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+        self._ram: "OrderedDict[str, _SessionEntry]" = OrderedDict()
+        self._disk: "OrderedDict[str, _SessionEntry]" = OrderedDict()
+        self._ram_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "ram_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "hit_tokens": 0,
+            "spills": 0,
+            "evictions": 0,
+        }
+
+    def _disk_path(self, session_id: str) -> Path:
+        # Hash the id to avoid filesystem issues
+        return self.disk_dir / f"{hashlib.md5(session_id.encode()).hexdigest()}.pt"
+
+    def put(self, session_id: str, token_ids: List[int], layers: KVLayers):
+        """Store the KV state covering `token_ids` for a session, replacing any older one."""
+        entry = _SessionEntry(token_ids=list(token_ids), layers=layers, nbytes=_layers_nbytes(layers))
+        with self._lock:
+            self._drop_locked(session_id)
+            if entry.nbytes > self.ram_budget_bytes:
+                logger.info(f"[SESSION KV] Session {session_id} KV ({entry.nbytes} bytes) exceeds RAM budget, not stored")
+                return
+            self._ram[session_id] = entry
+            self._ram_bytes += entry.nbytes
+            self._enforce_budgets_locked()
+
+    def match(self, session_id: str, token_ids: List[int]) -> Tuple[int, Optional[KVLayers]]:
+        """Return the stored KV state for the longest common prefix with `token_ids`.
+
+        Returns:
+            (matched_length, kv_layers); kv_layers is None on a miss
+        """
+        with self._lock:
+            entry = self._ram.get(session_id)
+            from_disk = False
+            if entry is None:
+                entry = self._disk.get(session_id)
+                from_disk = entry is not None
+            if entry is None:
+                self._stats["misses"] += 1
+                return 0, None
+
+            matched = 0
+            limit = min(len(entry.token_ids), len(token_ids))
+            while matched < limit and entry.token_ids[matched] == token_ids[matched]:
+                matched += 1
+
+            if matched < self.min_match_tokens:
+                self._stats["misses"] += 1
+                return 0, None
+
+            if from_disk:
+                self._load_locked(session_id, entry)
+                self._stats["disk_hits"] += 1
+            else:
+                self._ram.move_to_end(session_id)
+                self._stats["ram_hits"] += 1
+
+            entry.last_access = time.monotonic()
+            self._stats["hit_tokens"] += matched
+            return matched, [(k[:, :, :matched], v[:, :, :matched]) for k, v in entry.layers]
+
+    def drop(self, session_id: str):
+        """Forget a session (e.g. when it is deleted)."""
+        with self._lock:
+            self._drop_locked(session_id)
+
+    def spill_idle(self):
+        """Move RAM entries that have not been used recently to disk."""
+        now = time.monotonic()
+        with self._lock:
+            for session_id in [
+                sid for sid, entry in self._ram.items()
+                if now - entry.last_access > self.idle_spill_s
+            ]:
+                self._spill_locked(session_id)
+            self._enforce_budgets_locked()
+
+    def clear(self):
+        """Drop every entry from both tiers."""
+        with self._lock:
+            for session_id in list(self._ram) + list(self._disk):
+                self._drop_locked(session_id)
+        logger.info("[SESSION KV] Cleared")
+
+    def get_stats(self) -> Dict[str, float]:
+        """Return tier sizes and hit counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["ram_sessions"] = len(self._ram)
+            stats["disk_sessions"] = len(self._disk)
+            stats["ram_mb"] = round(self._ram_bytes / (1024 * 1024), 1)
+            stats["disk_mb"] = round(self._disk_bytes / (1024 * 1024), 1)
+            return stats
+
+    def _drop_locked(self, session_id: str):
+        entry = self._ram.pop(session_id, None)
+        if entry is not None:
+            self._ram_bytes -= entry.nbytes
+        entry = self._disk.pop(session_id, None)
+        if entry is not None:
+            self._disk_bytes -= entry.nbytes
+            self._disk_path(session_id).unlink(missing_ok=True)
+
+    def _enforce_budgets_locked(self):
+        while self._ram_bytes > self.ram_budget_bytes and self._ram:
+            self._spill_locked(next(iter(self._ram)))
+        while self._disk_bytes > self.disk_budget_bytes and self._disk:
+            session_id = next(iter(self._disk))
+            entry = self._disk.pop(session_id)
+            self._disk_bytes -= entry.nbytes
+            self._disk_path(session_id).unlink(missing_ok=True)
+            self._stats["evictions"] += 1
+
+    def _spill_locked(self, session_id: str):
+        """Move one entry from RAM to disk (or drop it if the disk tier is disabled)."""
+        entry = self._ram.pop(session_id)
+        self._ram_bytes -= entry.nbytes
+
+        if self.disk_budget_bytes <= 0 or entry.nbytes > self.disk_budget_bytes:
+            self._stats["evictions"] += 1
+            return
+
+        try:
+            torch.save(
+                {"token_ids": entry.token_ids, "layers": [(k.cpu(), v.cpu()) for k, v in entry.layers]},
+                self._disk_path(session_id)
+            )
+        except Exception as e:
+            logger.warning(f"[SESSION KV] Failed to spill session {session_id}: {e}")
+            self._stats["evictions"] += 1
+            return
+
+        entry.layers = None
+        self._disk[session_id] = entry
+        self._disk_bytes += entry.nbytes
+        self._stats["spills"] += 1
+
+    def _load_locked(self, session_id: str, entry: _SessionEntry):
+        """Promote a spilled entry back into RAM."""
+        data = torch.load(self._disk_path(session_id), map_location=self.device, weights_only=True)
+        entry.layers = [(k, v) for k, v in data["layers"]]
+
+        self._disk.pop(session_id)
+        self._disk_bytes -= entry.nbytes
+        self._disk_path(session_id).unlink(missing_ok=True)
+
+        self._ram[session_id] = entry
+        self._ram_bytes += entry.nbytes
+        self._enforce_budgets_locked()
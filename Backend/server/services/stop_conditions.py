@@ -0,0 +1,154 @@
+"""Text-based stopping conditions for generation.
+
+With tools in the prompt the model answers with a call such as
+`tool_code{"tool": "multiply", "args": {"numbers": [18.7, 0.015]}}`. The client
+runs the tool and sends a new request with the result, so every token decoded
+after the call is wasted (and usually filler). `StopCondition` watches the
+decoded text and reports when a complete, balanced `tool_code{...}` block has
+been emitted, or when the text contains one of the request's stop sequences.
+
+It only sees text deltas, so it works the same for every decode path (batch
+steps, speculative runs, compiled runs). The token that completes the match is
+kept in the output; nothing after it is generated.
+
+`RepetitionDetector` works on token ids instead and ends replies that have
+fallen into a loop.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+TOOL_CALL_PREFIX = "tool_code"
+
+
+class ToolCallDetector:
+    """Incremental scanner for a complete `tool_code{...}` block.
+
+    Brace counting skips braces inside JSON strings, the same way the client
+    extracts the call.
+    """
+
+    def __init__(self):
+        self._tail = ""  # recent text, to find the prefix across deltas
+        self._in_call = False  # prefix seen, waiting for / inside the JSON object
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text: str) -> bool:
+        """Scan a text delta; True once a tool call's JSON object is closed."""
+        for char in text:
+            if not self._in_call:
+                self._tail = (self._tail + char)[-len(TOOL_CALL_PREFIX):]
+                if self._tail == TOOL_CALL_PREFIX:
+                    self._in_call = True
+                    self._depth = 0
+                continue
+
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                elif not char.isspace():
+                    # "tool_code" mentioned in prose, not followed by a call
+                    self._in_call = False
+                    self._tail = char
+                continue
+
+            if self._escape:
+                self._escape = False
+            elif self._in_string:
+                if char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    return True
+        return False
+
+
+class StopCondition:
+    """Per-request stop check over decoded text deltas."""
+
+    def __init__(self, stop_sequences: Optional[List[str]] = None, stop_on_tool_call: bool = False):
+        """
+        Args:
+            stop_sequences: Stop as soon as the generated text contains any of these
+            stop_on_tool_call: Stop after the first complete `tool_code{...}` block
+        """
+        self.stop_sequences = [s for s in (stop_sequences or []) if s]
+        self.tool_call = ToolCallDetector() if stop_on_tool_call else None
+        self._window = max((len(s) for s in self.stop_sequences), default=1) - 1
+        self._tail = ""
+
+    def __bool__(self) -> bool:
+        return bool(self.stop_sequences) or self.tool_call is not None
+
+    def feed(self, text: str) -> Optional[str]:
+        """Scan a text delta and return the stop reason ("stop_sequence" or "tool_call"), if any."""
+        if not text:
+            return None
+        if self.stop_sequences:
+            # Keep just enough earlier text to match a stop sequence split across deltas
+            buffer = self._tail + text
+            if any(s in buffer for s in self.stop_sequences):
+                return "stop_sequence"
+            self._tail = buffer[-self._window:] if self._window else ""
+        if self.tool_call is not None and self.tool_call.feed(text):
+            return "tool_call"
+        return None
+
+
+class RepetitionDetector:
+    """Online n-gram tracker that flags degenerate repetition loops.
+
+    Greedy decoding on a small model sometimes repeats the same bullet or
+    sentence until `max_new_tokens`. A span of `ngram_tokens` token ids counts as
+    repeated only while it recurs back to back: each new occurrence must follow
+    the previous one at the same distance, with the same tokens in between. Once
+    that run reaches `max_repeats` occurrences the output is treated as a loop.
+    A phrase that recurs with other text in between, such as "within normal
+    limits" on each row of a lab table, never forms such a run.
+    """
+
+    def __init__(self, ngram_tokens: int = 12, max_repeats: int = 4):
+        """
+        Args:
+            ngram_tokens: Length of the token spans that are compared
+            max_repeats: Back-to-back occurrences of one span that end generation
+        """
+        self.ngram_tokens = ngram_tokens
+        self.max_repeats = max_repeats
+        self.repeated: Optional[Tuple[int, ...]] = None
+        self._token_ids: List[int] = []
+        # n-gram -> (end position of its last occurrence, distance to the one before, run length)
+        self._runs: Dict[Tuple[int, ...], Tuple[int, int, int]] = {}
+
+    def add(self, token_id: int) -> bool:
+        """Record a generated token; True once some span has repeated `max_repeats` times in a row."""
+        self._token_ids.append(token_id)
+        end = len(self._token_ids)
+        if end < self.ngram_tokens:
+            return False
+        ngram = tuple(self._token_ids[-self.ngram_tokens:])
+        previous = self._runs.get(ngram)
+        if previous is None:
+            run = (end, 0, 1)
+        else:
+            last_end, last_period, length = previous
+            period = end - last_end
+            ids = self._token_ids
+            # The run continues only if the tokens since the last occurrence repeat the previous period
+            if period == last_period and ids[last_end:end] == ids[last_end - period:last_end]:
+                run = (end, period, length + 1)
+            else:
+                run = (end, period, 2)
+        self._runs[ngram] = run
+        if run[2] >= self.max_repeats:
+            self.repeated = ngram
+            return True
+        return False
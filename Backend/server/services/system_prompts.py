@@ -5,7 +5,7 @@ Prompts are organized by domain and mode in the prompts/ directory.
 """
 
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict, List
 import logging
 from functools import lru_cache
 
@@ -14,6 +14,9 @@ logger = logging.getLogger(__name__)
 # Path to prompts directory
 PROMPTS_DIR = Path(__file__).parent.parent / "prompts"
 
+# Callbacks run by clear_prompt_cache (caches derived from the loaded prompts)
+_clear_callbacks: List[Callable[[], None]] = []
+
 
 @lru_cache(maxsize=128)
 def get_system_prompt(domain: str, mode: str) -> str:
@@ -107,9 +110,21 @@ def clear_prompt_cache():
     """Clear the LRU cache. Useful for hot-reloading prompts in development."""
     get_system_prompt.cache_clear()
     get_tool_usage_instructions.cache_clear()
+    for callback in _clear_callbacks:
+        callback()
     logger.info("Prompt cache cleared")
 
 
+def on_prompt_cache_clear(callback: Callable[[], None]):
+    """
+    Register a callback to run whenever the prompt cache is cleared.
+    
+    Args:
+        callback: Function invalidating state built from the old prompts
+    """
+    _clear_callbacks.append(callback)
+
+
 @lru_cache(maxsize=1)
 def get_tool_usage_instructions() -> str:
     """
@@ -0,0 +1,170 @@
+"""Content-addressed cache for image preprocessing and vision embeddings.
+
+Follow-up questions about the same image (an uploaded file or a DICOM slice PNG)
+would otherwise decode the file, run the image processor and run the SigLIP
+vision encoder again on every turn. Entries are keyed by the SHA-256 of the file
+contents, so the same image is found regardless of its path, and hold:
+
+- `pixel_values`: the processor output, stored when the image is first prepared
+- `image_features`: the projected image embeddings, stored after the first prefill
+
+RAM entries are evicted least-recently-used under a byte budget. With the disk
+tier enabled, evicted entries are kept as files and promoted back on access.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class VisionCacheEntry:
+    """Cached preprocessing/encoding results for one image."""
+    pixel_values: Optional[torch.Tensor] = None
+    image_features: Optional[torch.Tensor] = None
+
+    @property
+    def nbytes(self) -> int:
+        total = 0
+        for tensor in (self.pixel_values, self.image_features):
+            if tensor is not None:
+                total += tensor.numel() * tensor.element_size()
+        return total
+
+
+class VisionEmbeddingCache:
+    """LRU cache of image tensors keyed by content hash."""
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None, device: Optional[torch.device] = None):
+        """
+        Args:
+            max_bytes: Memory budget for cached tensors
+            disk_dir: Directory for the optional disk tier (None disables it)
+            device: Device entries loaded from disk are moved to
+        """
+        self.max_bytes = max_bytes
+        self.device = device
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+        self._entries: "OrderedDict[str, VisionCacheEntry]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "feature_hits": 0,
+            "evictions": 0,
+        }
+
+    @staticmethod
+    def hash_file(image_path: str) -> str:
+        """Return the SHA-256 hex digest of a file's contents."""
+        digest = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _disk_path(self, digest: str) -> Path:
+        return self.disk_dir / f"{digest}.pt"
+
+    def get(self, digest: str) -> Optional[VisionCacheEntry]:
+        """Look up an image by content hash, promoting it from disk if needed."""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+                self._stats["hits"] += 1
+                if entry.image_features is not None:
+                    self._stats["feature_hits"] += 1
+                return entry
+
+            if self.disk_dir is not None and self._disk_path(digest).exists():
+                try:
+                    data = torch.load(self._disk_path(digest), map_location=self.device, weights_only=True)
+                    entry = VisionCacheEntry(data.get("pixel_values"), data.get("image_features"))
+                except Exception as e:
+                    logger.warning(f"[VISION CACHE] Failed to load {digest[:12]} from disk: {e}")
+                    self._stats["misses"] += 1
+                    return None
+                self._insert_locked(digest, entry)
+                self._stats["disk_hits"] += 1
+                if entry.image_features is not None:
+                    self._stats["feature_hits"] += 1
+                return entry
+
+            self._stats["misses"] += 1
+            return None
+
+    def put_pixel_values(self, digest: str, pixel_values: torch.Tensor):
+        """Store the processor output for an image."""
+        with self._lock:
+            entry = self._entries.pop(digest, None) or VisionCacheEntry()
+            if entry.nbytes:
+                self._total_bytes -= entry.nbytes
+            entry.pixel_values = pixel_values
+            self._insert_locked(digest, entry)
+
+    def put_features(self, digest: str, image_features: torch.Tensor):
+        """Store the projected vision embeddings for an image."""
+        with self._lock:
+            entry = self._entries.pop(digest, None) or VisionCacheEntry()
+            if entry.nbytes:
+                self._total_bytes -= entry.nbytes
+            entry.image_features = image_features
+            self._insert_locked(digest, entry)
+
+    def _insert_locked(self, digest: str, entry: VisionCacheEntry):
+        self._entries[digest] = entry
+        self._total_bytes += entry.nbytes
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            victim_digest, victim = self._entries.popitem(last=False)
+            self._total_bytes -= victim.nbytes
+            self._stats["evictions"] += 1
+            self._spill(victim_digest, victim)
+
+    def _spill(self, digest: str, entry: VisionCacheEntry):
+        """Write an evicted entry to the disk tier, if enabled."""
+        if self.disk_dir is None:
+            return
+        try:
+            torch.save(
+                {
+                    "pixel_values": entry.pixel_values.cpu() if entry.pixel_values is not None else None,
+                    "image_features": entry.image_features.cpu() if entry.image_features is not None else None,
+                },
+                self._disk_path(digest)
+            )
+        except Exception as e:
+            logger.warning(f"[VISION CACHE] Failed to spill {digest[:12]} to disk: {e}")
+
+    def clear(self):
+        """Drop all cached entries, including the disk tier."""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            if self.disk_dir is not None:
+                for path in self.disk_dir.glob("*.pt"):
+                    path.unlink(missing_ok=True)
+        logger.info("[VISION CACHE] Cleared")
+
+    def get_stats(self) -> Dict[str, float]:
+        """Return hit/miss and memory counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+            stats["entries"] = len(self._entries)
+            stats["memory_mb"] = round(self._total_bytes / (1024 * 1024), 1)
+            return stats
@@ -0,0 +1,542 @@
+"""Multi-replica inference worker pool.
+
+A single `MedGemmaService` cannot use a large CPU server: one process runs one
+decode batch on one set of intra-op threads, and a long summarize request slows
+everyone else down. With `inference_replicas > 1` the API process does not load
+the model itself. Instead it starts one worker process per replica. Each worker
+pins itself to its own cores, sets its own torch thread count and runs a full
+`MedGemmaService` (scheduler, caches and all).
+
+`ReplicaWorkerPool` exposes the same interface the routes use on
+`MedGemmaService` and dispatches each request to the least-loaded replica.
+Requests of a session prefer the replica that served the session before, so its
+KV state can be reused, unless that replica is clearly busier than the others.
+
+Messages between the processes are plain tuples on multiprocessing queues:
+
+- to a worker: ("generate", request_id, kwargs, stream), ("cancel", request_id),
+  ("forget_session", session_id), ("clear_prompt_cache",), ("stats", token), ("stop",)
+- from a worker: ("ready", replica), ("failed", replica, message),
+  ("chunk", request_id, text), ("done", request_id, text, token_ids, stop_reason),
+  ("error", request_id, message, cancelled), ("stats", token, replica, stats)
+"""
+
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+import logging
+
+from server.api.schemas.request import ChatDomain, ChatMode
+from server.services.model_readiness import ModelReadiness, ModelState
+
+logger = logging.getLogger(__name__)
+
+# Default maximum tokens for generation (mirrors medgemma.DEFAULT_MAX_TOKENS)
+DEFAULT_MAX_TOKENS = 1024
+
+# A session stays on its replica unless that replica has this many more requests in flight
+SESSION_AFFINITY_SLACK = 2
+
+
+def replica_core_sets(num_replicas: int, threads_per_replica: int) -> List[List[int]]:
+    """Split the cores this process may run on into one disjoint set per replica."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if threads_per_replica <= 0:
+        threads_per_replica = max(len(cores) // num_replicas, 1)
+
+    core_sets = []
+    for i in range(num_replicas):
+        start = (i * threads_per_replica) % len(cores)
+        core_sets.append([cores[(start + j) % len(cores)] for j in range(threads_per_replica)])
+    return core_sets
+
+
+def _replica_main(index: int, cores: List[int], pin_cores: bool, inbox, outbox):
+    """Worker process entry point: load a replica and serve requests from `inbox`."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - replica{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    if pin_cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    from transformers.generation.streamers import BaseStreamer
+    from server.services.medgemma import create_service, GenerationCancelled, IncrementalDetokenizer
+    from server.services.system_prompts import clear_prompt_cache
+
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    class ReplicaStreamer(BaseStreamer):
+        """Sends text deltas of one request back to the API process."""
+
+        def __init__(self, tokenizer, request_id: str):
+            self.detokenizer = IncrementalDetokenizer(tokenizer)
+            self.request_id = request_id
+            self._next_tokens_are_prompt = True
+
+        def put(self, value):
+            if self._next_tokens_are_prompt:
+                self._next_tokens_are_prompt = False
+                return
+            text = self.detokenizer.add(value.reshape(-1).tolist())
+            if text:
+                outbox.put(("chunk", self.request_id, text))
+
+        def end(self):
+            text = self.detokenizer.flush()
+            if text:
+                outbox.put(("chunk", self.request_id, text))
+
+    service = create_service()
+    try:
+        service.load_model()
+    except Exception as e:
+        logger.error(f"[REPLICA {index}] Failed to load model: {e}", exc_info=True)
+        outbox.put(("failed", index, str(e)))
+        return
+    outbox.put(("ready", index))
+    logger.info(f"[REPLICA {index}] Ready on cores {cores} ({torch.get_num_threads()} threads)")
+
+    def run(request_id: str, kwargs: Dict[str, Any], stream: bool):
+        streamer = ReplicaStreamer(service.processor.tokenizer, request_id) if stream else None
+        try:
+            result = service.generate(**kwargs, streamer=streamer, request_id=request_id)
+            outbox.put(("done", request_id, result.text, result.token_ids, result.stop_reason))
+        except GenerationCancelled as e:
+            outbox.put(("error", request_id, str(e), True))
+        except Exception as e:
+            logger.error(f"[REPLICA {index}] Generation failed for {request_id}: {e}", exc_info=True)
+            outbox.put(("error", request_id, str(e), False))
+
+    while True:
+        message = inbox.get()
+        kind = message[0]
+        if kind == "stop":
+            break
+        if kind == "generate":
+            # Registered here, so a cancel read before the thread starts generating is not lost
+            service.register_request(message[1])
+            # The replica's scheduler batches concurrent requests; each caller just waits
+            threading.Thread(target=run, args=message[1:], daemon=True).start()
+        elif kind == "cancel":
+            service.cancel(message[1])
+        elif kind == "forget_session":
+            service.forget_session(message[1])
+        elif kind == "clear_prompt_cache":
+            # Also drops the replica's cached replies built from the old prompts
+            clear_prompt_cache()
+        elif kind == "stats":
+            outbox.put(("stats", message[1], index, service.get_stats()))
+
+    service.shutdown()
+
+
+class _Replica:
+    """API-process handle on one worker process."""
+
+    def __init__(self, index: int, cores: List[int]):
+        self.index = index
+        self.cores = cores
+        self.inbox = None
+        self.process = None
+        self.ready = False
+        self.in_flight = 0
+        self.dispatched = 0
+
+
+class _PendingCall:
+    """A request dispatched to a replica, completed by the pool's reader thread."""
+
+    def __init__(self, replica: _Replica, on_chunk: Optional[Callable[[Optional[str]], None]] = None):
+        self.replica = replica
+        self.on_chunk = on_chunk
+        self.result = None  # GenerationResult
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class ReplicaWorkerPool:
+    """Dispatches generation requests to N model replicas in worker processes."""
+
+    def __init__(self, num_replicas: int, threads_per_replica: int = 0, pin_cores: bool = True):
+        """
+        Args:
+            num_replicas: Number of worker processes, each with its own model copy
+            threads_per_replica: torch intra-op threads (and pinned cores) per replica; 0 splits the cores evenly
+            pin_cores: Pin each replica to its own cores (Linux only)
+        """
+        self.num_replicas = num_replicas
+        self.pin_cores = pin_cores
+        self.replicas = [
+            _Replica(i, cores) for i, cores in enumerate(replica_core_sets(num_replicas, threads_per_replica))
+        ]
+        self.model_loaded = False
+
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = None
+        self._reader: Optional[threading.Thread] = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _PendingCall] = {}
+        self._stats_replies: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        self._stats_cond = threading.Condition(self._lock)
+        self._session_replica: "OrderedDict[str, int]" = OrderedDict()
+        self._ready_cond = threading.Condition(self._lock)
+        self._failure: Optional[str] = None
+        self.readiness = ModelReadiness()
+        self._load_lock = threading.Lock()
+
+    def start_background_load(self) -> bool:
+        """Start the replicas on a background thread; progress is in `readiness`."""
+        return self.readiness.load_in_background(self.load_model, "medgemma-pool-loader")
+
+    def load_model(self):
+        """Start the worker processes and wait until every replica has loaded its model."""
+        with self._load_lock:
+            if self.model_loaded:
+                return
+            self.readiness.set(ModelState.LOADING, f"starting {self.num_replicas} replicas")
+            try:
+                self._load_model()
+            except BaseException as e:
+                self.readiness.fail(e)
+                raise
+            self.readiness.set(ModelState.READY)
+
+    def _load_model(self):
+        self._failure = None
+        print(f"Starting {self.num_replicas} MedGemma replicas...")
+        t0 = time.time()
+        self._outbox = self._context.Queue()
+        self._running = True
+        for replica in self.replicas:
+            replica.inbox = self._context.Queue()
+            replica.process = self._context.Process(
+                target=_replica_main,
+                args=(replica.index, replica.cores, self.pin_cores, replica.inbox, self._outbox),
+                name=f"medgemma-replica-{replica.index}",
+                daemon=True
+            )
+            replica.process.start()
+            print(f"  Replica {replica.index}: pid {replica.process.pid}, cores {replica.cores}")
+
+        self._reader = threading.Thread(target=self._read_loop, name="medgemma-pool-reader", daemon=True)
+        self._reader.start()
+
+        with self._lock:
+            reported = -1
+            while self._failure is None and not all(r.ready for r in self.replicas):
+                num_ready = sum(r.ready for r in self.replicas)
+                if num_ready != reported:
+                    reported = num_ready
+                    self.readiness.set(ModelState.LOADING, f"{num_ready}/{self.num_replicas} replicas ready")
+                self._ready_cond.wait(timeout=1.0)
+            failure = self._failure
+        if failure is not None:
+            self.shutdown()
+            raise RuntimeError(f"Replica failed to start: {failure}")
+
+        self.model_loaded = True
+        print(f"All {self.num_replicas} replicas loaded in {time.time()-t0:.1f}s")
+
+    def shutdown(self):
+        """Stop the worker processes and fail anything still in flight."""
+        self._running = False
+        for replica in self.replicas:
+            if replica.process is None:
+                continue
+            if replica.process.is_alive():
+                replica.inbox.put(("stop",))
+                replica.process.join(timeout=10)
+            if replica.process.is_alive():
+                replica.process.terminate()
+            replica.process = None
+            replica.ready = False
+        self._fail_calls(lambda call: True, RuntimeError("Inference worker pool stopped"))
+        self.model_loaded = False
+
+    def _read_loop(self):
+        while self._running:
+            try:
+                message = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                self._check_replicas()
+                continue
+            self._handle(message)
+
+    def _handle(self, message):
+        kind = message[0]
+        if kind == "chunk":
+            call = self._calls.get(message[1])
+            if call is not None and call.on_chunk is not None:
+                call.on_chunk(message[2])
+        elif kind in ("done", "error"):
+            with self._lock:
+                call = self._calls.pop(message[1], None)
+                if call is None:
+                    return
+                call.replica.in_flight -= 1
+            if kind == "done":
+                from server.services.medgemma import GenerationResult
+                call.result = GenerationResult(*message[2:])
+            else:
+                from server.services.medgemma import GenerationCancelled
+                call.error = GenerationCancelled(message[2]) if message[3] else RuntimeError(message[2])
+            self._complete(call)
+        elif kind == "stats":
+            with self._lock:
+                replies = self._stats_replies.get(message[1])
+                if replies is not None:
+                    replies[message[2]] = message[3]
+                    self._stats_cond.notify_all()
+        elif kind == "ready":
+            with self._lock:
+                self.replicas[message[1]].ready = True
+                self._ready_cond.notify_all()
+        elif kind == "failed":
+            with self._lock:
+                self._failure = f"replica {message[1]}: {message[2]}"
+                self._ready_cond.notify_all()
+
+    def _complete(self, call: _PendingCall):
+        call.done.set()
+        if call.on_chunk is not None:
+            call.on_chunk(None)
+
+    def _check_replicas(self):
+        """Fail the requests of any replica whose process died."""
+        for replica in self.replicas:
+            if replica.process is not None and not replica.process.is_alive():
+                logger.error(f"[POOL] Replica {replica.index} exited (code {replica.process.exitcode})")
+                replica.ready = False
+                with self._lock:
+                    if self._failure is None and not self.model_loaded:
+                        self._failure = f"replica {replica.index} exited"
+                        self._ready_cond.notify_all()
+                self._fail_calls(
+                    lambda call, r=replica: call.replica is r,
+                    RuntimeError(f"Inference replica {replica.index} exited")
+                )
+
+    def _fail_calls(self, predicate: Callable[[_PendingCall], bool], error: BaseException):
+        with self._lock:
+            failed = [rid for rid, call in self._calls.items() if predicate(call)]
+            calls = [self._calls.pop(rid) for rid in failed]
+            for call in calls:
+                call.replica.in_flight -= 1
+        for call in calls:
+            call.error = error
+            self._complete(call)
+
+    def _pick_replica(self, session_id: Optional[str]) -> _Replica:
+        """Least-loaded ready replica, preferring the session's previous replica."""
+        ready = [r for r in self.replicas if r.ready]
+        if not ready:
+            raise RuntimeError("No inference replica is available")
+        least = min(ready, key=lambda r: (r.in_flight, r.dispatched))
+
+        if session_id is not None and session_id in self._session_replica:
+            previous = self.replicas[self._session_replica[session_id]]
+            if previous.ready and previous.in_flight <= least.in_flight + SESSION_AFFINITY_SLACK:
+                return previous
+        return least
+
+    def _dispatch(
+        self,
+        kwargs: Dict[str, Any],
+        request_id: str,
+        stream: bool,
+        on_chunk: Optional[Callable[[Optional[str]], None]] = None
+    ) -> _PendingCall:
+        if not self.model_loaded:
+            self.load_model()
+
+        session_id = kwargs.get("session_id")
+        with self._lock:
+            replica = self._pick_replica(session_id)
+            call = _PendingCall(replica, on_chunk)
+            self._calls[request_id] = call
+            replica.in_flight += 1
+            replica.dispatched += 1
+            if session_id is not None:
+                self._session_replica[session_id] = replica.index
+                self._session_replica.move_to_end(session_id)
+                while len(self._session_replica) > 4096:
+                    self._session_replica.popitem(last=False)
+
+        logger.info(f"[POOL] {request_id} -> replica {replica.index} ({replica.in_flight} in flight)")
+        replica.inbox.put(("generate", request_id, kwargs, stream))
+        return call
+
+    def generate_response(self, *args, **kwargs) -> str:
+        """Generate a response on one of the replicas and return its text (see `generate`)."""
+        return self.generate(*args, **kwargs).text
+
+    def generate(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, Any]] = None,
+        image_path: Optional[str] = None,
+        domain: ChatDomain = ChatDomain.GENERAL,
+        mode: ChatMode = ChatMode.CONSULT,
+        max_new_tokens: int = DEFAULT_MAX_TOKENS,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        session_id: Optional[str] = None,
+        prompt_lookup: Optional[bool] = None,
+        request_id: Optional[str] = None,
+        stop: Optional[List[str]] = None
+    ):
+        """Generate a response on one of the replicas (blocks until it is finished).
+
+        Returns:
+            The replica's `GenerationResult`
+        """
+        request_id = request_id or uuid.uuid4().hex
+        call = self._dispatch(
+            dict(
+                user_message=user_message,
+                conversation_history=conversation_history,
+                image_path=image_path,
+                domain=domain,
+                mode=mode,
+                max_new_tokens=max_new_tokens,
+                tools=tools,
+                session_id=session_id,
+                prompt_lookup=prompt_lookup,
+                stop=stop
+            ),
+            request_id,
+            stream=False
+        )
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def generate_response_stream(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, Any]] = None,
+        image_path: Optional[str] = None,
+        domain: ChatDomain = ChatDomain.GENERAL,
+        mode: ChatMode = ChatMode.CONSULT,
+        max_new_tokens: int = DEFAULT_MAX_TOKENS,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        session_id: Optional[str] = None,
+        prompt_lookup: Optional[bool] = None,
+        request_id: Optional[str] = None,
+        stop: Optional[List[str]] = None
+    ) -> AsyncIterator[str]:
+        """Stream a response from one of the replicas, chunked like `MedGemmaService`."""
+        from server.services.medgemma import split_stream_text
+
+        if not self.model_loaded:
+            await asyncio.to_thread(self.load_model)
+
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        request_id = request_id or uuid.uuid4().hex
+        call = self._dispatch(
+            dict(
+                user_message=user_message,
+                conversation_history=conversation_history,
+                image_path=image_path,
+                domain=domain,
+                mode=mode,
+                max_new_tokens=max_new_tokens,
+                tools=tools,
+                session_id=session_id,
+                prompt_lookup=prompt_lookup,
+                stop=stop
+            ),
+            request_id,
+            stream=True,
+            on_chunk=lambda text: loop.call_soon_threadsafe(chunks.put_nowait, text)
+        )
+
+        completed = False
+        try:
+            while True:
+                text = await chunks.get()
+                if text is None:
+                    break
+                for piece in split_stream_text(text):
+                    yield piece
+            completed = True
+        finally:
+            if not completed:
+                # Client went away: free the replica for the next request
+                self.cancel(request_id)
+
+        if call.error is not None:
+            raise call.error
+
+    def cancel(self, request_id: str) -> bool:
+        """Cancel an in-flight generation on whichever replica runs it."""
+        with self._lock:
+            call = self._calls.get(request_id)
+        if call is None:
+            return False
+        call.replica.inbox.put(("cancel", request_id))
+        return True
+
+    def forget_session(self, session_id: str):
+        """Drop a deleted session's KV state on every replica."""
+        with self._lock:
+            self._session_replica.pop(session_id, None)
+        for replica in self.replicas:
+            if replica.ready:
+                replica.inbox.put(("forget_session", session_id))
+
+    def clear_prompt_cache(self):
+        """Reload system prompts on every replica (each process caches its own)."""
+        for replica in self.replicas:
+            # A replica still loading reads the message once it is ready
+            if replica.inbox is not None:
+                replica.inbox.put(("clear_prompt_cache",))
+
+    def get_stats(self, timeout: float = 2.0) -> Dict[str, Any]:
+        """Collect generation counters from every replica plus dispatcher load."""
+        token = uuid.uuid4().hex
+        ready = [r for r in self.replicas if r.ready]
+        with self._lock:
+            self._stats_replies[token] = {}
+        for replica in ready:
+            replica.inbox.put(("stats", token))
+
+        deadline = time.time() + timeout
+        with self._lock:
+            while len(self._stats_replies[token]) < len(ready) and time.time() < deadline:
+                self._stats_cond.wait(timeout=deadline - time.time())
+            replies = self._stats_replies.pop(token)
+
+        return {
+            "model_loaded": self.model_loaded,
+            "readiness": self.readiness.get_status(),
+            "replicas": [
+                {
+                    "replica": r.index,
+                    "pid": r.process.pid if r.process is not None else None,
+                    "cores": r.cores,
+                    "ready": r.ready,
+                    "in_flight": r.in_flight,
+                    "dispatched": r.dispatched,
+                    "stats": replies.get(r.index),
+                }
+                for r in self.replicas
+            ],
+        }
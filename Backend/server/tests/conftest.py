@@ -0,0 +1,41 @@
+"""Shared fixtures for the server tests."""
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def tiny_gemma3():
+    """A randomly initialised two-layer Gemma 3 (one sliding, one full attention layer) with a tiny vision tower."""
+    import torch
+    from transformers import Gemma3Config, Gemma3ForConditionalGeneration
+
+    torch.manual_seed(0)
+    config = Gemma3Config(
+        text_config=dict(
+            vocab_size=128,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            num_key_value_heads=1,
+            head_dim=16,
+            sliding_window=8,
+            layer_types=["sliding_attention", "full_attention"],
+            max_position_embeddings=256,
+        ),
+        vision_config=dict(
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=1,
+            num_attention_heads=2,
+            image_size=28,
+            patch_size=7,
+        ),
+        mm_tokens_per_image=4,
+        boi_token_index=125,
+        eoi_token_index=126,
+        image_token_index=127,
+        eos_token_id=1,
+        pad_token_id=0,
+    )
+    return Gemma3ForConditionalGeneration(config).eval()
@@ -0,0 +1,103 @@
+"""Unit tests for batch generation jobs."""
+
+import asyncio
+import json
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from server.db.database import Base
+from server.services import batch_jobs as batch_jobs_module
+from server.services.batch_jobs import BatchJobManager
+from server.services.medgemma import GenerationResult
+from server.services.model_readiness import ModelReadiness, ModelState
+
+
+class FakeService:
+    """Generates "reply to <message>" and fails on the message "boom"."""
+
+    def __init__(self):
+        self.readiness = ModelReadiness()
+        self.readiness.set(ModelState.READY)
+        self.messages = []
+
+    def generate(self, user_message, **kwargs):
+        self.messages.append(user_message)
+        if user_message == "boom":
+            raise RuntimeError("generation failed")
+        return GenerationResult(f"reply to {user_message}", [1, 2, 3], "eos")
+
+    def cancel(self, request_id):
+        return False
+
+
+class FakeQueue:
+    """Admits every request at once."""
+
+    class Slot:
+        def release(self):
+            pass
+
+    async def acquire(self, priority):
+        return self.Slot()
+
+
+@pytest.fixture
+def session_factory(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'batch.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(batch_jobs_module, "SessionLocal", factory)
+    return factory
+
+
+async def run_until_finished(manager, db, job_id):
+    """Run the manager until the job is completed, then stop it."""
+    manager.start()
+    for _ in range(500):
+        db.expire_all()
+        if manager.get_job(db, job_id).status == "completed":
+            break
+        await asyncio.sleep(0.01)
+    await manager.stop()
+
+
+def test_job_results_are_persisted_per_item(session_factory):
+    """Test that every item gets its result or error, downloadable in submission order."""
+    db = session_factory()
+    manager = BatchJobManager(FakeService(), FakeQueue(), concurrency=2)
+
+    async def run():
+        job = manager.create_job(db, [{"message": "a", "custom_id": "ws-1"}, {"message": "boom"}, {"message": "c"}])
+        await run_until_finished(manager, db, job.id)
+        return job.id
+
+    job_id = asyncio.run(run())
+    assert manager.get_job(db, job_id).status == "completed"
+    counts = manager.item_counts(db, job_id)
+    assert counts["done"] == 2 and counts["failed"] == 1
+
+    lines = [json.loads(line) for line in manager.iter_results(job_id)]
+    assert [line["index"] for line in lines] == [0, 1, 2]
+    assert lines[0]["custom_id"] == "ws-1"
+    assert lines[0]["response"] == "reply to a" and lines[0]["finish_reason"] == "eos"
+    assert lines[1]["status"] == "failed" and "generation failed" in lines[1]["error"]
+    db.close()
+
+
+def test_interrupted_items_resume_after_restart(session_factory):
+    """Test that items left generating by a restart run again and finished ones do not."""
+    db = session_factory()
+    service = FakeService()
+    manager = BatchJobManager(service, FakeQueue(), concurrency=1)
+    job = manager.create_job(db, [{"message": "a"}, {"message": "b"}])
+    job.status = "running"
+    job.items[0].status = "done"
+    job.items[0].response = "reply to a"
+    job.items[1].status = "running"
+    db.commit()
+
+    asyncio.run(run_until_finished(manager, db, job.id))
+    assert service.messages == ["b"]
+    assert manager.item_counts(db, job.id)["done"] == 2
+    db.close()
@@ -0,0 +1,69 @@
+"""Unit tests for the generation admission queue."""
+
+import asyncio
+import pytest
+from server.services.generation_queue import GenerationQueue, Priority, QueueFull, QueueTimeout
+
+
+def make_queue(slots=1, max_depth=2, max_wait_s=0.0):
+    return GenerationQueue(
+        slots=slots,
+        max_depth={priority: max_depth for priority in Priority},
+        max_wait_s={priority: max_wait_s for priority in Priority},
+        initial_service_s=4.0
+    )
+
+
+def test_waiters_are_served_by_priority():
+    """Test that a freed slot goes to the highest-priority waiter, FIFO within a priority."""
+    async def run():
+        queue = make_queue()
+        running = await queue.acquire(Priority.INTERACTIVE)
+        order = []
+
+        async def wait(priority, name):
+            slot = await queue.acquire(priority)
+            order.append(name)
+            slot.release()
+
+        tasks = [
+            asyncio.ensure_future(wait(Priority.BATCH, "batch")),
+            asyncio.ensure_future(wait(Priority.SUMMARIZE, "summarize")),
+            asyncio.ensure_future(wait(Priority.INTERACTIVE, "chat")),
+        ]
+        await asyncio.sleep(0)
+        running.release()
+        await asyncio.gather(*tasks)
+        return order, queue.get_stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ["chat", "summarize", "batch"]
+    assert stats["in_use"] == 0
+    assert stats["priorities"]["batch"]["admitted"] == 1
+
+
+def test_rejects_full_queue_and_times_out_waiters():
+    """Test 429-style rejection at max depth and 503-style timeout with a Retry-After estimate."""
+    async def run():
+        queue = make_queue(max_depth=1, max_wait_s=0.05)
+        running = await queue.acquire(Priority.INTERACTIVE)
+        waiter = asyncio.ensure_future(queue.acquire(Priority.INTERACTIVE))
+        await asyncio.sleep(0)
+
+        with pytest.raises(QueueFull) as full:
+            await queue.acquire(Priority.INTERACTIVE)
+        # One waiter ahead plus this request, 4s each on one slot
+        assert full.value.retry_after_s == 8
+
+        with pytest.raises(QueueTimeout):
+            await waiter
+        running.release()
+        running.release()  # idempotent
+        return queue.get_stats()
+
+    stats = asyncio.run(run())
+    interactive = stats["priorities"]["interactive"]
+    assert interactive["rejected_full"] == 1
+    assert interactive["timed_out"] == 1
+    assert interactive["depth"] == 0
+    assert stats["in_use"] == 0
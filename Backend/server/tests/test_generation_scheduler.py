@@ -0,0 +1,178 @@
+"""Tests for the continuous-batching generation scheduler on a tiny random Gemma 3."""
+
+import pytest
+import torch
+
+from server.services.medgemma import GenerationScheduler, GenerationRequest, GenerationCancelled
+
+PROMPTS = [
+    [2, 5, 6, 7, 8],
+    [2, 9, 10],
+    [2, 11, 12, 13, 14, 15, 16, 17, 18, 19],
+]
+MAX_NEW_TOKENS = 12
+
+
+def make_request(prompt, max_new_tokens=MAX_NEW_TOKENS, **kwargs):
+    input_ids = torch.tensor([prompt])
+    return GenerationRequest(
+        inputs={"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)},
+        max_new_tokens=max_new_tokens,
+        **kwargs
+    )
+
+
+def greedy(model, prompt):
+    input_ids = torch.tensor([prompt])
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            do_sample=False,
+            max_new_tokens=MAX_NEW_TOKENS
+        )
+    return output[0, len(prompt):].tolist()
+
+
+def step(scheduler):
+    """One scheduler iteration, as the loop thread runs it."""
+    scheduler._admit()
+    if scheduler._active:
+        scheduler._decode_step()
+
+
+@pytest.fixture
+def scheduler(tiny_gemma3):
+    """A scheduler driven step by step from the test (no loop thread)."""
+    scheduler = GenerationScheduler(tiny_gemma3, eos_token_ids=[1], max_batch_size=4)
+    scheduler._running = True
+    return scheduler
+
+
+class FailingStreamer:
+    """Raises on the third decoded token."""
+
+    def __init__(self):
+        self.tokens = 0
+
+    def put(self, value):
+        if value.dim() == 1:
+            self.tokens += 1
+            if self.tokens == 3:
+                raise RuntimeError("client write failed")
+
+    def end(self):
+        pass
+
+
+def test_batched_output_matches_greedy(tiny_gemma3):
+    """Test that sequences decoded together get exactly their own greedy output."""
+    scheduler = GenerationScheduler(tiny_gemma3, eos_token_ids=[1], max_batch_size=4)
+    scheduler.start()
+    try:
+        requests = [scheduler.submit(make_request(prompt)) for prompt in PROMPTS]
+        outputs = [request.wait() for request in requests]
+    finally:
+        scheduler.stop()
+    assert outputs == [greedy(tiny_gemma3, prompt) for prompt in PROMPTS]
+
+
+def test_join_mid_decode_and_retire(scheduler, tiny_gemma3):
+    """Test that a request joining a running batch and one leaving it do not change the others' output."""
+    first = scheduler.submit(make_request(PROMPTS[0]))
+    short = scheduler.submit(make_request(PROMPTS[2], max_new_tokens=3))
+    for _ in range(4):
+        step(scheduler)
+    assert short.finished and short.output_ids == greedy(tiny_gemma3, PROMPTS[2])[:3]
+    assert len(scheduler._active) == 1 and scheduler._active[0] is first
+
+    late = scheduler.submit(make_request(PROMPTS[1]))
+    while not (first.finished and late.finished):
+        step(scheduler)
+    assert first.wait() == greedy(tiny_gemma3, PROMPTS[0])
+    assert late.wait() == greedy(tiny_gemma3, PROMPTS[1])
+    assert scheduler._active == [] and scheduler._batch_cache is None
+
+
+def test_cancel_drops_only_that_request(scheduler, tiny_gemma3):
+    """Test that a cancelled request ends with GenerationCancelled at the next step and the rest continue."""
+    keep = scheduler.submit(make_request(PROMPTS[0]))
+    drop = scheduler.submit(make_request(PROMPTS[1]))
+    step(scheduler)
+    scheduler.cancel(drop)
+    step(scheduler)
+    assert drop.finished and all(request is not drop for request in scheduler._active)
+    with pytest.raises(GenerationCancelled):
+        drop.wait()
+
+    while not keep.finished:
+        step(scheduler)
+    assert keep.wait() == greedy(tiny_gemma3, PROMPTS[0])
+
+
+def test_failing_request_does_not_stall_the_others(tiny_gemma3):
+    """Test that a request whose streamer raises fails alone and the scheduler keeps serving."""
+    scheduler = GenerationScheduler(tiny_gemma3, eos_token_ids=[1], max_batch_size=4)
+    scheduler.start()
+    try:
+        failing = scheduler.submit(make_request(PROMPTS[0], streamer=FailingStreamer()))
+        other = scheduler.submit(make_request(PROMPTS[1]))
+        with pytest.raises(RuntimeError, match="client write failed"):
+            failing.wait()
+        assert other.wait() == greedy(tiny_gemma3, PROMPTS[1])
+
+        later = scheduler.submit(make_request(PROMPTS[2]))
+        assert later.wait() == greedy(tiny_gemma3, PROMPTS[2])
+        assert scheduler._thread.is_alive()
+    finally:
+        scheduler.stop()
+
+
+def test_failing_iteration_fails_in_flight_requests_and_keeps_looping(tiny_gemma3, monkeypatch):
+    """Test that an error outside the model forward fails the batch, not the scheduler thread."""
+    scheduler = GenerationScheduler(tiny_gemma3, eos_token_ids=[1], max_batch_size=4)
+    original = scheduler._retire_finished
+    calls = {"n": 0}
+
+    def flaky_retire():
+        calls["n"] += 1
+        if calls["n"] == 2:
+            raise MemoryError("cannot allocate batch cache")
+        original()
+
+    monkeypatch.setattr(scheduler, "_retire_finished", flaky_retire)
+    scheduler.start()
+    try:
+        # Queue both before the loop can admit either, so both are in the failing batch
+        with scheduler._cond:
+            requests = [scheduler.submit(make_request(prompt)) for prompt in PROMPTS[:2]]
+        for request in requests:
+            with pytest.raises(MemoryError):
+                request.wait()
+
+        later = scheduler.submit(make_request(PROMPTS[2]))
+        assert later.wait() == greedy(tiny_gemma3, PROMPTS[2])
+        assert scheduler._thread.is_alive()
+    finally:
+        scheduler.stop()
+
+
+def test_paged_kv_batch_matches_greedy(tiny_gemma3):
+    """Test that decoding from the KV block pool gives the same output as the padded batch cache."""
+    from server.services.kv_block_pool import KVBlockPool
+
+    text_config = tiny_gemma3.config.text_config
+    pool = KVBlockPool(
+        num_layers=text_config.num_hidden_layers,
+        num_kv_heads=text_config.num_key_value_heads,
+        head_dim=text_config.head_dim,
+        num_blocks=16,
+        block_size=4
+    )
+    scheduler = GenerationScheduler(tiny_gemma3, eos_token_ids=[1], max_batch_size=4, kv_pool=pool)
+    scheduler._running = True
+    requests = [scheduler.submit(make_request(prompt)) for prompt in PROMPTS]
+    while not all(request.finished for request in requests):
+        step(scheduler)
+    assert [request.wait() for request in requests] == [greedy(tiny_gemma3, prompt) for prompt in PROMPTS]
+    assert pool.free_blocks == 15
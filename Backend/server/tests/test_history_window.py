@@ -0,0 +1,70 @@
+"""Unit tests for token-budgeted history windowing."""
+
+from server.services.history_window import HistoryWindow, MESSAGE_OVERHEAD_TOKENS
+
+
+class WordTokenizer:
+    """Fake tokenizer: one token per whitespace-separated word."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text, add_special_tokens=False):
+        self.calls += 1
+        return {"input_ids": text.split()}
+
+
+def make_history(num_turns, words_per_message=10):
+    history = []
+    for i in range(num_turns):
+        history.append({"role": "user", "content": " ".join([f"q{i}"] * words_per_message)})
+        history.append({"role": "assistant", "content": " ".join([f"a{i}"] * words_per_message)})
+    return history
+
+
+def test_short_history_is_untouched():
+    """Test that history within budget is returned as is."""
+    window = HistoryWindow(WordTokenizer(), max_tokens=1000)
+    history = make_history(3)
+    assert window.fit(history) == history
+
+
+def test_trims_oldest_and_starts_with_user():
+    """Test that the oldest messages are dropped and the window starts on a user turn."""
+    per_message = 10 + MESSAGE_OVERHEAD_TOKENS
+    window = HistoryWindow(WordTokenizer(), max_tokens=per_message * 6, min_recent_messages=2, trim_ratio=0.75)
+    history = make_history(6)
+
+    kept = window.fit(history)
+    assert kept == history[-len(kept):]
+    assert kept[0]["role"] == "user"
+    assert sum(window.count_tokens(m) + MESSAGE_OVERHEAD_TOKENS for m in kept) <= per_message * 6
+
+
+def test_recent_messages_are_pinned():
+    """Test that the most recent messages are kept even over budget."""
+    window = HistoryWindow(WordTokenizer(), max_tokens=1, min_recent_messages=2)
+    history = make_history(4)
+    assert window.fit(history) == history[-2:]
+
+
+def test_window_start_is_stable_per_session():
+    """Test that the window start does not move while the session is under budget."""
+    per_message = 10 + MESSAGE_OVERHEAD_TOKENS
+    window = HistoryWindow(WordTokenizer(), max_tokens=per_message * 8, min_recent_messages=2, trim_ratio=0.5)
+    history = make_history(5)
+
+    first = window.fit(history, session_id="s1")
+    history += make_history(1)
+    second = window.fit(history, session_id="s1")
+    assert second[0] is first[0]
+
+
+def test_token_counts_are_cached():
+    """Test that each message is tokenized only once."""
+    tokenizer = WordTokenizer()
+    window = HistoryWindow(tokenizer, max_tokens=1000)
+    history = make_history(3)
+    window.fit(history)
+    window.fit(history)
+    assert tokenizer.calls == len(history)
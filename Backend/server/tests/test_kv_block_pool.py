@@ -0,0 +1,76 @@
+"""Unit tests for the paged KV block pool."""
+
+import pytest
+import torch
+from server.services.kv_block_pool import KVBlockPool, KVPoolExhausted
+
+
+def make_layers(token_ids, num_layers=2):
+    """Fake KV state shaped [1, heads=1, len, dim=1] whose values encode the token id."""
+    values = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1)
+    return [(values.clone(), values.clone() * 2) for _ in range(num_layers)]
+
+
+def make_pool(num_blocks=8, block_size=4):
+    return KVBlockPool(num_layers=2, num_kv_heads=1, head_dim=1, num_blocks=num_blocks, block_size=block_size)
+
+
+def test_gather_left_pads_sequences():
+    """Test that a batch gathers each sequence's KV with left padding and a matching mask."""
+    pool = make_pool()
+    a = pool.add_sequence([1, 2, 3, 4, 5, 6], make_layers([1, 2, 3, 4, 5, 6]), shareable_len=0)
+    b = pool.add_sequence([7, 8], make_layers([7, 8]), shareable_len=0)
+
+    layers, mask = pool.gather([a, b])
+    assert layers[0][0].shape == (2, 1, 6, 1)
+    assert layers[1][1][0].flatten().tolist() == [2, 4, 6, 8, 10, 12]
+    assert layers[0][0][1].flatten().tolist() == [0, 0, 0, 0, 7, 8]
+    assert mask.tolist() == [[1, 1, 1, 1, 1, 1], [0, 0, 0, 0, 1, 1]]
+
+
+def test_common_prefix_blocks_are_shared_and_refcounted():
+    """Test that full prefix blocks are shared and only freed with their last user."""
+    pool = make_pool()
+    a = pool.add_sequence([1, 2, 3, 4, 5], make_layers([1, 2, 3, 4, 5]), shareable_len=4)
+    b = pool.add_sequence([1, 2, 3, 4, 9], make_layers([1, 2, 3, 4, 9]), shareable_len=4)
+
+    assert a.blocks[0] == b.blocks[0]
+    assert a.blocks[1] != b.blocks[1]
+    stats = pool.get_stats()
+    assert stats["used_blocks"] == 3
+    assert stats["shared_blocks"] == 1
+
+    pool.free(a)
+    assert pool.get_stats()["used_blocks"] == 2
+    layers, _ = pool.gather([b])
+    assert layers[0][0].flatten().tolist() == [1, 2, 3, 4, 9]
+    pool.free(b)
+    assert pool.get_stats()["used_blocks"] == 0
+
+
+def test_append_slot_takes_blocks_until_exhausted():
+    """Test decode-time growth across block boundaries and exhaustion."""
+    pool = make_pool(num_blocks=3, block_size=2)
+    table = pool.add_sequence([1, 2], make_layers([1, 2]), shareable_len=0)
+    assert pool.blocks_needed_for_step([table]) == 1
+
+    slots = [pool.append_slot(table), pool.append_slot(table)]
+    pool.write(slots, [(torch.tensor([[[3.0], [4.0]]]), torch.tensor([[[6.0], [8.0]]]))] * 2)
+    layers, _ = pool.gather([table])
+    assert layers[1][0].flatten().tolist() == [1, 2, 3, 4]
+
+    with pytest.raises(KVPoolExhausted):
+        pool.append_slot(table)
+    assert not pool.can_allocate(1)
+
+
+def test_gathered_layers_are_not_copied_again_into_the_cache():
+    """Test that the decode cache adopts the gathered tensors instead of copying them."""
+    from server.services.medgemma import _rebuild_cache
+
+    pool = make_pool()
+    table = pool.add_sequence([1, 2, 3], make_layers([1, 2, 3]), shareable_len=0)
+    layers, _ = pool.gather([table])
+    cache = _rebuild_cache(layers)
+    assert [layer.keys.data_ptr() for layer in cache.layers] == [k.data_ptr() for k, _ in layers]
+    assert cache.get_seq_length() == 3
@@ -0,0 +1,44 @@
+"""Unit tests for the model readiness state machine."""
+
+import threading
+from server.services.model_readiness import ModelReadiness, ModelState
+
+
+def test_background_load_reaches_ready():
+    """Test that a background load runs once and waiters see it become ready."""
+    readiness = ModelReadiness()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        readiness.set(ModelState.LOADING, "loading weights")
+        readiness.set(ModelState.WARMING, "setting up caches")
+        release.wait()
+        readiness.set(ModelState.READY)
+
+    assert readiness.load_in_background(load, "test-loader")
+    assert not readiness.load_in_background(load, "test-loader")
+    assert not readiness.wait(0.05)
+    assert readiness.get_status()["state"] in ("loading", "warming")
+
+    release.set()
+    assert readiness.wait(5)
+    assert calls == [1]
+    status = readiness.get_status()
+    assert status["state"] == "ready" and status["elapsed_s"] >= 0
+
+
+def test_failed_load_can_be_retried():
+    """Test that a failure is reported with its error and a new load may start."""
+    readiness = ModelReadiness()
+    readiness.set(ModelState.LOADING, "loading weights")
+    readiness.fail(RuntimeError("out of memory"))
+    assert not readiness.wait(5)
+    assert readiness.get_status()["error"] == "out of memory"
+
+    done = threading.Event()
+    assert readiness.load_in_background(lambda: (readiness.set(ModelState.READY), done.set()), "test-loader")
+    done.wait(5)
+    assert readiness.get_status()["state"] == "ready"
+    assert readiness.get_status()["error"] is None
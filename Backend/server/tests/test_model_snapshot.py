@@ -0,0 +1,43 @@
+"""Unit tests for pre-converted model snapshots."""
+
+from server.services.model_snapshot import read_snapshot, save_snapshot, snapshot_path
+
+
+class FakePretrained:
+    """Stands in for a model or processor; writes one file like save_pretrained."""
+
+    def __init__(self, filename, fail=False):
+        self.filename = filename
+        self.fail = fail
+
+    def save_pretrained(self, path, **kwargs):
+        (path / self.filename).write_text("weights")
+        if self.fail:
+            raise RuntimeError("disk full")
+
+
+def test_snapshot_path_is_per_dtype_and_quantization(tmp_path):
+    """Test that every dtype/quantization combination gets its own directory."""
+    base = snapshot_path(str(tmp_path), "google/medgemma-4b-it", "bfloat16", "int8")
+    assert base.parent == tmp_path
+    assert "/" not in base.name
+    assert base != snapshot_path(str(tmp_path), "google/medgemma-4b-it", "float32", "int8")
+    assert base != snapshot_path(str(tmp_path), "google/medgemma-4b-it", "bfloat16", "none")
+
+
+def test_only_complete_snapshots_are_read(tmp_path):
+    """Test that a failed save leaves nothing behind and a finished one is readable."""
+    path = snapshot_path(str(tmp_path), "m", "float32", "none")
+    assert read_snapshot(path) is None
+
+    try:
+        save_snapshot(path, FakePretrained("model.safetensors", fail=True), FakePretrained("tokenizer.json"), {})
+    except RuntimeError:
+        pass
+    assert read_snapshot(path) is None
+    assert list(tmp_path.iterdir()) == []
+
+    save_snapshot(path, FakePretrained("model.safetensors"), FakePretrained("tokenizer.json"), {"dtype": "float32"})
+    assert read_snapshot(path)["dtype"] == "float32"
+    assert (path / "model.safetensors").exists()
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
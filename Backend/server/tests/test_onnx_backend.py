@@ -0,0 +1,196 @@
+"""Tests for the ONNX Runtime backend: host-side attention masks and greedy parity with torch."""
+
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+from server.config import settings
+from server.services.medgemma import GenerationRequest
+from server.services.onnx_backend import MASK_MIN, attention_masks, decode_masks, image_groups
+
+IMAGE = 9
+
+# Tiny model prompts: (token ids, with image); image token runs match its 4 tokens per image
+TINY_PROMPTS = [
+    ([2, 5, 6, 7, 8], False),
+    ([2, 9, 10], False),
+    ([2, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21], False),
+    ([2, 3, 125, 127, 127, 127, 127, 126, 4, 5], True),
+]
+TINY_MAX_NEW_TOKENS = 16
+
+# Reference prompts for the parity test: (message, domain, mode, with image)
+REFERENCE_PROMPTS = [
+    ("What are the first-line treatments for community-acquired pneumonia?", "general", "consult", False),
+    ("List the differential diagnosis for acute chest pain in a 55 year old.", "general", "consult", False),
+    ("Explain the mechanism of action of metformin in two sentences.", "general", "consult", False),
+    ("Describe this image.", "radiology", "consult", True),
+]
+
+
+def allowed(mask):
+    return mask[0, 0] == 0
+
+
+def test_image_groups_number_contiguous_runs():
+    """Test that each run of image tokens is its own group and text is -1."""
+    ids = np.array([1, IMAGE, IMAGE, 5, IMAGE, IMAGE, IMAGE, 6])
+    assert image_groups(ids, IMAGE).tolist() == [-1, 0, 0, -1, 1, 1, 1, -1]
+    assert image_groups(ids, None).tolist() == [-1] * 8
+
+
+def test_text_masks_are_causal():
+    """Test that without images both masks are causal and blocked positions use the float32 minimum."""
+    full, sliding = attention_masks(np.full(5, -1), 0, sliding_window=None)
+    assert full.shape == (1, 1, 5, 5) and full.dtype == np.float32
+    assert (allowed(full) == np.tril(np.ones((5, 5), dtype=bool))).all()
+    assert (allowed(sliding) == allowed(full)).all()
+    assert full[0, 0, 0, 1] == MASK_MIN
+
+
+def test_sliding_mask_drops_old_keys():
+    """Test that sliding layers only see the last `sliding_window` positions."""
+    full, sliding = attention_masks(np.full(6, -1), 0, sliding_window=2)
+    assert allowed(full)[5].tolist() == [True] * 6
+    assert allowed(sliding)[5].tolist() == [False, False, False, False, True, True]
+
+
+def test_image_tokens_attend_bidirectionally():
+    """Test that tokens of one image see each other, but not other images or later text."""
+    groups = image_groups(np.array([1, IMAGE, IMAGE, IMAGE, 5, IMAGE, IMAGE]), IMAGE)
+    full, sliding = attention_masks(groups, 0, sliding_window=1)
+    full = allowed(full)
+    assert full[1, 3] and full[3, 1]
+    assert not full[1, 4]
+    assert not full[3, 5]
+    assert not full[0, 1]
+    # Within an image the sliding window does not apply
+    assert allowed(sliding)[3, 1]
+
+
+def test_decode_mask_covers_past_and_new_tokens():
+    """Test that a decode step gets one query row over the whole sequence."""
+    groups = image_groups(np.array([1, IMAGE, IMAGE, 5, 6]), IMAGE)
+    full, sliding = attention_masks(groups, 4, sliding_window=2)
+    assert full.shape == sliding.shape == (1, 1, 1, 5)
+    assert allowed(full)[0].all()
+    assert allowed(sliding)[0].tolist() == [False, False, False, True, True]
+
+
+def test_batched_decode_masks_skip_left_padding():
+    """Test that each row sees its own real keys and the new token, and the window counts real distance."""
+    padding = np.array([[1, 1, 1, 1], [0, 0, 1, 1]])
+    full, sliding = decode_masks(padding, sliding_window=3)
+    assert full.shape == sliding.shape == (2, 1, 1, 5)
+    assert allowed(full[:1])[0].tolist() == [True] * 5
+    assert allowed(full[1:])[0].tolist() == [False, False, True, True, True]
+    assert allowed(sliding[:1])[0].tolist() == [False, False, True, True, True]
+    # Without padding a decode row is the last row of the single-sequence mask
+    single, _ = attention_masks(np.full(5, -1), 4, sliding_window=3)
+    assert (full[:1] == single).all()
+
+
+@pytest.fixture(scope="module")
+def tiny_onnx(tiny_gemma3, tmp_path_factory):
+    """The tiny Gemma 3 (eager attention, as exported) and a runner on its exported graphs."""
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnxscript")
+    from server.services.onnx_backend import OnnxGemmaRunner, export_onnx
+
+    model = copy.deepcopy(tiny_gemma3)
+    model_dir = tmp_path_factory.mktemp("tiny_onnx")
+    export_onnx(model, None, str(model_dir))
+    return model, OnnxGemmaRunner(str(model_dir))
+
+
+def tiny_inputs(prompt, with_image):
+    input_ids = torch.tensor([prompt])
+    inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    if with_image:
+        inputs["pixel_values"] = torch.rand(1, 3, 28, 28, generator=torch.Generator().manual_seed(len(prompt)))
+        inputs["token_type_ids"] = (input_ids == 127).long()
+    return inputs
+
+
+def test_tiny_model_batched_greedy_matches_torch(tiny_onnx):
+    """Test that the exported graphs, decoding all prompts in one batch, reproduce torch greedy output."""
+    from server.services.onnx_backend import OnnxScheduler
+
+    model, runner = tiny_onnx
+    expected = []
+    for prompt, with_image in TINY_PROMPTS:
+        with torch.no_grad():
+            output = model.generate(**tiny_inputs(prompt, with_image), do_sample=False, max_new_tokens=TINY_MAX_NEW_TOKENS)
+        expected.append(output[0, len(prompt):].tolist())
+
+    scheduler = OnnxScheduler(runner, eos_token_ids=[1], tokenizer=None, max_batch_size=4)
+    scheduler.start()
+    try:
+        requests = [
+            scheduler.submit(GenerationRequest(inputs=tiny_inputs(prompt, with_image), max_new_tokens=TINY_MAX_NEW_TOKENS))
+            for prompt, with_image in TINY_PROMPTS
+        ]
+        outputs = [request.wait() for request in requests]
+        stats = scheduler.get_stats()
+    finally:
+        scheduler.stop()
+    assert outputs == expected
+    # All rows decoded together: one decoder run per step, not per sequence
+    assert stats["avg_batch_size"] > 1
+
+
+@pytest.fixture(scope="module")
+def services(tmp_path_factory):
+    """A float32 CPU torch service and an ONNX service, both greedy and without reply caches."""
+    pytest.importorskip("onnxruntime")
+    if not settings.onnx_model_dir:
+        pytest.skip("ONNX_MODEL_DIR is not set (export with python -m server.services.onnx_backend export)")
+
+    import torch
+    from server.services.medgemma import MedGemmaService
+    from server.services.onnx_backend import OnnxMedGemmaService
+
+    with pytest.MonkeyPatch.context() as mp:
+        for name in ("response_cache_enabled", "semantic_cache_enabled", "speculative_enabled", "compiled_mode_enabled"):
+            mp.setattr(settings, name, False)
+        torch_service = MedGemmaService()
+        torch_service.device, torch_service.dtype = torch.device("cpu"), torch.float32
+        onnx_service = OnnxMedGemmaService()
+        torch_service.load_model()
+        onnx_service.load_model()
+        yield torch_service, onnx_service
+        torch_service.shutdown()
+        onnx_service.shutdown()
+
+
+@pytest.fixture(scope="module")
+def reference_image(tmp_path_factory):
+    from PIL import Image
+
+    y, x = np.mgrid[0:448, 0:448]
+    pixels = np.stack([x % 256, y % 256, (x + y) % 256], axis=-1).astype(np.uint8)
+    path = tmp_path_factory.mktemp("onnx") / "reference.png"
+    Image.fromarray(pixels).save(path)
+    return str(path)
+
+
+@pytest.mark.parametrize("message,domain,mode,with_image", REFERENCE_PROMPTS)
+def test_greedy_output_matches_torch(services, reference_image, message, domain, mode, with_image):
+    """Test that the ONNX backend generates the same greedy tokens as torch."""
+    from server.api.schemas.request import ChatDomain, ChatMode
+
+    kwargs = dict(
+        user_message=message,
+        image_path=reference_image if with_image else None,
+        domain=ChatDomain(domain),
+        mode=ChatMode(mode),
+        max_new_tokens=48,
+        prompt_lookup=False
+    )
+    torch_service, onnx_service = services
+    expected = torch_service.generate(**kwargs)
+    result = onnx_service.generate(**kwargs)
+    assert result.token_ids == expected.token_ids
+    assert result.stop_reason == expected.stop_reason
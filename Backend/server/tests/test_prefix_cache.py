@@ -0,0 +1,73 @@
+"""Unit tests for the prefix KV cache."""
+
+import torch
+from server.services.prefix_cache import PrefixKVCache
+
+
+def make_layers(token_ids, num_layers=2):
+    """Fake KV state whose values encode the token id at each position."""
+    values = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1)
+    return [(values.clone(), values.clone() * 2) for _ in range(num_layers)]
+
+
+def test_miss_on_empty_cache():
+    """Test lookups on an empty cache miss."""
+    cache = PrefixKVCache(max_bytes=1 << 20, min_prefix_tokens=1)
+    matched, layers = cache.match([1, 2, 3])
+    assert matched == 0
+    assert layers is None
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_exact_and_partial_prefix_match():
+    """Test that a shared prefix is served from the cache."""
+    cache = PrefixKVCache(max_bytes=1 << 20, min_prefix_tokens=1)
+    cache.insert([1, 2, 3, 4], make_layers([1, 2, 3, 4]))
+
+    matched, layers = cache.match([1, 2, 3, 4, 5, 6])
+    assert matched == 4
+    assert layers[0][0].flatten().tolist() == [1, 2, 3, 4]
+
+    # Diverges inside an edge
+    matched, layers = cache.match([1, 2, 9])
+    assert matched == 2
+    assert layers[1][1].flatten().tolist() == [2, 4]
+
+
+def test_branching_prefixes_share_storage():
+    """Test that two prompts with a common prefix split one edge."""
+    cache = PrefixKVCache(max_bytes=1 << 20, min_prefix_tokens=1)
+    cache.insert([1, 2, 3, 4], make_layers([1, 2, 3, 4]))
+    cache.insert([1, 2, 7, 8], make_layers([1, 2, 7, 8]))
+
+    matched, layers = cache.match([1, 2, 7, 8])
+    assert matched == 4
+    assert layers[0][0].flatten().tolist() == [1, 2, 7, 8]
+
+    matched, layers = cache.match([1, 2, 3, 4])
+    assert matched == 4
+    assert layers[0][0].flatten().tolist() == [1, 2, 3, 4]
+
+
+def test_min_prefix_tokens():
+    """Test that short matches are reported as misses."""
+    cache = PrefixKVCache(max_bytes=1 << 20, min_prefix_tokens=3)
+    cache.insert([1, 2, 3, 4], make_layers([1, 2, 3, 4]))
+    matched, _ = cache.match([1, 2, 5])
+    assert matched == 0
+
+
+def test_lru_eviction_under_budget():
+    """Test that the least recently used prefix is evicted first."""
+    one_prompt = sum(k.numel() * 4 + v.numel() * 4 for k, v in make_layers([0] * 4))
+    cache = PrefixKVCache(max_bytes=2 * one_prompt, min_prefix_tokens=1)
+
+    cache.insert([1, 1, 1, 1], make_layers([1, 1, 1, 1]))
+    cache.insert([2, 2, 2, 2], make_layers([2, 2, 2, 2]))
+    cache.match([1, 1, 1, 1])  # touch the first prompt
+    cache.insert([3, 3, 3, 3], make_layers([3, 3, 3, 3]))
+
+    assert cache.match([1, 1, 1, 1])[0] == 4
+    assert cache.match([2, 2, 2, 2])[0] == 0
+    assert cache.match([3, 3, 3, 3])[0] == 4
+    assert cache.get_stats()["evictions"] == 1
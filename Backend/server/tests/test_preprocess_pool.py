@@ -0,0 +1,52 @@
+"""Unit tests for the bounded preprocessing pool."""
+
+import threading
+import time
+import pytest
+from server.services.preprocess_pool import PreprocessPool
+
+
+def test_workers_bound_concurrency_and_queue_blocks_callers():
+    """Test that at most `workers` tasks run at once and callers beyond the queue wait."""
+    pool = PreprocessPool(workers=2, max_queued=1)
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def work(x):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return x * 2
+
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.update({i: pool.run(work, i)})) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {i: i * 2 for i in range(6)}
+    assert peak[0] == 2
+    stats = pool.get_stats()
+    assert stats["completed"] == 6
+    assert stats["peak_in_stage"] <= 3
+    assert stats["blocked"] >= 1
+    pool.shutdown()
+
+
+def test_errors_reach_the_caller():
+    """Test that an exception in preprocessing is raised to the caller and counted."""
+    pool = PreprocessPool(workers=1, max_queued=0)
+
+    def fail():
+        raise ValueError("bad image")
+
+    with pytest.raises(ValueError, match="bad image"):
+        pool.run(fail)
+    assert pool.get_stats()["failed"] == 1
+    assert pool.run(lambda: "ok") == "ok"
+    pool.shutdown()
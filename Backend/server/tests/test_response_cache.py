@@ -0,0 +1,49 @@
+"""Unit tests for the exact-match response cache."""
+
+import time
+from server.services.response_cache import ResponseCache
+
+
+def test_key_covers_prompt_image_and_params():
+    """Test that any input difference changes the key."""
+    params = {"max_new_tokens": 64, "model": "m"}
+    key = ResponseCache.make_key([1, 2, 3], None, params)
+
+    assert key == ResponseCache.make_key([1, 2, 3], None, dict(params))
+    assert key != ResponseCache.make_key([1, 2, 4], None, params)
+    assert key != ResponseCache.make_key([1, 2, 3], "abc", params)
+    assert key != ResponseCache.make_key([1, 2, 3], None, {"max_new_tokens": 32, "model": "m"})
+
+
+def test_lru_and_ttl():
+    """Test LRU eviction and expiry."""
+    cache = ResponseCache(max_entries=2, ttl_s=0)
+    cache.put("a", "reply a", [1])
+    cache.put("b", "reply b", [2])
+    assert cache.get("a").text == "reply a"
+    cache.put("c", "reply c", [3])
+
+    # "b" was least recently used
+    assert cache.get("b") is None
+    assert cache.get("a").token_ids == [1]
+
+    expiring = ResponseCache(max_entries=2, ttl_s=0.01)
+    expiring.put("a", "reply a", [1])
+    time.sleep(0.02)
+    assert expiring.get("a") is None
+    assert expiring.get_stats()["expired"] == 1
+
+
+def test_sqlite_tier_survives_restart(tmp_path):
+    """Test that replies are served from SQLite by a new instance and cleared with it."""
+    db = str(tmp_path / "responses.db")
+    ResponseCache(max_entries=4, sqlite_path=db).put("k", "persisted", [5, 6])
+
+    cache = ResponseCache(max_entries=4, sqlite_path=db)
+    entry = cache.get("k")
+    assert entry.text == "persisted"
+    assert entry.token_ids == [5, 6]
+    assert cache.get_stats()["sqlite_hits"] == 1
+
+    cache.clear()
+    assert ResponseCache(max_entries=4, sqlite_path=db).get("k") is None
@@ -0,0 +1,63 @@
+"""Unit tests for the semantic answer cache."""
+
+import json
+import torch
+import torch.nn.functional as F
+from server.services.semantic_cache import SemanticAnswerCache
+
+VECTORS = {
+    "normal adult potassium range": [1.0, 0.0, 0.0],
+    "what is the normal potassium range in adults": [0.98, 0.2, 0.0],
+    "what is hemoglobin": [0.0, 1.0, 0.0],
+}
+
+
+def fake_embed(text):
+    return F.normalize(torch.tensor(VECTORS[text]), dim=-1)
+
+
+def test_hit_above_threshold_only():
+    """Test that a near-duplicate hits and an unrelated question misses."""
+    cache = SemanticAnswerCache(fake_embed, threshold=0.9)
+    scope = ("general", "consult")
+
+    entry, embedding = cache.lookup(scope, "normal adult potassium range")
+    assert entry is None
+    cache.put(scope, "normal adult potassium range", embedding, "3.5-5.0 mmol/L", [1, 2])
+
+    entry, _ = cache.lookup(scope, "what is the normal potassium range in adults")
+    assert entry.text == "3.5-5.0 mmol/L"
+    assert entry.token_ids == [1, 2]
+
+    entry, _ = cache.lookup(scope, "what is hemoglobin")
+    assert entry is None
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["recent_hits"][0]["matched_question"] == "normal adult potassium range"
+
+
+def test_scopes_are_separate():
+    """Test that answers are not shared across domain/mode."""
+    cache = SemanticAnswerCache(fake_embed, threshold=0.9)
+    _, embedding = cache.lookup(("general", "consult"), "what is hemoglobin")
+    cache.put(("general", "consult"), "what is hemoglobin", embedding, "A protein...", [3])
+
+    entry, _ = cache.lookup(("pathology", "consult"), "what is hemoglobin")
+    assert entry is None
+
+
+def test_audit_log(tmp_path):
+    """Test that every hit is appended to the audit log."""
+    audit = tmp_path / "audit.jsonl"
+    cache = SemanticAnswerCache(fake_embed, threshold=0.9, audit_log_path=str(audit))
+    scope = ("general", "consult")
+    _, embedding = cache.lookup(scope, "normal adult potassium range")
+    cache.put(scope, "normal adult potassium range", embedding, "3.5-5.0 mmol/L", [1])
+    cache.lookup(scope, "what is the normal potassium range in adults")
+
+    records = [json.loads(line) for line in audit.read_text().splitlines()]
+    assert len(records) == 1
+    assert records[0]["question"] == "what is the normal potassium range in adults"
+    assert records[0]["similarity"] >= 0.9
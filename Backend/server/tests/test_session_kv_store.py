@@ -0,0 +1,68 @@
+"""Unit tests for the per-session KV store."""
+
+import torch
+from server.services.session_kv_store import SessionKVStore
+
+
+def make_layers(num_tokens, num_layers=2):
+    """Fake KV state: one float per position, value = position."""
+    values = torch.arange(num_tokens, dtype=torch.float32).view(1, 1, -1, 1)
+    return [(values.clone(), values.clone()) for _ in range(num_layers)]
+
+
+def entry_bytes(num_tokens, num_layers=2):
+    return num_tokens * 4 * 2 * num_layers
+
+
+def test_match_returns_common_prefix(tmp_path):
+    """Test that the next turn reuses the previous turn's tokens."""
+    store = SessionKVStore(ram_budget_bytes=1 << 20, disk_budget_bytes=0, disk_dir=str(tmp_path), min_match_tokens=1)
+    store.put("s1", [1, 2, 3, 4, 5], make_layers(5))
+
+    matched, layers = store.match("s1", [1, 2, 3, 9, 9, 9])
+    assert matched == 3
+    assert layers[0][0].flatten().tolist() == [0, 1, 2]
+
+    matched, layers = store.match("other", [1, 2, 3])
+    assert matched == 0
+    assert layers is None
+
+
+def test_ram_budget_spills_lru_to_disk(tmp_path):
+    """Test that the least recently used session is spilled and reloaded."""
+    store = SessionKVStore(
+        ram_budget_bytes=entry_bytes(8),
+        disk_budget_bytes=1 << 20,
+        disk_dir=str(tmp_path),
+        min_match_tokens=1
+    )
+    store.put("old", [1, 2, 3, 4], make_layers(4))
+    store.put("new", [5, 6, 7, 8, 9], make_layers(5))
+
+    stats = store.get_stats()
+    assert stats["ram_sessions"] == 1
+    assert stats["disk_sessions"] == 1
+    assert len(list(tmp_path.glob("*.pt"))) == 1
+
+    matched, layers = store.match("old", [1, 2, 3, 4])
+    assert matched == 4
+    assert layers[1][1].flatten().tolist() == [0, 1, 2, 3]
+    assert store.get_stats()["disk_hits"] == 1
+
+
+def test_idle_spill_and_drop(tmp_path):
+    """Test idle entries move to disk and dropped sessions are removed."""
+    store = SessionKVStore(
+        ram_budget_bytes=1 << 20,
+        disk_budget_bytes=1 << 20,
+        idle_spill_s=0,
+        disk_dir=str(tmp_path),
+        min_match_tokens=1
+    )
+    store.put("s1", [1, 2, 3], make_layers(3))
+    store.spill_idle()
+    assert store.get_stats()["disk_sessions"] == 1
+
+    store.drop("s1")
+    assert store.get_stats()["disk_sessions"] == 0
+    assert not list(tmp_path.glob("*.pt"))
@@ -0,0 +1,53 @@
+"""Unit tests for text-based stopping conditions."""
+
+from server.services.stop_conditions import RepetitionDetector, StopCondition
+
+
+def feed_all(condition, deltas):
+    """Feed deltas until one reports a stop; return (reason, number of deltas consumed)."""
+    for i, delta in enumerate(deltas, 1):
+        reason = condition.feed(delta)
+        if reason is not None:
+            return reason, i
+    return None, len(deltas)
+
+
+def test_stops_after_balanced_tool_call():
+    """Test that the call is complete only when its outer brace closes, ignoring braces in strings."""
+    deltas = ["Sure. tool", "_code", " {\"tool\": \"echo\", ", "\"args\": {\"text\": \"a}{b\"}", "}", " and more"]
+    assert feed_all(StopCondition(stop_on_tool_call=True), deltas) == ("tool_call", 5)
+
+
+def test_tool_code_in_prose_is_not_a_call():
+    """Test that a mention of tool_code not followed by an object does not start a call."""
+    condition = StopCondition(stop_on_tool_call=True)
+    assert condition.feed("Use the tool_code prefix. {not a call}") is None
+    assert condition.feed("tool_code{\"tool\": \"x\", \"args\": {}}") == "tool_call"
+
+
+def test_stop_sequence_split_across_deltas():
+    """Test that stop sequences match across delta boundaries."""
+    condition = StopCondition(["\n\nReferences:"])
+    assert feed_all(condition, ["Answer.\n", "\nRefer", "ences:", " [1]"]) == ("stop_sequence", 3)
+    assert not StopCondition()
+
+
+def test_repetition_detected_on_repeated_span():
+    """Test that a span repeated max_repeats times stops generation, and varied text does not."""
+    detector = RepetitionDetector(ngram_tokens=3, max_repeats=3)
+    assert not any(detector.add(token) for token in range(50))
+
+    detector = RepetitionDetector(ngram_tokens=3, max_repeats=3)
+    loop = [7, 8, 9, 10] * 3
+    stopped_at = next(i for i, token in enumerate(loop) if detector.add(token))
+    assert stopped_at == len(loop) - 2
+    assert detector.repeated == (7, 8, 9)
+
+
+def test_recurring_phrase_with_text_between_is_not_a_loop():
+    """Test that a phrase repeated on every row of a list, with other text between, does not stop generation."""
+    detector = RepetitionDetector(ngram_tokens=3, max_repeats=3)
+    phrase = [50, 51, 52, 53]
+    rows = [token for lab in range(6) for token in [100 + lab, 200 + lab] + phrase]
+    assert not any(detector.add(token) for token in rows)
+    assert detector.repeated is None
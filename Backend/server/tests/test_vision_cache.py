@@ -0,0 +1,48 @@
+"""Unit tests for the vision embedding cache."""
+
+import torch
+from server.services.vision_cache import VisionEmbeddingCache
+
+
+def test_hash_is_content_addressed(tmp_path):
+    """Test that identical files at different paths hash the same."""
+    a = tmp_path / "a.png"
+    b = tmp_path / "b.png"
+    c = tmp_path / "c.png"
+    a.write_bytes(b"same image bytes")
+    b.write_bytes(b"same image bytes")
+    c.write_bytes(b"other image bytes")
+
+    assert VisionEmbeddingCache.hash_file(str(a)) == VisionEmbeddingCache.hash_file(str(b))
+    assert VisionEmbeddingCache.hash_file(str(a)) != VisionEmbeddingCache.hash_file(str(c))
+
+
+def test_pixel_values_then_features():
+    """Test that features are added to an existing pixel_values entry."""
+    cache = VisionEmbeddingCache(max_bytes=1 << 20)
+    assert cache.get("abc") is None
+
+    cache.put_pixel_values("abc", torch.zeros(1, 3, 4, 4))
+    entry = cache.get("abc")
+    assert entry.pixel_values is not None
+    assert entry.image_features is None
+
+    cache.put_features("abc", torch.ones(1, 2, 8))
+    entry = cache.get("abc")
+    assert entry.image_features.shape == (1, 2, 8)
+    assert cache.get_stats()["feature_hits"] == 1
+
+
+def test_lru_eviction_with_disk_tier(tmp_path):
+    """Test that evicted entries are served again from disk."""
+    one_entry = 16 * 4
+    cache = VisionEmbeddingCache(max_bytes=one_entry, disk_dir=str(tmp_path))
+
+    cache.put_features("first", torch.full((16,), 1.0))
+    cache.put_features("second", torch.full((16,), 2.0))
+    assert cache.get_stats()["entries"] == 1
+
+    entry = cache.get("first")
+    assert entry is not None
+    assert entry.image_features[0].item() == 1.0
+    assert cache.get_stats()["disk_hits"] == 1
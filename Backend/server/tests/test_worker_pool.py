@@ -0,0 +1,48 @@
+"""Unit tests for the replica worker pool dispatcher (no worker processes started)."""
+
+import queue
+
+from server.services.worker_pool import ReplicaWorkerPool, replica_core_sets, SESSION_AFFINITY_SLACK
+
+
+def test_core_sets_are_disjoint_when_cores_suffice():
+    """Test that replicas get separate cores of the requested size."""
+    core_sets = replica_core_sets(2, 1)
+
+    assert len(core_sets) == 2
+    assert all(len(cores) == 1 for cores in core_sets)
+    assert replica_core_sets(1, 0)[0]
+
+
+def test_pick_least_loaded_with_session_affinity():
+    """Test load-based routing and that sessions stick to their replica until it is much busier."""
+    pool = ReplicaWorkerPool(3, threads_per_replica=1, pin_cores=False)
+    for replica in pool.replicas:
+        replica.ready = True
+    pool.replicas[0].in_flight = 2
+    pool.replicas[1].in_flight = 1
+
+    assert pool._pick_replica(None).index == 2
+
+    pool._session_replica["s1"] = 0
+    assert pool._pick_replica("s1").index == 0
+
+    pool.replicas[0].in_flight = SESSION_AFFINITY_SLACK + 1
+    pool.replicas[2].in_flight = 0
+    assert pool._pick_replica("s1").index == 2
+
+    pool.replicas[2].ready = False
+    assert pool._pick_replica(None).index == 1
+
+
+def test_clear_prompt_cache_reaches_every_started_replica():
+    """Test that a prompt reload is sent to each replica process, including ones still loading."""
+    pool = ReplicaWorkerPool(3, threads_per_replica=1, pin_cores=False)
+    for replica in pool.replicas[:2]:
+        replica.inbox = queue.Queue()
+    pool.replicas[0].ready = True
+
+    pool.clear_prompt_cache()
+
+    assert [r.inbox.get_nowait() for r in pool.replicas[:2]] == [("clear_prompt_cache",)] * 2
+    assert pool.replicas[2].inbox is None